@@ -1,12 +1,9 @@
 import streamlit as st
-from PIL import Image
-import os
-from tempfile import NamedTemporaryFile
 import base64
 
 # Import your project's modules
 from src.model import load_model
-from src.analyze import get_predictions, create_probability_fig, create_heatmap_figs
+from src.analyze import CONFIDENCE_THRESHOLD, detected_diseases, get_predictions, create_probability_fig, create_heatmap_figs
 
 # =================================================================================================
 # --- PAGE CONFIGURATION ---
@@ -143,6 +140,23 @@ model = load_cached_model()
 # --- ASSET & HELPER FUNCTIONS ---
 # =================================================================================================
 
+@st.cache_data(max_entries=16, show_spinner=False)
+def analyze_upload(image_bytes):
+    """
+    Runs the model once per distinct upload: the result is memoized on the image content, so reruns
+    (navigation, widgets, resizing) reuse the predictions and the encoded heatmaps.
+    Returns None if the image can't be read.
+    """
+    results, orig_img, features = get_predictions(image_bytes, model)
+    if results is None:
+        return None
+    detected = detected_diseases(results)
+    return {
+        "results": results,
+        "detected": detected,
+        "heatmap_figs": create_heatmap_figs(list(detected), features, model, orig_img),
+    }
+
 @st.cache_data
 def get_base64_of_bin_file(bin_file):
     with open(bin_file, 'rb') as f:
@@ -171,40 +185,37 @@ def render_analyzer_page():
 
     # --- MAIN CONTENT AREA ---
     if uploaded_file is not None:
-        # Save uploaded file to a temporary path
-        with NamedTemporaryFile(delete=False, suffix=".png") as temp_image:
-            temp_image.write(uploaded_file.getvalue())
-            temp_path = temp_image.name
+        image_bytes = uploaded_file.getvalue()
 
         # --- ANALYSIS DASHBOARD ---
         col1, col2 = st.columns([0.45, 0.55])
 
         with col1:
             st.markdown("<div class='card-title'>Uploaded Radiograph</div>", unsafe_allow_html=True)
-            image = Image.open(uploaded_file)
-            st.image(image, caption='Patient X-Ray', use_container_width=True, output_format='PNG')
+            # The uploaded bytes are shown as they are, without decoding and re-encoding on every rerun
+            st.image(image_bytes, caption='Patient X-Ray', use_container_width=True)
         
         with col2:
             with st.spinner('🤖 AI is performing a deep analysis...'):
-                results, orig_img = get_predictions(temp_path, model)
+                analysis = analyze_upload(image_bytes)
+                results = analysis["results"] if analysis else None
                 
                 if results:
-                    threshold = 0.5
-                    detected = {k: v for k, v in results.items() if v > threshold}
+                    detected = analysis["detected"]
                     
                     st.markdown("<div class='card-title'>Comprehensive Analysis Report</div>", unsafe_allow_html=True)
                     if detected:
-                        st.write("The model has identified the following potential pathologies with confidence levels above 50%:")
-                        sorted_detected = sorted(detected.items(), key=lambda item: item[1], reverse=True)
-                        for disease, prob in sorted_detected:
+                        st.write(f"The model has identified the following potential pathologies with confidence levels above {CONFIDENCE_THRESHOLD}%:")
+                        for disease, prob in detected.items():
                             st.warning(f"**{disease}**: Detected with **{prob*100:.1f}%** confidence.")
                     else:
-                        st.success("✅ **Normal Finding:** The model did not detect any of the targeted pathologies above the 50% confidence threshold.")
+                        st.success(f"✅ **Normal Finding:** The model did not detect any of the targeted pathologies above the {CONFIDENCE_THRESHOLD}% confidence threshold.")
                     
                     st.markdown("---")
                     st.subheader("Full Probability Distribution")
-                    prob_fig = create_probability_fig(results, uploaded_file.name)
-                    st.pyplot(prob_fig)
+                    st.vega_lite_chart(create_probability_fig(results, uploaded_file.name), use_container_width=True)
+                else:
+                    st.error("❌ The image could not be read. Please upload a PNG or JPEG radiograph.")
         
         # --- GRAD-CAM VISUALIZATION SECTION ---
         if results and detected:
@@ -212,21 +223,17 @@ def render_analyzer_page():
             st.markdown("<p class='main-header' style='font-size: 2rem;'>Explainable AI (XAI) Visualizations</p>", unsafe_allow_html=True)
             st.info("💡 The highlighted areas (heatmaps) below show which parts of the X-ray the AI model focused on to make its predictions for each detected condition. This provides transparency into the AI's decision-making process.")
             
-            with st.spinner('Generating visual explanations...'):
-                heatmap_figs = create_heatmap_figs(detected.keys(), temp_path, model, orig_img)
-                
-                num_heatmaps = len(heatmap_figs)
-                if num_heatmaps > 0:
-                    # Dynamically create columns for a clean, responsive layout
-                    max_cols = 3
-                    cols = st.columns(min(num_heatmaps, max_cols))
-                    col_idx = 0
-                    for disease, fig in heatmap_figs.items():
-                        with cols[col_idx]:
-                            st.pyplot(fig, use_container_width=True)
-                        col_idx = (col_idx + 1) % max_cols
-        
-        os.remove(temp_path)
+            heatmap_figs = analysis["heatmap_figs"]
+            num_heatmaps = len(heatmap_figs)
+            if num_heatmaps > 0:
+                # Dynamically create columns for a clean, responsive layout
+                max_cols = 3
+                cols = st.columns(min(num_heatmaps, max_cols))
+                col_idx = 0
+                for disease, fig in heatmap_figs.items():
+                    with cols[col_idx]:
+                        st.image(fig, caption=disease, use_container_width=True)
+                    col_idx = (col_idx + 1) % max_cols
 
     else:
         # --- WELCOME SCREEN ---
@@ -289,7 +296,7 @@ def render_faq_page():
         st.write("A confidence score represents the model's certainty (from 0% to 100%) that a specific feature or pathology is present in the image. A high score does not confirm a diagnosis but indicates a high probability according to the model's training. We flag any finding above 50% for review.")
 
     with st.expander("Is my data private and secure?"):
-        st.write("Yes. Images are processed in a temporary, secure environment and are deleted immediately after the analysis is complete. We do not store any patient data or uploaded images.")
+        st.write("Yes. Images are processed in memory and never written to disk. The results of the most recent uploads are kept in the server's memory only so that the page can be redrawn without re-running the analysis. We do not store any patient data or uploaded images.")
     
     st.markdown(
         """
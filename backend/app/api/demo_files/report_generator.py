@@ -1,12 +1,19 @@
-import google.generativeai as genai
+import argparse
+import hashlib
 import json
-from fpdf import FPDF
 import os
+import random
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from fpdf import FPDF
 
 # --- Configuration ---
-# IMPORTANT: Replace "YOUR_API_KEY" with your actual Google AI API key.
+# Read the key from the environment, like xray_analyzer's gemini_handler.
 # You can get your key from https://aistudio.google.com/app/apikey
-API_KEY = ""
+API_KEY = os.environ.get("GEMINI_API_KEY", "")
 
 # Name for the input JSON file
 PATIENT_DATA_FILE = "patient.json"
@@ -14,6 +21,11 @@ PATIENT_DATA_FILE = "patient.json"
 # Name for the output PDF file
 OUTPUT_PDF_FILE = "patient_report.pdf"
 
+GEMINI_MODEL = "gemini-1.5-flash-latest"
+
+# The API server's modules, for its offline stub of Gemini
+XRAY_ANALYZER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), *[os.pardir] * 4, "xray_analyzer")
+
 # --- Main Functions ---
 
 def create_patient_json_template():
@@ -75,22 +87,50 @@ def generate_prompt(patient_data):
     """
     return prompt
 
+def clean_response_text(text):
+    """Cleans up the response text from markdown-like formatting for better PDF rendering."""
+    return text.replace('**', '').replace('*', '')
+
+class GeminiClient:
+    """Gemini client configured once and reused for every request."""
+    def __init__(self, api_key, model_name=GEMINI_MODEL):
+        import google.generativeai as genai
+        genai.configure(api_key=api_key)
+        self.model = genai.GenerativeModel(model_name)
+
+    def generate(self, prompt):
+        return self.model.generate_content(prompt).text
+
+class StubClient:
+    """
+    GeminiClient's interface over the API server's offline stand-in for Gemini (gemini_handler.StubBackend):
+    its canned report after `latency` seconds, failing at `failure_rate`.
+    """
+    def __init__(self, latency=0.5, failure_rate=0.0):
+        if XRAY_ANALYZER_DIR not in sys.path:
+            sys.path.append(XRAY_ANALYZER_DIR)
+        from gemini_handler import StubBackend
+        self.backend = StubBackend(latency_seconds=latency, latency_sigma=0, error_rate=failure_rate, stream_error_rate=0)
+
+    def generate(self, prompt):
+        return "".join(self.backend.stream(prompt))
+
 def get_gemini_response(api_key, prompt):
     """Sends the prompt to the Gemini API and gets the response."""
     try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('gemini-1.5-flash-latest')
-        response = model.generate_content(prompt)
-        # Clean up the response text from markdown-like formatting for better PDF rendering
-        cleaned_text = response.text.replace('**', '').replace('*', '')
-        return cleaned_text
+        return clean_response_text(GeminiClient(api_key).generate(prompt))
     except Exception as e:
         print(f"\nAn error occurred while contacting the Gemini API: {e}")
         print("Please check your API key and internet connection.")
         return None
 
-def create_pdf_report(title, report_text, filename):
-    """Creates a PDF file from the given text."""
+HEADING_PATTERN = re.compile(r"^\s*\d+\.\s+\S")
+
+def create_pdf_report(title, report_text, filename, quiet=False, sections=False):
+    """
+    Creates a PDF file from the given text. Returns True on success.
+    With `sections` (batch mode), each paragraph is laid out on its own, numbered section headings in bold.
+    """
     pdf = FPDF()
     pdf.add_page()
     pdf.set_auto_page_break(auto=True, margin=15)
@@ -100,26 +140,216 @@ def create_pdf_report(title, report_text, filename):
     pdf.cell(0, 10, title, ln=True, align='C')
     pdf.ln(10) # Add a line break
     
-    # Set Body Text
-    pdf.set_font("Arial", size=12)
-    # The multi_cell is used for text that can span multiple lines and wrap automatically
     # We use encode('latin-1', 'replace') to handle potential unicode characters that FPDF doesn't support by default
-    pdf.multi_cell(0, 10, txt=report_text.encode('latin-1', 'replace').decode('latin-1'))
+    report_text = report_text.encode('latin-1', 'replace').decode('latin-1')
+    if sections:
+        # One paragraph at a time: numbered section headings in bold, single-spaced lines
+        for paragraph in report_text.split('\n'):
+            if not paragraph.strip():
+                pdf.ln(3)
+                continue
+            pdf.set_font("Arial", 'B' if HEADING_PATTERN.match(paragraph) else '', 12)
+            pdf.multi_cell(0, 6, txt=paragraph)
+    else:
+        # Set Body Text
+        pdf.set_font("Arial", size=12)
+        # The multi_cell is used for text that can span multiple lines and wrap automatically
+        pdf.multi_cell(0, 10, txt=report_text)
     
     try:
         pdf.output(filename)
-        print(f"\nSuccessfully generated PDF report: '{filename}'")
+        if not quiet:
+            print(f"\nSuccessfully generated PDF report: '{filename}'")
+        return True
     except Exception as e:
         print(f"\nAn error occurred while creating the PDF: {e}")
+        return False
+
+# --- Batch Mode ---
+
+class RateLimiter:
+    """Token bucket shared by the worker threads: at most `per_minute` calls per minute, with bursts of `burst`."""
+    def __init__(self, per_minute, burst=1):
+        self.interval = 60.0 / per_minute
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last) / self.interval)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) * self.interval
+            time.sleep(delay)
+
+def iter_patient_records(source):
+    """Yields (record id, patient data) from a directory of .json files (id: file name) or a .jsonl file (id: "id" field or line number)."""
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            if name.endswith('.json'):
+                yield os.path.splitext(name)[0], read_patient_data(os.path.join(source, name))
+    else:
+        with open(source) as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    print(f"Error: line {line_number} of '{source}' contains invalid JSON.")
+                    yield f"line-{line_number:06d}", None
+                    continue
+                if not isinstance(record, dict):
+                    print(f"Error: line {line_number} of '{source}' is not a JSON object.")
+                    yield f"line-{line_number:06d}", None
+                    continue
+                yield str(record.pop("id", f"patient-{line_number:06d}")), record
+
+def safe_record_id(record_id):
+    """
+    The PDF file name of a record. Ids that need escaping also get a hash of the original id,
+    so two ids escaping to the same name (like "a/b" and "a_b") still get their own PDF.
+    """
+    safe = re.sub(r"[^A-Za-z0-9_.-]", "_", record_id)
+    if safe == record_id:
+        return safe
+    return f"{safe}-{hashlib.blake2b(record_id.encode(), digest_size=4).hexdigest()}"
+
+def generate_with_retries(llm, prompt, rate_limiter, retries, stats):
+    """Calls the LLM under the rate limit, retrying failures with exponential backoff and jitter."""
+    for attempt in range(retries + 1):
+        rate_limiter.acquire()
+        start = time.perf_counter()
+        try:
+            text = llm.generate(prompt)
+            stats.add("llm_seconds", time.perf_counter() - start)
+            return clean_response_text(text)
+        except Exception:
+            if attempt == retries:
+                raise
+            stats.add("retries", 1)
+            time.sleep(min(60.0, 2 ** attempt) * (0.5 + random.random()))
+
+def render_pdf(title, report_text, filename):
+    """Process-pool task: renders to a temporary file and renames it, so a PDF on disk is always complete."""
+    tmp_filename = f"{filename}.{os.getpid()}.tmp"
+    try:
+        if not create_pdf_report(title, report_text, tmp_filename, quiet=True, sections=True):
+            raise RuntimeError(f"could not write '{filename}'")
+        os.replace(tmp_filename, filename)
+    finally:
+        # Only left over if rendering failed
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+    return filename
+
+class BatchStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.values = {"generated": 0, "skipped": 0, "failed": 0, "retries": 0, "llm_seconds": 0.0}
+
+    def add(self, name, amount):
+        with self._lock:
+            self.values[name] += amount
+
+def run_batch(args):
+    """Generates one PDF per patient record. Records whose PDF already exists are skipped, so reruns resume."""
+    if args.stub:
+        llm = StubClient(latency=args.stub_latency, failure_rate=args.stub_failure_rate)
+    else:
+        if not API_KEY:
+            print("\nERROR: Please set GEMINI_API_KEY to your Google AI API key, or use --stub.")
+            return
+        llm = GeminiClient(API_KEY)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    rate_limiter = RateLimiter(args.rate_limit, burst=args.concurrency)
+    stats = BatchStats()
+    errors = open(os.path.join(args.output_dir, "errors.jsonl"), "a")
+    pdf_pool = ProcessPoolExecutor(max_workers=args.pdf_workers)
+    llm_pool = ThreadPoolExecutor(max_workers=args.concurrency)
+    start = time.perf_counter()
+
+    def process(record_id, patient_data, filename):
+        if not isinstance(patient_data, dict):
+            raise ValueError("unreadable patient record")
+        report_text = generate_with_retries(llm, generate_prompt(patient_data), rate_limiter, args.retries, stats)
+        patient_name = patient_data.get("patient_details", {}).get("name", "Unknown Patient")
+        # The LLM thread hands the layout to the process pool and moves on to the next record
+        return pdf_pool.submit(render_pdf, f"Medical Analysis Report for {patient_name}", report_text, filename)
+
+    def record_error(record_id, error):
+        stats.add("failed", 1)
+        errors.write(json.dumps({"id": record_id, "error": str(error), "time": time.time()}) + "\n")
+        errors.flush()
+        print(f"❌ {record_id}: {error}")
+
+    in_flight = {} # future -> record id; LLM futures resolve to PDF futures
+    max_in_flight = args.concurrency * 4
+
+    def drain(block_until):
+        while len(in_flight) > block_until:
+            done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+            for future in done:
+                record_id = in_flight.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    record_error(record_id, e)
+                    continue
+                if isinstance(result, str):
+                    stats.add("generated", 1)
+                else:
+                    in_flight[result] = record_id # PDF still rendering
+
+    try:
+        for record_id, patient_data in iter_patient_records(args.source):
+            filename = os.path.join(args.output_dir, f"{safe_record_id(record_id)}.pdf")
+            if os.path.exists(filename):
+                stats.add("skipped", 1)
+                continue
+            in_flight[llm_pool.submit(process, record_id, patient_data, filename)] = record_id
+            drain(max_in_flight)
+        drain(0)
+    finally:
+        llm_pool.shutdown(wait=True)
+        pdf_pool.shutdown(wait=True)
+        errors.close()
+
+    elapsed = time.perf_counter() - start
+    values = stats.values
+    rate = values["generated"] / elapsed * 60 if elapsed > 0 else 0.0
+    mean_llm = values["llm_seconds"] / max(1, values["generated"])
+    print(f"\n✅ {values['generated']} reports generated, {values['skipped']} already done, {values['failed']} failed "
+          f"in {elapsed:.1f}s: {rate:.1f} reports/min")
+    print(f"   LLM: {mean_llm:.2f}s per call on average, {values['retries']} retries. Output: {args.output_dir}")
 
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate patient analysis PDF reports.")
+    parser.add_argument("--batch", dest="source", help="Directory of patient .json files or a .jsonl file; without it, patient.json is used")
+    parser.add_argument("-o", "--output-dir", default="reports", help="Where batch PDFs are written (default: reports/)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent LLM calls (default: 8)")
+    parser.add_argument("--rate-limit", type=float, default=60, help="LLM calls per minute (default: 60)")
+    parser.add_argument("--retries", type=int, default=4, help="Retries per record, with exponential backoff (default: 4)")
+    parser.add_argument("--pdf-workers", type=int, default=max(1, (os.cpu_count() or 2) // 2), help="PDF rendering processes")
+    parser.add_argument("--stub", action="store_true", help="Use the offline LLM stub instead of Gemini")
+    parser.add_argument("--stub-latency", type=float, default=0.5, help="Stub response time in seconds")
+    parser.add_argument("--stub-failure-rate", type=float, default=0.0, help="Fraction of stub calls that fail")
+    return parser.parse_args(argv)
 
 def main():
     """Main function to run the script."""
     print("--- Patient Analysis Report Generator ---")
 
     # Check for API Key
-    if API_KEY == "YOUR_API_KEY" or not API_KEY:
-        print("\nERROR: Please replace 'YOUR_API_KEY' with your actual Google AI API key in the script.")
+    if not API_KEY:
+        print("\nERROR: Please set GEMINI_API_KEY to your Google AI API key.")
         return
         
     # Create and check for the patient data file
@@ -153,4 +383,8 @@ def main():
     create_pdf_report(report_title, report_content, OUTPUT_PDF_FILE)
 
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    if args.source:
+        run_batch(args)
+    else:
+        main()
@@ -1,38 +1,149 @@
+import base64
+import json
 import os
-from flask import Flask, request, jsonify, render_template
-from werkzeug.utils import secure_filename
+import queue
+import time
+from functools import partial
+from flask import Flask, request, jsonify, render_template, Response, stream_with_context
 import torch
 
 # Import your project's modules
-from src.model import load_model
-from src.analyze import get_predictions_for_api # This function now returns heatmaps too
+from src.model import load_model, warmup_model, MODEL_VERSION
+from src.analyze import CLASSES, analyze_study, disease_cams, get_predictions_for_api
+from src.inference import InferenceScheduler
+from src.cache import ResultCache
+from src.preprocess import PreprocessPool
+from src.heatmaps import HeatmapStore, IMAGE_FORMATS
+from src.tta import TestTimeAugmentation
+from src import metrics
+from src.metrics import span
 
 # --- CONFIGURATION ---
-UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 
+# Image decoding/preprocessing runs on its own pool, overlapping with inference
+PREPROCESS_WORKERS = int(os.environ.get('PREPROCESS_WORKERS', 2))
+PREPROCESS_PROCESSES = os.environ.get('PREPROCESS_PROCESSES', '0') == '1'
+
+# Micro-batching of concurrent /analyze requests
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 8))
+MAX_BATCH_WAIT_MS = float(os.environ.get('MAX_BATCH_WAIT_MS', 10))
+MAX_QUEUE_SIZE = int(os.environ.get('MAX_QUEUE_SIZE', 64))
+
+# Cold start: memory-map the local checkpoint and warm the model up before serving
+MODEL_MMAP = os.environ.get('MODEL_MMAP', '0') == '1'
+WARMUP_STEPS = int(os.environ.get('WARMUP_STEPS', 1))
+
+# Inference precision: fp32, fp32-fused, bf16 or int8 (calibrated on CALIBRATION_DIR), see `python -m src.parity`
+MODEL_PRECISION = os.environ.get('MODEL_PRECISION', 'fp32')
+CALIBRATION_DIR = os.environ.get('CALIBRATION_DIR') or None
+
+# Repeated uploads of the same image are answered from the result cache
+RESULT_CACHE_MB = int(os.environ.get('RESULT_CACHE_MB', 256))
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR') or None
+
+# The activations of an analysis are kept this long (and within this much memory) so that
+# /heatmaps/<study_id>/<disease> can compute Grad-CAMs on demand
+HEATMAP_TTL_SECONDS = int(os.environ.get('HEATMAP_TTL_SECONDS', 300))
+HEATMAP_STORE_MB = int(os.environ.get('HEATMAP_STORE_MB', 256))
+# With several server processes (python -m src.serve), studies are shared through this directory
+HEATMAP_SHARED_DIR = os.environ.get('HEATMAP_SHARED_DIR') or None
+
+# Test-time augmentation, off unless a request asks for it with ?tta= (see src/tta.py);
+# TTA_VIEWS and TTA_AGGREGATE set the defaults for every request
+TTA_VIEWS = os.environ.get('TTA_VIEWS', '')
+TTA_AGGREGATE = os.environ.get('TTA_AGGREGATE', 'mean')
+
 app = Flask(__name__)
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
-
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# /metrics, per-route latency and X-Request-ID; METRICS_ENABLED=0 turns it off, TRACE_REQUESTS=1 adds traces
+metrics.init_app(app)
 
 # --- MODEL LOADING ---
 print("--- Med-AI Server is starting up ---")
-model = load_model()
+startup_start = time.perf_counter()
+model = load_model(mmap=MODEL_MMAP, precision=MODEL_PRECISION, calibration_dir=CALIBRATION_DIR)
 print("--- Model loaded successfully ---")
+load_seconds = time.perf_counter() - startup_start
+warmup_model(model, steps=WARMUP_STEPS)
+STARTUP_METRICS = {
+    "model_load_seconds": round(load_seconds, 4),
+    "warmup_seconds": round(time.perf_counter() - startup_start - load_seconds, 4),
+    "startup_seconds": round(time.perf_counter() - startup_start, 4),
+    "first_request_seconds": None,
+}
+print(f"--- Model warmed up, ready in {STARTUP_METRICS['startup_seconds']:.2f}s ---")
+scheduler = InferenceScheduler(
+    model,
+    max_batch_size=MAX_BATCH_SIZE,
+    max_wait_ms=MAX_BATCH_WAIT_MS,
+    max_queue_size=MAX_QUEUE_SIZE
+).start()
+preprocess_pool = PreprocessPool(
+    workers=PREPROCESS_WORKERS,
+    use_processes=PREPROCESS_PROCESSES,
+    max_pending=MAX_QUEUE_SIZE
+)
+result_cache = ResultCache(f"{MODEL_VERSION}+{MODEL_PRECISION}", max_bytes=RESULT_CACHE_MB * 1024 * 1024, disk_dir=RESULT_CACHE_DIR)
+heatmap_store = HeatmapStore(
+    partial(disease_cams, model),
+    CLASSES,
+    ttl_seconds=HEATMAP_TTL_SECONDS,
+    max_bytes=HEATMAP_STORE_MB * 1024 * 1024,
+    shared_dir=HEATMAP_SHARED_DIR
+)
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def parse_heatmap_format():
+    """Reads ?format= and ?quality= shared by the heatmap routes. Returns (format, quality, error response)."""
+    fmt = request.args.get('format', 'png').lower()
+    if fmt == 'jpg':
+        fmt = 'jpeg'
+    if fmt not in IMAGE_FORMATS and fmt != 'cam':
+        return None, None, (jsonify({"error": f"Unsupported format '{fmt}'"}), 400)
+    try:
+        quality = min(max(int(request.args.get('quality', 90)), 1), 100)
+    except ValueError:
+        return None, None, (jsonify({"error": "quality must be an integer"}), 400)
+    return fmt, quality, None
+
+def parse_tta():
+    """
+    Reads ?tta= (a number of views or comma-separated view names), ?tta_aggregate= and ?tta_cams=1.
+    Returns (TestTimeAugmentation or None, error response). The CAMs of all the views are only
+    computed for inline heatmaps, so ?tta_cams=1 without ?heatmaps=inline is an error.
+    """
+    views = request.args.get('tta', TTA_VIEWS).strip()
+    if request.args.get('tta_cams') == '1' and request.args.get('heatmaps') != 'inline':
+        return None, (jsonify({"error": "tta_cams=1 needs heatmaps=inline; lazy heatmaps use the identity view"}), 400)
+    if views in ('', '0', '1'):
+        return None, None
+    try:
+        views = int(views) if views.isdigit() else [v for v in views.split(',') if v]
+        tta = TestTimeAugmentation(
+            views,
+            aggregate=request.args.get('tta_aggregate', TTA_AGGREGATE),
+            cams=request.args.get('tta_cams') == '1'
+        )
+    except ValueError as e:
+        return None, (jsonify({"error": str(e)}), 400)
+    return tta, None
+
 # --- API ROUTES ---
 
 @app.route('/')
 def serve_app():
     return render_template('index.html')
 
+@app.route('/health')
+def health():
+    return jsonify({"status": "ready", "startup": STARTUP_METRICS, "cache": result_cache.stats(), "heatmaps": heatmap_store.stats()})
+
 @app.route('/analyze', methods=['POST'])
 def analyze_image():
+    request_start = time.perf_counter()
     if 'file' not in request.files:
         return jsonify({"error": "No file part in the request"}), 400
     
@@ -41,38 +152,110 @@ def analyze_image():
     if file.filename == '':
         return jsonify({"error": "No file selected"}), 400
         
+    tta, error = parse_tta()
+    if error:
+        return error
+
     if file and allowed_file(file.filename):
-        filepath = None # Define filepath here to be accessible in finally block
         try:
-            filename = secure_filename(file.filename)
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
+            # The upload is decoded straight from memory, it never touches the disk
+            with span("upload"):
+                image_bytes = file.read()
             
-            print(f"--- Analyzing image: {filepath} ---")
+            print(f"--- Analyzing image: {file.filename} ---")
             
-            # This now returns two values: predictions and heatmaps
-            predictions, heatmaps = get_predictions_for_api(filepath, model)
+            # By default only the forward pass runs: heatmaps are returned as URLs and computed
+            # when fetched. ?heatmaps=inline computes them now and returns base64 PNGs instead.
+            # With ?tta=, all the augmented views go through that forward pass as one batch.
+            if request.args.get('heatmaps') == 'inline':
+                predictions, heatmaps = get_predictions_for_api(
+                    image_bytes, model,
+                    scheduler=scheduler,
+                    cache=result_cache,
+                    preprocess_pool=preprocess_pool,
+                    tta=tta
+                )
+                result = None if predictions is None else {"predictions": predictions, "heatmaps": heatmaps}
+            else:
+                result = analyze_study(
+                    image_bytes, model, heatmap_store,
+                    scheduler=scheduler,
+                    cache=result_cache,
+                    preprocess_pool=preprocess_pool,
+                    tta=tta
+                )
             
-            if predictions is None:
+            if result is None:
                  return jsonify({"error": "Could not process image"}), 500
             
-            print("--- Analysis complete, sending results and heatmaps. ---")
-            # Return both predictions and heatmaps in the response
-            return jsonify({
-                "predictions": predictions,
-                "heatmaps": heatmaps
-            })
+            if STARTUP_METRICS["first_request_seconds"] is None:
+                STARTUP_METRICS["first_request_seconds"] = round(time.perf_counter() - request_start, 4)
+            
+            print("--- Analysis complete, sending results. ---")
+            with span("serialize"):
+                return jsonify(result)
 
+        except queue.Full:
+            return jsonify({"error": "Server is busy, please retry shortly"}), 503
         except Exception as e:
             print(f"An error occurred: {e}")
             return jsonify({"error": "An internal error occurred during analysis"}), 500
-        finally:
-            # Clean up the uploaded file
-            if filepath and os.path.exists(filepath):
-                os.remove(filepath)
     else:
         return jsonify({"error": "File type not allowed"}), 400
 
+@app.route('/heatmaps/<study_id>/<disease>')
+def get_heatmap(study_id, disease):
+    """
+    Serves one heatmap as png/jpeg/webp (with ?quality=) or as the raw float16 CAM (?format=cam).
+    Any class can be requested; its Grad-CAM is computed on first request from the stored activations.
+    """
+    fmt, quality, error = parse_heatmap_format()
+    if error:
+        return error
+
+    encoded = heatmap_store.encode(study_id, disease, fmt=fmt, quality=quality)
+    if encoded is None:
+        return jsonify({"error": "Heatmap not found or expired"}), 404
+
+    data, mimetype = encoded
+    response = Response(data, mimetype=mimetype)
+    response.headers['Cache-Control'] = f'private, max-age={HEATMAP_TTL_SECONDS}'
+    if fmt == 'cam':
+        response.headers['X-CAM-Shape'] = ','.join(str(d) for d in heatmap_store.cam_shape(study_id, disease))
+        response.headers['X-CAM-Dtype'] = 'float16'
+    return response
+
+@app.route('/studies/<study_id>/gradcam')
+def stream_gradcams(study_id):
+    """
+    Streams the Grad-CAMs of a study as NDJSON, one {"disease", "mimetype", "data"} line per class
+    (base64 data), in the order asked for with ?diseases=A,B (default: every class).
+    All requested CAMs are computed together; each overlay is sent as soon as it is encoded.
+    """
+    fmt, quality, error = parse_heatmap_format()
+    if error:
+        return error
+    diseases = [d for d in request.args.get('diseases', '').split(',') if d] or CLASSES
+    unknown = [d for d in diseases if d not in CLASSES]
+    if unknown:
+        return jsonify({"error": f"Unknown diseases: {', '.join(unknown)}"}), 400
+    if heatmap_store.compute(study_id, diseases) is None:
+        return jsonify({"error": "Study not found or expired"}), 404
+
+    def generate():
+        for disease in diseases:
+            encoded = heatmap_store.encode(study_id, disease, fmt=fmt, quality=quality)
+            if encoded is None: # Expired while streaming
+                yield json.dumps({"disease": disease, "error": "Study not found or expired"}) + "\n"
+                return
+            data, mimetype = encoded
+            line = {"disease": disease, "mimetype": mimetype, "data": base64.b64encode(data).decode()}
+            if fmt == 'cam':
+                line["shape"] = list(heatmap_store.cam_shape(study_id, disease))
+            yield json.dumps(line) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 # --- MAIN EXECUTION ---
 if __name__ == '__main__':
     print("--- Starting Flask server at http://127.0.0.1:5000 ---")
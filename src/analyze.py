@@ -1,12 +1,14 @@
 import torch
 import cv2
 import numpy as np
-from PIL import Image
 import base64
+import uuid
 from io import BytesIO
 
 # Import your existing utilities
 from src.utils import preprocess_image
+from src.render import HeatmapRenderer, get_renderer
+from src.metrics import span
 
 CLASSES = [
     "Atelectasis", "Cardiomegaly", "Effusion", "Infiltration",
@@ -14,114 +16,381 @@ CLASSES = [
     "Consolidation", "Edema"
 ]
 
-def generate_gradcam(model, input_tensor, target_class, original_image_np):
-    """Generates a Grad-CAM heatmap and overlays it on the original image."""
+# Findings above this confidence (in %) are reported as detected and get a heatmap
+CONFIDENCE_THRESHOLD = 50
+
+def find_target_layer(model):
+    """Returns the last convolutional layer in densenet's features."""
+    for layer in reversed(list(model.features.modules())):
+        if isinstance(layer, torch.nn.Conv2d):
+            return layer
+    return None
+
+def forward_features(model, input_tensor):
+    """One forward pass without autograd. Returns the probabilities and the final feature map."""
     model.eval()
+    with span("forward"), torch.no_grad():
+        features = model.features(input_tensor)
+        probs = torch.sigmoid(model.head(features))
+    return probs, features
+
+def _cams_from_graph(output, feature_map, target_classes):
+    """Grad-CAMs of `feature_map` (a leaf of the graph that produced `output`) for all target classes."""
+    # One batched backward: row k of grad_outputs selects the score of class k for every image
+    scores = output[:, target_classes]
+    num_targets = len(target_classes)
+    grad_outputs = torch.eye(num_targets, dtype=scores.dtype, device=scores.device)
+    grad_outputs = grad_outputs.unsqueeze(1).expand(num_targets, *scores.shape)
+    try:
+        grads, = torch.autograd.grad(scores, feature_map, grad_outputs=grad_outputs, is_grads_batched=True)
+    except RuntimeError:
+        # Fall back to one backward per class over the same retained graph
+        grads = torch.stack([
+            torch.autograd.grad(scores, feature_map, grad_outputs=grad_outputs[k], retain_graph=True)[0]
+            for k in range(num_targets)
+        ])
+
+    # grads: (targets, batch, channels, h, w) -> channel weights: (targets, batch, channels)
+    weights = grads.mean(dim=(3, 4))
+    return HeatmapRenderer.normalize(torch.einsum('kbc,bchw->bkhw', weights, feature_map.detach()))
+
+def gradcams_from_features(model, features, target_classes):
+    """
+    Grad-CAMs for the target classes from an already computed final feature map.
+    No DenseNet pass is needed: this is what lets explanations be computed later, from
+    activations kept after a forward-only request. Models with `cam_weights` (a linear head)
+    get the exact CAMs of the last dense layer's conv from one no-grad contraction with the
+    classifier weights; for other heads only model.head is differentiated, and the CAMs are
+    those of the final feature map.
+    Returns a (batch, targets, h, w) tensor normalized to [0, 1].
+    """
+    target_classes = list(target_classes)
+    if not target_classes:
+        return features.new_zeros((features.shape[0], 0) + features.shape[2:])
+    with span("gradcam"):
+        if hasattr(model, "cam_weights"):
+            with torch.no_grad():
+                weights = model.cam_weights(features, target_classes)
+                return HeatmapRenderer.normalize(torch.einsum('bkc,bchw->bkhw', weights, model.cam_activations(features)))
+        features = features.detach().requires_grad_(True)
+        with torch.enable_grad():
+            output = model.head(features)
+        return _cams_from_graph(output, features, target_classes)
+
+def generate_gradcams(model, input_tensor, target_classes, target_layer=None):
+    """
+    Runs a single forward pass and computes the Grad-CAMs for all target classes at once.
+    `target_classes` is a list of class indices, or a callable that receives the probabilities
+    of that forward pass and returns the indices (e.g. the classes above a threshold).
+    Models with a `head` get the CAMs of gradcams_from_features from the final feature map; pass
+    `target_layer` (or use a model without a `head`) to hook a layer instead, by default the last conv.
+    Returns the CAMs as a (batch, targets, h, w) tensor normalized to [0, 1], the probabilities
+    and the target class indices that were used.
+    """
+    model.eval()
+    if target_layer is None and hasattr(model, "head"):
+        probs, features = forward_features(model, input_tensor)
+        if callable(target_classes):
+            target_classes = target_classes(probs)
+        target_classes = list(target_classes)
+        return gradcams_from_features(model, features, target_classes), probs, target_classes
+
+    if target_layer is None:
+        target_layer = find_target_layer(model)
+    if target_layer is None:
+        return None, None, [] # Should not happen with DenseNet
+
     features = []
-    gradients = []
 
     def forward_hook(module, input, output):
+        # Cut the graph at the target layer: the backward pass then only runs through
+        # the layers after it, and no gradients are needed for the weights or the input.
+        output = output.detach().requires_grad_(True)
         features.append(output)
+        return output
 
-    def backward_hook(module, grad_in, grad_out):
-        gradients.append(grad_out[0])
+    handle = target_layer.register_forward_hook(forward_hook)
+    try:
+        with torch.enable_grad():
+            output = model(input_tensor.detach())
+    finally:
+        handle.remove()
 
-    # Find the last convolutional layer in densenet's features
-    last_conv_layer = None
-    for layer in reversed(list(model.features.modules())):
-        if isinstance(layer, torch.nn.Conv2d):
-            last_conv_layer = layer
-            break
-    
-    if not last_conv_layer:
-        return None # Should not happen with DenseNet
+    probs = torch.sigmoid(output.detach())
+    feature_map = features[0]
+    if callable(target_classes):
+        target_classes = target_classes(probs)
+    target_classes = list(target_classes)
+    if not target_classes:
+        return feature_map.new_zeros((feature_map.shape[0], 0) + feature_map.shape[2:]), probs, []
+    return _cams_from_graph(output, feature_map, target_classes), probs, target_classes
 
-    h1 = last_conv_layer.register_forward_hook(forward_hook)
-    h2 = last_conv_layer.register_full_backward_hook(backward_hook)
+def overlay_heatmaps(cams, original_image_np):
+    """
+    Resizes a (classes, h, w) stack of normalized CAMs to the original image, colorizes them and
+    superimposes each one. The result is a view into this thread's render buffers: encode or copy it
+    before rendering again.
+    """
+    return get_renderer().render(cams, original_image_np)
 
-    input_tensor.requires_grad_(True)
-    model.zero_grad()
-    output = model(input_tensor)
-    loss = output[0, target_class]
-    loss.backward()
+def overlay_heatmap(cam, original_image_np):
+    """Resizes a normalized CAM to the original image, colorizes it and superimposes it."""
+    return overlay_heatmaps(np.asarray(cam)[None], original_image_np)[0].copy()
 
-    feature_map = features[0][0].detach()
-    grads = gradients[0][0].detach()
+def generate_gradcam(model, input_tensor, target_class, original_image_np):
+    """Generates a Grad-CAM heatmap and overlays it on the original image."""
+    cams, _, _ = generate_gradcams(model, input_tensor, [target_class])
+    if cams is None:
+        return None
+    return overlay_heatmap(cams[0, 0].cpu().numpy(), original_image_np)
 
-    weights = torch.mean(grads, dim=[1, 2])
-    cam = torch.zeros(feature_map.shape[1:], dtype=torch.float32)
-    for i, w in enumerate(weights):
-        cam += w * feature_map[i, :, :]
+def detected_classes(pred):
+    """Returns the indices of the classes above the confidence threshold, most confident first."""
+    pred = pred[:len(CLASSES)]
+    detected = [i for i, prob in enumerate(pred) if round(float(prob) * 100) > CONFIDENCE_THRESHOLD]
+    return sorted(detected, key=lambda i: pred[i], reverse=True)
 
-    cam = torch.maximum(cam, torch.tensor(0.0))
-    cam = cam.cpu().numpy()
-    
-    if np.max(cam) > 0:
-        cam = cam / np.max(cam)
-    
-    h1.remove()
-    h2.remove()
-    
-    # Resize heatmap to match original image and apply colormap
-    heatmap = cv2.resize(cam, (original_image_np.shape[1], original_image_np.shape[0]))
-    heatmap = np.uint8(255 * heatmap)
-    heatmap = cv2.applyColorMap(heatmap, cv2.COLORMAP_JET)
-
-    # Superimpose the heatmap on the original image
-    # Ensure original image is in BGR format for OpenCV
-    if len(original_image_np.shape) == 2: # Grayscale
-        original_image_bgr = cv2.cvtColor(original_image_np, cv2.COLOR_GRAY2BGR)
-    else: # Already BGR/RGB
-        original_image_bgr = original_image_np
-
-    superimposed_img = cv2.addWeighted(original_image_bgr, 0.6, heatmap, 0.4, 0)
+def predict_features_batch(model, x_batch):
+    """
+    Forward-only pass over a batch of preprocessed images.
+    Returns, for every image, its class probabilities and its (1, channels, h, w) final feature map,
+    from which Grad-CAMs can be computed afterwards with cams_for_classes.
+    """
+    probs, features = forward_features(model, x_batch)
+    probs = probs.cpu().numpy()[:, :len(CLASSES)]
+    return [(pred, features[i:i + 1].clone()) for i, pred in enumerate(probs)]
+
+def cams_for_classes(model, features, class_indices):
+    """Returns a {class index: normalized CAM} dict for one image's (1, channels, h, w) feature map."""
+    class_indices = list(class_indices)
+    cams = gradcams_from_features(model, features, class_indices)[0].cpu().numpy()
+    return {c: cams[k] for k, c in enumerate(class_indices)}
+
+def disease_cams(model, features, diseases):
+    """cams_for_classes keyed by disease name, the `cam_fn` of a HeatmapStore."""
+    cams = cams_for_classes(model, features, [CLASSES.index(disease) for disease in diseases])
+    return {CLASSES[c]: cam for c, cam in cams.items()}
+
+def predict_batch(model, x_batch):
+    """
+    Runs one forward pass over a batch of preprocessed images.
+    Returns, for every image, its class probabilities and a {class index: CAM} dict
+    with the Grad-CAMs of its detected classes.
+    """
+    def batch_targets(probs):
+        # Union of the detected classes of every image in the batch
+        probs = probs.cpu().numpy()
+        return sorted(set(c for pred in probs for c in detected_classes(pred)))
+
+    cams, probs, target_classes = generate_gradcams(model, x_batch, batch_targets)
+    if probs is None:
+        return None
+
+    cams = cams.cpu().numpy()
+    probs = probs.cpu().numpy()[:, :len(CLASSES)]
+    results = []
+    for i, pred in enumerate(probs):
+        image_cams = {c: cams[i, target_classes.index(c)] for c in detected_classes(pred)}
+        results.append((pred, image_cams))
+    return results
+
+def _preprocess(image, preprocess_pool):
+    with span("preprocess"):
+        if preprocess_pool is not None:
+            return preprocess_pool.preprocess(image, block=False)
+        return preprocess_image(image)
+
+def _predictions_json(pred):
+    results = {label: float(prob) for label, prob in zip(CLASSES, pred)}
     
-    return superimposed_img
+    # Sort results by confidence
+    sorted_results = sorted(results.items(), key=lambda item: item[1], reverse=True)
+    return [{"name": label, "confidence": round(prob * 100)} for label, prob in sorted_results]
+
+def _forward(x_tensor, model, scheduler):
+    """Probabilities and feature map of one image, batched with concurrent requests when a scheduler is given."""
+    # Includes the wait for a batch; the batched pass itself is the "forward" stage
+    with span("inference"):
+        if scheduler is not None:
+            return scheduler.predict(x_tensor)
+        return predict_features_batch(model, x_tensor)[0]
+
+def _forward_views(x_tensor, model, scheduler, tta):
+    """
+    Scores all the views of one image (a TestTimeAugmentation) in one batched forward pass.
+    Returns the aggregated probabilities and the (views, channels, h, w) feature maps, identity view first.
+    """
+    x_views = tta.batch(x_tensor)
+    with span("inference"):
+        if scheduler is not None:
+            results = scheduler.predict_many(x_views)
+        else:
+            results = predict_features_batch(model, x_views)
+    preds, features = zip(*results)
+    return tta.aggregate_probs(np.stack(preds)), torch.cat(features)
+
+def _tta_cams(model, features, class_indices, tta, size):
+    """cams_for_classes for the views of a TestTimeAugmentation: averaged over the views with `tta.cams`, else the identity view's."""
+    class_indices = list(class_indices)
+    if not tta.cams or not class_indices:
+        return cams_for_classes(model, features[:1], class_indices)
+    cams = tta.aggregate_cams(gradcams_from_features(model, features, class_indices), *size).cpu().numpy()
+    return {c: cams[k] for k, c in enumerate(class_indices)}
 
-def get_predictions_for_api(image_path, model):
+def get_predictions_for_api(image, model, scheduler=None, cache=None, preprocess_pool=None, tta=None):
     """
     Runs model prediction and generates heatmaps for detected pathologies.
+    `image` is a path, raw bytes, a file-like object or a decoded RGB array; it is decoded once,
+    on the PreprocessPool when one is given.
+    When an InferenceScheduler is given the forward pass is batched with concurrent requests,
+    and when a ResultCache is given repeated images are answered from it.
+    With a TestTimeAugmentation, its views are scored together and their probabilities aggregated.
     Returns predictions and base64-encoded heatmap images.
     """
     # Preprocess for the model
-    x_tensor, _ = preprocess_image(image_path)
+    x_tensor, original_image_np = _preprocess(image, preprocess_pool)
     if x_tensor is None:
         return None, None
-        
-    # Get raw predictions
-    with torch.no_grad():
-        pred = torch.sigmoid(model(x_tensor))
-    
-    pred = pred.cpu().numpy()[0][:len(CLASSES)]
-    results = {label: float(prob) for label, prob in zip(CLASSES, pred)}
-    
-    # Sort results by confidence
-    sorted_results = sorted(results.items(), key=lambda item: item[1], reverse=True)
-    predictions_json = [{"name": label, "confidence": round(prob * 100)} for label, prob in sorted_results]
+
+    if cache is not None:
+        mode = "inline" if tta is None else f"inline/{tta.key()}"
+        cache_key = cache.make_key((x_tensor, original_image_np), CONFIDENCE_THRESHOLD, mode)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    # A single forward pass; the Grad-CAMs of the detected classes only differentiate the head
+    if tta is None:
+        pred, features = _forward(x_tensor, model, scheduler)
+        cams = cams_for_classes(model, features, detected_classes(pred))
+    else:
+        pred, features = _forward_views(x_tensor, model, scheduler, tta)
+        cams = _tta_cams(model, features, detected_classes(pred), tta, x_tensor.shape[-2:])
+    predictions_json = _predictions_json(pred)
     
     # --- HEATMAP GENERATION ---
     heatmaps_json = []
-    detected_diseases = [p for p in predictions_json if p['confidence'] > 50]
-
-    if detected_diseases:
-        # Load original image in a format OpenCV can use (NumPy array)
-        original_image = Image.open(image_path).convert('RGB').resize((224, 224))
-        original_image_np = np.array(original_image)
+    if cams:
+        # Reuse the decoded image in a format OpenCV can use (BGR)
         original_image_np = cv2.cvtColor(original_image_np, cv2.COLOR_RGB2BGR)
 
-        for disease in detected_diseases:
-            disease_name = disease['name']
-            target_class_index = CLASSES.index(disease_name)
-            
-            # Generate the superimposed heatmap image
-            superimposed_img = generate_gradcam(model, x_tensor, target_class_index, original_image_np)
+        # Render all the class overlays in one pass
+        superimposed_imgs = overlay_heatmaps(np.stack(list(cams.values())), original_image_np)
+        for target_class_index, superimposed_img in zip(cams, superimposed_imgs):
+            disease_name = CLASSES[target_class_index]
             
-            if superimposed_img is not None:
-                # Convert the image to a base64 string
+            # Convert the image to a base64 string
+            with span("encode"):
                 is_success, buffer = cv2.imencode(".png", superimposed_img)
                 if is_success:
                     img_bytes = BytesIO(buffer)
                     base64_string = base64.b64encode(img_bytes.read()).decode()
                     heatmaps_json.append({"disease": disease_name, "image": base64_string})
 
-    return predictions_json, heatmaps_json
\ No newline at end of file
+    if cache is not None:
+        cache.put(cache_key, predictions_json, heatmaps_json)
+    return predictions_json, heatmaps_json
+
+def analyze_study(image, model, heatmap_store, scheduler=None, cache=None, preprocess_pool=None, tta=None):
+    """
+    Forward-only analysis: returns {"study_id", "predictions", "heatmaps"} as soon as the
+    probabilities are known. The feature map is kept in the HeatmapStore under the study id,
+    and each heatmap URL (for any class, detected or not) computes its Grad-CAM on first request.
+    With a TestTimeAugmentation the probabilities are aggregated over its views; the heatmaps
+    are those of the identity view, so one with `cams` set raises ValueError.
+    Returns None if the image can't be processed.
+    """
+    if tta is not None and tta.cams:
+        raise ValueError("TTA CAMs are only computed for inline heatmaps")
+    x_tensor, original_image_np = _preprocess(image, preprocess_pool)
+    if x_tensor is None:
+        return None
+
+    # Every analysis gets a random study id: the content key is never exposed, and repeated uploads don't share ids
+    study_id = uuid.uuid4().hex
+    cache_key = None
+    if cache is not None:
+        # v2: the entries hold disease names rather than URLs with the study id
+        mode = "lazy-v2" if tta is None else f"lazy-v2/{tta.key()}"
+        cache_key = cache.make_key((x_tensor, original_image_np), CONFIDENCE_THRESHOLD, mode)
+        cached = cache.get(cache_key)
+        # A cached result is only usable while the store still holds its study, under the new id too
+        if cached is not None and heatmap_store.alias(cache_key, study_id):
+            predictions_json, diseases = cached
+            heatmaps_json = [{"disease": d, "url": heatmap_store.url(study_id, d)} for d in diseases]
+            return {"study_id": study_id, "predictions": predictions_json, "heatmaps": heatmaps_json}
+
+    if tta is None:
+        pred, features = _forward(x_tensor, model, scheduler)
+    else:
+        pred, features = _forward_views(x_tensor, model, scheduler, tta)
+        features = features[:1].clone()
+    predictions_json = _predictions_json(pred)
+
+    heatmap_store.put(study_id, cv2.cvtColor(original_image_np, cv2.COLOR_RGB2BGR), features=features, key=cache_key)
+    heatmaps_json = []
+    for target_class_index in detected_classes(pred):
+        disease_name = CLASSES[target_class_index]
+        heatmaps_json.append({"disease": disease_name, "url": heatmap_store.url(study_id, disease_name)})
+
+    if cache is not None:
+        # The URLs hold this study's id, so only the diseases are cached
+        cache.put(cache_key, predictions_json, [heatmap["disease"] for heatmap in heatmaps_json])
+    return {"study_id": study_id, "predictions": predictions_json, "heatmaps": heatmaps_json}
+# --- STREAMLIT APP ---
+
+def get_predictions(image, model):
+    """
+    One forward pass over an image (path, bytes, file-like object or decoded array).
+    Returns ({class: probability}, the resized RGB image, the final feature map), or (None, None, None)
+    if the image can't be read. The feature map gives create_heatmap_figs its CAMs without another pass.
+    """
+    x_tensor, original_image_np = preprocess_image(image)
+    if x_tensor is None:
+        return None, None, None
+    pred, features = predict_features_batch(model, x_tensor)[0]
+    return {label: float(prob) for label, prob in zip(CLASSES, pred)}, original_image_np, features
+
+def detected_diseases(results):
+    """get_predictions' {class: probability} reduced to the findings, by /analyze's rule (detected_classes)."""
+    return {CLASSES[i]: results[CLASSES[i]] for i in detected_classes([results[c] for c in CLASSES])}
+
+def create_probability_fig(results, title=None):
+    """A Vega-Lite bar chart of the class probabilities (for st.vega_lite_chart), most confident first."""
+    values = [
+        {"pathology": label, "confidence": round(prob * 100, 1), "detected": round(prob * 100) > CONFIDENCE_THRESHOLD}
+        for label, prob in sorted(results.items(), key=lambda item: item[1], reverse=True)
+    ]
+    spec = {
+        "data": {"values": values},
+        "mark": {"type": "bar", "cornerRadiusEnd": 3},
+        "encoding": {
+            "y": {"field": "pathology", "type": "nominal", "sort": None, "title": None},
+            "x": {"field": "confidence", "type": "quantitative", "title": "Confidence (%)", "scale": {"domain": [0, 100]}},
+            "color": {
+                "field": "detected", "type": "nominal", "legend": None,
+                "scale": {"domain": [False, True], "range": ["#3498DB", "#E74C3C"]},
+            },
+            "tooltip": [{"field": "pathology"}, {"field": "confidence", "title": "Confidence (%)"}],
+        },
+    }
+    if title:
+        spec["title"] = title
+    return spec
+
+def create_heatmap_figs(diseases, features, model, original_image_np):
+    """
+    Grad-CAM overlays for the given diseases from get_predictions' feature map and resized image.
+    Returns {disease: PNG bytes}, ready for st.image and cheap to cache.
+    """
+    diseases = list(diseases)
+    if not diseases:
+        return {}
+    cams = disease_cams(model, features, diseases)
+    overlays = overlay_heatmaps(np.stack([cams[d] for d in diseases]), cv2.cvtColor(original_image_np, cv2.COLOR_RGB2BGR))
+    figs = {}
+    for disease, overlay in zip(diseases, overlays):
+        is_success, buffer = cv2.imencode(".png", overlay)
+        if is_success:
+            figs[disease] = buffer.tobytes()
+    return figs
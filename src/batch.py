@@ -0,0 +1,257 @@
+"""
+Batch scoring of whole directories (or file lists) of radiographs.
+
+    python -m src.batch data/ -o results.jsonl
+    python -m src.batch files.txt -o results.csv --workers 8 --batch-size 32
+    python -m src.batch archive/ -o results.parquet --gradcam --heatmaps-dir heatmaps/
+
+Images are decoded and preprocessed by a pool of workers and scored in batches on the CPU.
+Results are written incrementally; a `<output>.checkpoint` file lists the images already
+scored, so rerunning the same command resumes where an interrupted run stopped.
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from src.analyze import CLASSES, detected_classes, overlay_heatmaps, predict_batch
+from src.model import load_model
+from src.preprocess import PreprocessPool
+
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg'}
+
+# --- INPUT ---
+
+def iter_image_paths(source):
+    """Yields image paths from a directory (recursively, in sorted order) or a text file with one path per line."""
+    if os.path.isdir(source):
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            for name in sorted(files):
+                if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                    yield os.path.join(root, name)
+    else:
+        with open(source) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    yield line
+
+# --- OUTPUT ---
+
+class ResultWriter:
+    """
+    Appends result rows to a JSONL, CSV or Parquet output, one flush per batch. Every write is on
+    disk when it returns, so the checkpoint can mark its rows done: JSONL and CSV are fsynced, and
+    each Parquet write is a complete part file of its own.
+    """
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.format = os.path.splitext(output_path)[1].lower().lstrip('.')
+        self.columns = ["path"] + CLASSES + ["detected", "heatmaps", "error"]
+        self._file = None
+        self._csv = None
+
+        if self.format == 'jsonl':
+            self._file = open(output_path, 'a')
+        elif self.format == 'csv':
+            write_header = not os.path.exists(output_path) or os.path.getsize(output_path) == 0
+            self._file = open(output_path, 'a', newline='')
+            self._csv = csv.DictWriter(self._file, fieldnames=self.columns)
+            if write_header:
+                self._csv.writeheader()
+        elif self.format == 'parquet':
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                raise SystemExit("❌ Parquet output needs pyarrow: pip install pyarrow")
+            # A Parquet file can't be appended to, and is only readable once closed: the output is a
+            # dataset directory with one part per write
+            os.makedirs(output_path, exist_ok=True)
+            self._part = len([name for name in os.listdir(output_path) if name.endswith('.parquet')])
+            self._pa, self._pq = pyarrow, pyarrow.parquet
+        else:
+            raise SystemExit(f"❌ Unsupported output format '{self.format}' (use .jsonl, .csv or .parquet)")
+
+    def write(self, rows):
+        if not rows:
+            return
+        if self.format == 'jsonl':
+            self._file.write(''.join(json.dumps(row) + '\n' for row in rows))
+        elif self.format == 'csv':
+            for row in rows:
+                self._csv.writerow(dict(row, detected=';'.join(row['detected']), heatmaps=';'.join(row['heatmaps'])))
+        else:
+            self._write_part(self._pa.Table.from_pylist(rows, schema=self._schema()))
+        if self._file is not None:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def _write_part(self, table):
+        part_path = os.path.join(self.output_path, f"part-{self._part:05d}.parquet")
+        tmp_path = part_path + '.tmp' # Not a .parquet file: readers never see a partial part
+        self._pq.write_table(table, tmp_path)
+        with open(tmp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, part_path)
+        self._part += 1
+
+    def _schema(self):
+        pa = self._pa
+        return pa.schema(
+            [("path", pa.string())]
+            + [(name, pa.float64()) for name in CLASSES]
+            + [("detected", pa.list_(pa.string())), ("heatmaps", pa.list_(pa.string())), ("error", pa.string())]
+        )
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+class Checkpoint:
+    """Append-only list of the images already written to the output."""
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.done = {line.rstrip('\n') for line in f if line.strip()}
+        self._file = open(path, 'a')
+
+    def mark(self, paths):
+        self._file.write(''.join(path + '\n' for path in paths))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+# --- SCORING ---
+
+def heatmap_stem(path, source):
+    """
+    Unique name of an image's overlays, without the class suffix. Images of a directory keep their
+    path relative to it, so a/001.png and b/001.png don't overwrite each other; images of a file
+    list get their file name plus a short hash of the path as listed.
+    """
+    stem = os.path.splitext(path)[0]
+    if os.path.isdir(source):
+        return os.path.relpath(stem, source)
+    digest = hashlib.blake2b(path.encode(), digest_size=4).hexdigest()
+    return f"{os.path.basename(stem)}-{digest}"
+
+def save_heatmaps(path, cams, original_image_np, heatmaps_dir, source):
+    """Writes one overlay PNG per detected class and returns their paths."""
+    stem = os.path.join(heatmaps_dir, heatmap_stem(path, source))
+    os.makedirs(os.path.dirname(stem), exist_ok=True)
+    original_image_bgr = cv2.cvtColor(original_image_np, cv2.COLOR_RGB2BGR)
+    overlays = overlay_heatmaps(np.stack(list(cams.values())), original_image_bgr)
+    written = []
+    for class_index, overlay in zip(cams, overlays):
+        heatmap_path = f"{stem}_{CLASSES[class_index]}.png"
+        cv2.imwrite(heatmap_path, overlay)
+        written.append(heatmap_path)
+    return written
+
+def score_batch(model, batch, gradcam, heatmaps_dir, source):
+    """Runs one forward pass over the batch and returns its result rows."""
+    paths, tensors, images = zip(*batch)
+    x_batch = torch.cat(tensors)
+    if gradcam:
+        results = predict_batch(model, x_batch)
+    else:
+        with torch.no_grad():
+            probs = torch.sigmoid(model(x_batch)).cpu().numpy()[:, :len(CLASSES)]
+        results = [(pred, {}) for pred in probs]
+
+    rows = []
+    for path, image, (pred, cams) in zip(paths, images, results):
+        row = {"path": path}
+        row.update({label: round(float(prob), 6) for label, prob in zip(CLASSES, pred)})
+        row["detected"] = [CLASSES[i] for i in detected_classes(pred)]
+        row["heatmaps"] = save_heatmaps(path, cams, image, heatmaps_dir, source) if cams else []
+        row["error"] = None
+        rows.append(row)
+    return rows
+
+def error_row(path, error):
+    row = {"path": path}
+    row.update({label: None for label in CLASSES})
+    row.update({"detected": [], "heatmaps": [], "error": error})
+    return row
+
+def run(args):
+    torch.set_num_threads(args.threads or torch.get_num_threads())
+    model = load_model(require_features=args.gradcam)
+    os.makedirs(os.path.dirname(os.path.abspath(args.output.rstrip('/'))), exist_ok=True)
+    writer = ResultWriter(args.output)
+    checkpoint = Checkpoint(args.output.rstrip('/') + '.checkpoint')
+    heatmaps_dir = args.heatmaps_dir or os.path.splitext(args.output.rstrip('/'))[0] + '_heatmaps'
+    if checkpoint.done:
+        print(f"↩️ Resuming: {len(checkpoint.done)} images already scored")
+
+    paths = (path for path in iter_image_paths(args.source) if path not in checkpoint.done)
+    pool = PreprocessPool(workers=max(1, args.workers), use_processes=args.processes)
+    images = pool.map(paths)
+
+    start = time.perf_counter()
+    scored = errors = 0
+    last_report = start
+
+    def flush(batch, failed):
+        rows = score_batch(model, batch, args.gradcam, heatmaps_dir, args.source) if batch else []
+        rows += failed
+        writer.write(rows)
+        checkpoint.mark([row["path"] for row in rows])
+        return len(rows)
+
+    try:
+        batch, failed = [], []
+        for path, x_tensor, image, error in images:
+            if error:
+                failed.append(error_row(path, error))
+                errors += 1
+            else:
+                batch.append((path, x_tensor, image))
+            if len(batch) + len(failed) >= args.batch_size:
+                scored += flush(batch, failed)
+                batch, failed = [], []
+
+            now = time.perf_counter()
+            if now - last_report >= args.report_every:
+                print(f"  {scored} images, {scored / (now - start):.1f} images/s")
+                last_report = now
+        scored += flush(batch, failed)
+    finally:
+        pool.close()
+        writer.close()
+        checkpoint.close()
+
+    elapsed = time.perf_counter() - start
+    rate = scored / elapsed if elapsed > 0 else 0.0
+    print(f"✅ Scored {scored} images ({errors} errors) in {elapsed:.1f}s: {rate:.1f} images/s")
+    print(f"   Results: {args.output}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Score a directory or file list of chest radiographs.")
+    parser.add_argument("source", help="Directory of images, or a text file with one image path per line")
+    parser.add_argument("-o", "--output", required=True, help="Output file: .jsonl, .csv or .parquet")
+    parser.add_argument("--batch-size", type=int, default=16, help="Images per forward pass (default: 16)")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="Decode/preprocess workers (default: half the cores)")
+    parser.add_argument("--processes", action="store_true", help="Decode in worker processes instead of threads")
+    parser.add_argument("--threads", type=int, default=0, help="torch intra-op threads for the model (default: torch's)")
+    parser.add_argument("--gradcam", action="store_true", help="Write Grad-CAM overlays for detected findings")
+    parser.add_argument("--heatmaps-dir", help="Where to write the overlays (default: <output>_heatmaps/)")
+    parser.add_argument("--report-every", type=float, default=10.0, help="Seconds between progress lines")
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    run(parse_args())
@@ -0,0 +1,244 @@
+"""
+Latency and throughput benchmark of the analysis pipeline.
+
+    python -m src.bench -o bench.json
+    python -m src.bench --batch-sizes 1,8 --threads 1,4 --baseline bench-baseline.json --max-regression 0.15
+
+The images are the ones in data/, chest_xray.png and synthetic images at several resolutions
+(--sizes), each encoded as PNG and JPEG. Every stage is timed on its own:
+
+    decode      bytes -> RGB image (load_image, with the JPEG draft reduction), per image
+    transform   resize + normalization to the model input (transform_image), per image
+    forward     one forward pass, per thread count and batch size
+    gradcam     the Grad-CAM of one class from a batch's feature map, per thread count and batch size
+    encode      overlay + PNG + base64 of one heatmap
+    analyze     POST /analyze through the Flask test client, lazy, ?heatmaps=inline and inline with 4 TTA views
+
+For each one the report gives the p50/p95/p99 latency in ms, the images per second and the peak
+RSS of the process so far. With --baseline, the p50 of every stage is compared against a previous
+report and the run exits with status 1 if any of them regressed by more than --max-regression.
+"""
+import argparse
+import base64
+import json
+import os
+import platform
+import resource
+import sys
+import time
+from io import BytesIO
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+
+from src.analyze import CLASSES, forward_features, gradcams_from_features, overlay_heatmaps
+from src.model import load_model
+from src.utils import INPUT_SIZE, load_image, transform_image
+
+BUNDLED_IMAGES = ["data", "chest_xray.png"]
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg'}
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def summarize(seconds, items=1):
+    """Latency percentiles (ms) of a list of timings, and the throughput when each timing covers `items` images."""
+    ms = np.asarray(seconds) * 1000
+    return {
+        "p50_ms": round(float(np.percentile(ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(ms, 99)), 3),
+        "images_per_second": round(items * len(ms) / (ms.sum() / 1000), 2),
+        "samples": len(ms),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def measure(fn, repeats, items=1, warmup=1):
+    """Times `repeats` calls of `fn(i)` after `warmup` untimed ones."""
+    for i in range(warmup):
+        fn(i)
+    seconds = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        fn(i)
+        seconds.append(time.perf_counter() - start)
+    return summarize(seconds, items)
+
+def synthetic_image(size, seed=0):
+    """A smooth, radiograph-like grayscale image (two dark lung fields on a bright body) with a little noise."""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size] / size
+    lungs = np.exp(-(((x - 0.32) / 0.14) ** 2 + ((y - 0.5) / 0.28) ** 2))
+    lungs += np.exp(-(((x - 0.68) / 0.14) ** 2 + ((y - 0.5) / 0.28) ** 2))
+    image = 200 - 140 * lungs + rng.normal(0, 6, (size, size))
+    return Image.fromarray(np.clip(image, 0, 255).astype(np.uint8)).convert("RGB")
+
+def encode_image(image, fmt):
+    buffer = BytesIO()
+    image.save(buffer, format=fmt)
+    return buffer.getvalue()
+
+def load_benchmark_images(sizes):
+    """Returns {label: encoded bytes} for the bundled images and the synthetic ones."""
+    images = {}
+    for source in BUNDLED_IMAGES:
+        if os.path.isdir(source):
+            paths = [os.path.join(source, name) for name in sorted(os.listdir(source))]
+        else:
+            paths = [source] if os.path.isfile(source) else []
+        for path in paths:
+            if os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS:
+                with open(path, 'rb') as f:
+                    images[os.path.basename(path)] = f.read()
+    for size in sizes:
+        image = synthetic_image(size)
+        images[f"synthetic-{size}.png"] = encode_image(image, "PNG")
+        images[f"synthetic-{size}.jpg"] = encode_image(image, "JPEG")
+    return images
+
+def bench_preprocessing(images, repeats):
+    results = {}
+    for label, data in images.items():
+        results[f"decode/{label}"] = measure(lambda i: load_image(data, draft_size=(INPUT_SIZE, INPUT_SIZE)), repeats)
+        decoded = load_image(data, draft_size=(INPUT_SIZE, INPUT_SIZE))
+        results[f"transform/{label}"] = measure(lambda i: transform_image(decoded), repeats)
+    return results
+
+def bench_model(model, tensors, batch_sizes, thread_counts, repeats):
+    results = {}
+    for threads in thread_counts:
+        torch.set_num_threads(threads)
+        for batch_size in batch_sizes:
+            batch = torch.cat([tensors[i % len(tensors)] for i in range(batch_size)])
+            key = f"bs={batch_size}/threads={threads}"
+            results[f"forward/{key}"] = measure(lambda i: forward_features(model, batch), repeats, items=batch_size)
+            _, features = forward_features(model, batch)
+            results[f"gradcam/{key}"] = measure(
+                lambda i: gradcams_from_features(model, features, [i % len(CLASSES)]), repeats, items=batch_size
+            )
+    return results
+
+def bench_encode(model, x_tensor, original_image_np, repeats):
+    _, features = forward_features(model, x_tensor)
+    cams = gradcams_from_features(model, features, list(range(len(CLASSES))))[0].numpy()
+    image_bgr = cv2.cvtColor(original_image_np, cv2.COLOR_RGB2BGR)
+
+    def encode(i):
+        overlay = overlay_heatmaps(cams[i % len(CLASSES)][None], image_bgr)[0]
+        _, buffer = cv2.imencode(".png", overlay)
+        base64.b64encode(buffer).decode()
+
+    return {"encode": measure(encode, repeats)}
+
+def bench_server(images, repeats, threads):
+    """Full /analyze requests through the Flask test client. The server loads its own model from its env configuration."""
+    torch.set_num_threads(threads)
+    import main
+    main.result_cache = None # Every request must run the pipeline
+    client = main.app.test_client()
+    uploads = [(label, data) for label, data in images.items() if not label.startswith("synthetic")] or list(images.items())
+
+    def post(query):
+        def request(i):
+            label, data = uploads[i % len(uploads)]
+            response = client.post(f'/analyze{query}', data={'file': (BytesIO(data), label)})
+            if response.status_code != 200:
+                raise RuntimeError(f"/analyze{query} answered {response.status_code} for {label}")
+        return request
+
+    return {
+        f"analyze/lazy/threads={threads}": measure(post(""), repeats),
+        f"analyze/inline/threads={threads}": measure(post("?heatmaps=inline"), repeats),
+        f"analyze/inline-tta=4/threads={threads}": measure(post("?heatmaps=inline&tta=4"), repeats),
+    }
+
+def compare(results, baseline, max_regression, metric="p50_ms"):
+    """Prints the change of `metric` per stage against a baseline report. Returns the stages that regressed too much."""
+    regressions = []
+    print(f"{'stage':<44}{'baseline':>10}{'current':>10}{'change':>9}")
+    for key, row in results.items():
+        base = baseline["results"].get(key)
+        if base is None or not base[metric]:
+            continue
+        change = row[metric] / base[metric] - 1
+        flag = ""
+        if change > max_regression:
+            regressions.append(key)
+            flag = "  ❌"
+        print(f"{key:<44}{base[metric]:>10.2f}{row[metric]:>10.2f}{change:>+9.1%}{flag}")
+    return regressions
+
+def run(args):
+    batch_sizes = [int(b) for b in args.batch_sizes.split(',') if b.strip()]
+    thread_counts = [int(t) for t in args.threads.split(',') if t.strip()]
+    sizes = [int(s) for s in args.sizes.split(',') if s.strip()]
+
+    images = load_benchmark_images(sizes)
+    print(f"🖼️ {len(images)} benchmark images")
+    model = load_model(precision=args.precision, calibration_dir=args.calibration_dir)
+    preprocessed = [transform_image(load_image(data, draft_size=(INPUT_SIZE, INPUT_SIZE))) for data in images.values()]
+    tensors = [x_tensor for x_tensor, _ in preprocessed]
+
+    results = {}
+    results.update(bench_preprocessing(images, args.repeats))
+    results.update(bench_model(model, tensors, batch_sizes, thread_counts, args.repeats))
+    results.update(bench_encode(model, *preprocessed[0], args.repeats))
+    if not args.no_server:
+        results.update(bench_server(images, args.server_repeats, max(thread_counts)))
+
+    print(f"{'stage':<44}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'img/s':>9}{'RSS MB':>9}")
+    for key, row in results.items():
+        print(f"{key:<44}{row['p50_ms']:>9.2f}{row['p95_ms']:>9.2f}{row['p99_ms']:>9.2f}"
+              f"{row['images_per_second']:>9.1f}{row['peak_rss_mb']:>9.0f}")
+
+    report = {
+        "meta": {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "precision": args.precision,
+            "torch": torch.__version__,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "repeats": args.repeats,
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"   Report: {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for field in ("torch", "machine", "cpu_count", "precision"):
+            if baseline["meta"].get(field) != report["meta"][field]:
+                print(f"⚠️ Baseline {field} differs: {baseline['meta'].get(field)} vs {report['meta'][field]}")
+        regressions = compare(results, baseline, args.max_regression)
+        if regressions:
+            print(f"❌ {len(regressions)} stages are more than {args.max_regression:.0%} slower than the baseline")
+            raise SystemExit(1)
+        print(f"✅ No stage is more than {args.max_regression:.0%} slower than the baseline")
+    return report
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the stages of the analysis pipeline.")
+    parser.add_argument("--batch-sizes", default="1,4,8", help="Comma-separated batch sizes for forward/gradcam (default: 1,4,8)")
+    parser.add_argument("--threads", default=str(torch.get_num_threads()), help="Comma-separated torch thread counts (default: torch's)")
+    parser.add_argument("--sizes", default="512,1024,2048", help="Sides of the synthetic images (default: 512,1024,2048)")
+    parser.add_argument("--repeats", type=int, default=20, help="Timed runs per stage (default: 20)")
+    parser.add_argument("--server-repeats", type=int, default=10, help="Timed /analyze requests per mode (default: 10)")
+    parser.add_argument("--precision", default="fp32", help="Precision mode of the benchmarked model (see src.precision)")
+    parser.add_argument("--calibration-dir", help="Calibration images for int8")
+    parser.add_argument("--no-server", action="store_true", help="Skip the /analyze stage")
+    parser.add_argument("--baseline", help="Previous report to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.15, help="Largest acceptable p50 slowdown (default: 0.15)")
+    parser.add_argument("-o", "--output", help="Write the report as JSON")
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    run(parse_args())
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+class ResultCache:
+    """
+    Content-addressed cache for /analyze results (predictions + encoded heatmaps, or the diseases of lazy ones).
+    Entries live in a bounded in-memory LRU, evicted by size, and optionally in an
+    on-disk tier (one JSON file per key) that survives restarts.
+    """
+    def __init__(self, model_version, max_bytes=256 * 1024 * 1024, disk_dir=None):
+        self.model_version = model_version
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self._entries = OrderedDict() # key -> (predictions, heatmaps, size in bytes)
+        self._lock = threading.Lock()
+        self.bytes_held = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def make_key(self, pixels, *params):
+        """
+        Hashes the decoded pixel content (any number of arrays/tensors) with the model version
+        and the parameters that change the result (threshold, response format, ...).
+        """
+        h = hashlib.blake2b(digest_size=20)
+        for array in pixels:
+            array = array.numpy() if hasattr(array, "numpy") else array
+            h.update(str(array.shape).encode())
+            h.update(array.tobytes())
+        h.update("|".join(str(param) for param in (self.model_version,) + params).encode())
+        return h.hexdigest()
+
+    def get(self, key):
+        """Returns (predictions, heatmaps) for the key, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0], entry[1]
+
+        entry = self._read_disk(key)
+        if entry is None:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        predictions, heatmaps, size = entry
+        with self._lock:
+            self.disk_hits += 1
+            self._insert(key, predictions, heatmaps, size)
+        return predictions, heatmaps
+
+    def put(self, key, predictions, heatmaps):
+        payload = json.dumps({"predictions": predictions, "heatmaps": heatmaps}).encode()
+        with self._lock:
+            self._insert(key, predictions, heatmaps, len(payload))
+        self._write_disk(key, payload)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes_held": self.bytes_held,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+            }
+
+    def _insert(self, key, predictions, heatmaps, size):
+        # Caller holds the lock
+        if size > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.bytes_held -= old[2]
+        self._entries[key] = (predictions, heatmaps, size)
+        self.bytes_held += size
+        while self.bytes_held > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.bytes_held -= evicted[2]
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        try:
+            with open(self._disk_path(key), "rb") as f:
+                payload = f.read()
+            data = json.loads(payload)
+        except (FileNotFoundError, ValueError):
+            return None
+        return data["predictions"], data["heatmaps"], len(payload)
+
+    def _write_disk(self, key, payload):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(payload)
+            os.replace(tmp_path, path) # Atomic, so readers never see a partial file
+        except OSError as e:
+            print(f"⚠️ Could not write cache entry to disk: {e}")
@@ -0,0 +1,52 @@
+"""
+Exports the classifier as a frozen inference graph that load_model prefers over the eager model.
+
+    python -m src.export -o models/densenet121.pt2
+    python -m src.export -o models/densenet121-aoti.pt2 --format aoti --precision bf16
+    python -m src.export -o models/densenet121-int8.ts --format torchscript --precision int8 --calibration-dir calibration/
+
+The artifact returns the logits and the final feature map, so the forward-only path and the
+Grad-CAMs computed from stored feature maps both run on it. --no-features exports the logits only:
+it is inference-only, used by batch scoring without --gradcam; load_model ignores it everywhere
+else. Its metadata is written to `<output>.json`.
+Serve it with MODEL_ARTIFACT=<output> (and the same MODEL_PRECISION).
+"""
+import argparse
+import time
+
+import torch
+
+from src.model import ARTIFACT_FORMATS, MODEL_VERSION, export_artifact, load_model
+from src.precision import PRECISION_MODES
+
+def run(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if args.format != "torchscript" and args.precision == "int8":
+        raise SystemExit("❌ torch.export can't serialize the int8 model; use --format torchscript")
+    model = load_model(precision=args.precision, calibration_dir=args.calibration_dir, artifact_path=None)
+
+    print(f"📦 Exporting {MODEL_VERSION} ({args.precision}) as {args.format}...")
+    start = time.perf_counter()
+    export_artifact(
+        model, args.output,
+        fmt=args.format,
+        precision=args.precision,
+        with_features=not args.no_features,
+        max_batch_size=args.max_batch_size
+    )
+    print(f"✅ Exported and checked in {time.perf_counter() - start:.1f}s: {args.output}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Export the classifier as a compiled inference artifact.")
+    parser.add_argument("-o", "--output", required=True, help="Artifact path (.pt2 for export/aoti, .ts for torchscript)")
+    parser.add_argument("--format", choices=ARTIFACT_FORMATS, default="export", help="Artifact format (default: export)")
+    parser.add_argument("--precision", choices=PRECISION_MODES, default="fp32", help="Precision mode to export (default: fp32)")
+    parser.add_argument("--calibration-dir", help="Calibration images for int8")
+    parser.add_argument("--no-features", action="store_true", help="Export the logits only, without the feature map (inference-only: batch scoring without --gradcam)")
+    parser.add_argument("--max-batch-size", type=int, default=64, help="Largest batch the export/aoti artifact accepts")
+    parser.add_argument("--threads", type=int, default=0, help="torch intra-op threads (default: torch's)")
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    run(parse_args())
@@ -0,0 +1,302 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+import torch
+
+from src.metrics import span
+from src.render import get_renderer
+
+# format -> (file extension for cv2.imencode, mimetype, quality flag)
+IMAGE_FORMATS = {
+    "png": (".png", "image/png", None),
+    "jpeg": (".jpg", "image/jpeg", cv2.IMWRITE_JPEG_QUALITY),
+    "webp": (".webp", "image/webp", cv2.IMWRITE_WEBP_QUALITY),
+}
+
+# Study ids are uuids and keys hex digests; anything else is never looked up on disk
+STUDY_ID_PATTERN = re.compile(r"[0-9a-f]{8,64}")
+
+class _Study:
+    """What is kept for one study: the resized BGR image, the final feature map and what was derived from it."""
+    __slots__ = ("key", "study_ids", "expires_at", "image_bgr", "features", "cams", "encoded", "nbytes", "lock")
+
+    def __init__(self, key, expires_at, image_bgr, features):
+        self.key = key # the content key it can be reused under, or its own study id
+        self.study_ids = set() # the ids it is held under; counted towards the cap while there is one
+        self.expires_at = expires_at
+        self.image_bgr = image_bgr
+        self.features = features
+        self.cams = {} # disease -> normalized (h, w) CAM
+        self.encoded = {} # (disease, format, quality) -> (bytes, mimetype)
+        self.nbytes = image_bgr.nbytes + features.element_size() * features.nelement()
+        self.lock = threading.Lock()
+
+class HeatmapStore:
+    """
+    Short-lived in-memory store behind the /heatmaps/<study_id>/<disease> URLs.
+    It keeps the activations of an analysis (the resized BGR image and the final feature map),
+    and computes a class's Grad-CAM with `cam_fn(features, diseases)` only when a client asks for
+    it, then encodes the overlay in the format and quality it asks for. Any of `diseases` can be
+    requested, detected or not. Studies expire after `ttl_seconds`; beyond `max_bytes` of
+    retained data the least recently used ones are dropped.
+    Study ids are random tokens handed to clients. A study stored with a `key` (the image's cache
+    key) can be handed out again under a new id with `alias`, sharing its activations and CAMs;
+    the key itself is never part of a URL.
+    With `shared_dir` (ideally on tmpfs), the activations are also written there, so that several
+    server processes can answer for each other's studies.
+    """
+    def __init__(self, cam_fn, diseases, ttl_seconds=300, max_bytes=256 * 1024 * 1024, url_prefix="/heatmaps",
+                 shared_dir=None):
+        self.cam_fn = cam_fn
+        self.diseases = list(diseases)
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.url_prefix = url_prefix
+        self.shared_dir = shared_dir
+        self._studies = OrderedDict() # study_id -> _Study, several ids can share one
+        self._keys = {} # key -> _Study
+        self._bytes_held = 0
+        self._lock = threading.Lock()
+        self._last_sweep = time.time()
+        self.cams_computed = 0
+        self.shared_loads = 0
+        if shared_dir:
+            os.makedirs(shared_dir, exist_ok=True)
+
+    def url(self, study_id, disease):
+        return f"{self.url_prefix}/{study_id}/{disease}"
+
+    def put(self, study_id, image_bgr, features, key=None):
+        """
+        Stores a study's resized BGR image and its (1, channels, h, w) final feature map under
+        `study_id`. With `key`, `alias` can later hand out the same study under other ids.
+        """
+        study = _Study(key or study_id, time.monotonic() + self.ttl_seconds, image_bgr, features.detach())
+        with self._lock:
+            if study_id in self._studies:
+                self._drop(study_id)
+            # Replaces an older study of the same key for `alias`; the ids already handed out keep theirs
+            self._add(study_id, study)
+            self._evict()
+        if self.shared_dir:
+            self._write_shared(study, study_id)
+
+    def alias(self, key, study_id):
+        """
+        Makes the study stored under `key` available as `study_id` too, and restarts its TTL.
+        Returns False if there is no such study (never stored, expired or evicted).
+        """
+        with self._lock:
+            study = self._keys.get(key)
+            if study is not None and study.expires_at < time.monotonic():
+                for old_id in list(study.study_ids):
+                    self._drop(old_id)
+                study = None
+        loaded = study is None and self.shared_dir
+        if loaded:
+            study = self._read_shared(key, key=key)
+        if study is None:
+            return False
+
+        with self._lock:
+            if loaded:
+                self.shared_loads += 1
+            study = self._keys.get(key, study)
+            study.expires_at = time.monotonic() + self.ttl_seconds
+            self._add(study_id, study)
+            self._evict()
+        if self.shared_dir:
+            self._link_shared(study, study_id)
+        return True
+
+    def contains(self, study_id):
+        return self._get(study_id) is not None
+
+    def compute(self, study_id, diseases):
+        """
+        Returns {disease: CAM} for the requested diseases, computing the missing ones in a single
+        `cam_fn` call. Returns None if the study is unknown or expired; unknown diseases are skipped.
+        """
+        study = self._get(study_id)
+        if study is None:
+            return None
+        diseases = [d for d in dict.fromkeys(diseases) if d in self.diseases]
+        with study.lock:
+            missing = [d for d in diseases if d not in study.cams]
+            if missing:
+                cams = self.cam_fn(study.features, missing)
+                for disease, cam in cams.items():
+                    study.cams[disease] = np.asarray(cam, dtype=np.float32)
+                self._grow(study, sum(cam.nbytes for cam in cams.values()))
+                self.cams_computed += len(missing)
+            return {d: study.cams[d] for d in diseases}
+
+    def encode(self, study_id, disease, fmt="png", quality=90):
+        """
+        Returns (bytes, mimetype) for one heatmap, or None if the study or disease is unknown.
+        `fmt` is png, jpeg or webp for the overlay image, or cam for the raw low-resolution
+        CAM as little-endian float16 (row-major, shape given by `cam_shape`).
+        """
+        cams = self.compute(study_id, [disease])
+        if not cams:
+            return None
+        study = self._get(study_id)
+        if study is None:
+            return None
+
+        key = (disease, fmt, quality)
+        with study.lock:
+            if key in study.encoded:
+                return study.encoded[key]
+
+        if fmt == "cam":
+            result = (cams[disease].astype("<f2").tobytes(), "application/octet-stream")
+        else:
+            ext, mimetype, quality_flag = IMAGE_FORMATS[fmt]
+            with span("encode"):
+                overlay = get_renderer().render(cams[disease][None], study.image_bgr)[0]
+                params = [quality_flag, int(quality)] if quality_flag is not None else []
+                is_success, buffer = cv2.imencode(ext, overlay, params)
+            if not is_success:
+                return None
+            result = (buffer.tobytes(), mimetype)
+
+        with study.lock:
+            if key not in study.encoded:
+                study.encoded[key] = result
+                self._grow(study, len(result[0]))
+        return result
+
+    def cam_shape(self, study_id, disease):
+        cams = self.compute(study_id, [disease])
+        if not cams:
+            return None
+        return cams[disease].shape
+
+    def stats(self):
+        with self._lock:
+            self._evict()
+            return {
+                "studies": len(self._studies),
+                "bytes_held": self._bytes_held,
+                "max_bytes": self.max_bytes,
+                "cams_computed": self.cams_computed,
+                "shared_loads": self.shared_loads,
+            }
+
+    def _get(self, study_id):
+        with self._lock:
+            study = self._studies.get(study_id)
+            if study is not None and study.expires_at < time.monotonic():
+                self._drop(study_id)
+                study = None
+            if study is not None:
+                self._studies.move_to_end(study_id)
+                return study
+        if not self.shared_dir:
+            return None
+
+        study = self._read_shared(study_id)
+        if study is None:
+            return None
+        with self._lock:
+            # Another request may have loaded it meanwhile
+            if study_id in self._studies:
+                return self._studies[study_id]
+            self._add(study_id, study)
+            self.shared_loads += 1
+            self._evict()
+        return study
+
+    def _grow(self, study, nbytes):
+        with self._lock:
+            study.nbytes += nbytes
+            # A study that was already evicted no longer counts towards the cap
+            if study.study_ids:
+                self._bytes_held += nbytes
+                self._evict()
+
+    def _add(self, study_id, study):
+        # Caller holds the lock; a study's bytes count once, however many ids it has
+        if not study.study_ids:
+            self._bytes_held += study.nbytes
+            self._keys[study.key] = study
+        study.study_ids.add(study_id)
+        self._studies[study_id] = study
+
+    def _drop(self, study_id):
+        # Caller holds the lock
+        study = self._studies.pop(study_id)
+        study.study_ids.discard(study_id)
+        if not study.study_ids:
+            self._bytes_held -= study.nbytes
+            if self._keys.get(study.key) is study:
+                del self._keys[study.key]
+
+    def _evict(self):
+        # Caller holds the lock
+        now = time.monotonic()
+        for study_id in [s for s, study in self._studies.items() if study.expires_at < now]:
+            self._drop(study_id)
+        # The most recent study is always kept, even if it alone is over the cap
+        while self._bytes_held > self.max_bytes and len(self._studies) > 1:
+            self._drop(next(iter(self._studies)))
+
+    def _shared_path(self, study_id):
+        return os.path.join(self.shared_dir, f"{study_id}.npz")
+
+    def _write_shared(self, study, study_id):
+        """Writes the study's file under its key, and links its id to it when the two differ."""
+        path = self._shared_path(study.key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp.npz"
+        try:
+            np.savez(tmp_path, image_bgr=study.image_bgr, features=study.features.numpy())
+            os.replace(tmp_path, path) # Atomic, so readers never see a partial file
+        except OSError as e:
+            print(f"⚠️ Could not write the study to the shared heatmap directory: {e}")
+        self._link_shared(study, study_id)
+        self._sweep_shared()
+
+    def _link_shared(self, study, study_id):
+        # A hard link shares the file's modification time: touching it restarts the TTL of every id
+        if study_id == study.key:
+            return
+        path = self._shared_path(study.key)
+        try:
+            os.utime(path)
+            os.link(path, self._shared_path(study_id))
+        except OSError as e:
+            print(f"⚠️ Could not link the study in the shared heatmap directory: {e}")
+
+    def _read_shared(self, study_id, key=None):
+        if not STUDY_ID_PATTERN.fullmatch(study_id):
+            return None
+        path = self._shared_path(study_id)
+        try:
+            remaining = os.path.getmtime(path) + self.ttl_seconds - time.time()
+            if remaining <= 0:
+                return None
+            with np.load(path) as data:
+                image_bgr, features = data["image_bgr"], torch.from_numpy(data["features"])
+        except (OSError, ValueError, KeyError):
+            return None
+        return _Study(key or study_id, time.monotonic() + remaining, image_bgr, features)
+
+    def _sweep_shared(self):
+        """Deletes the expired files of every process, at most a few times per TTL."""
+        now = time.time()
+        if now - self._last_sweep < self.ttl_seconds / 4:
+            return
+        self._last_sweep = now
+        for name in os.listdir(self.shared_dir):
+            path = os.path.join(self.shared_dir, name)
+            try:
+                if os.path.getmtime(path) + self.ttl_seconds < now:
+                    os.remove(path)
+            except OSError:
+                pass # Removed by another process meanwhile
@@ -0,0 +1,125 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+from src.analyze import predict_features_batch
+
+class InferenceScheduler:
+    """
+    Collects preprocessed tensors from concurrent requests into micro-batches and runs
+    them through the model on a single worker thread. A batch is closed once it holds
+    `max_batch_size` images or the first image has waited `max_wait_ms` milliseconds.
+    The views of one image (`submit_many`) are one request: they always run in the same batch.
+    At most `max_queue_size` requests wait in the queue; beyond that `submit` raises queue.Full.
+    """
+    def __init__(self, model, max_batch_size=8, max_wait_ms=10, max_queue_size=64, batch_fn=predict_features_batch):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.batch_fn = batch_fn
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._held = None # a request that didn't fit in the last batch, first in the next one
+        self._thread = None
+        self._stopped = threading.Event()
+        self.batches_run = 0
+        self.images_run = 0
+
+    def start(self):
+        """Starts the worker thread that owns the model."""
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="inference-scheduler", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops the worker thread once the batch in flight is done."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, x_tensor):
+        """Queues a (1, 3, H, W) tensor and returns a Future for its (probabilities, feature map) result."""
+        future = Future()
+        self._queue.put_nowait((x_tensor, future, False))
+        return future
+
+    def submit_many(self, x_batch):
+        """
+        Queues the images of a (n, 3, H, W) batch, such as the TTA views of one image, as a single request
+        and returns a Future for the list of their results. They run in one batch, never split across
+        batches or interleaved with other requests; more than max_batch_size of them get a batch of their own.
+        """
+        future = Future()
+        self._queue.put_nowait((x_batch, future, True))
+        return future
+
+    def predict(self, x_tensor, timeout=None):
+        """Blocking helper for request threads: submits the tensor and waits for its result."""
+        return self.submit(x_tensor).result(timeout=timeout)
+
+    def predict_many(self, x_batch, timeout=None):
+        """Blocking helper for submit_many: queues the images as one request and waits for all their results."""
+        return self.submit_many(x_batch).result(timeout=timeout)
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def _collect_batch(self):
+        """
+        Blocks for the first request, then gathers more until the batch is full or the wait expires.
+        A request whose images don't all fit is held back to open the next batch.
+        """
+        if self._held is not None:
+            batch, self._held = [self._held], None
+        else:
+            try:
+                batch = [self._queue.get(timeout=0.1)]
+            except queue.Empty:
+                return []
+
+        size = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if size + len(request[0]) > self.max_batch_size:
+                self._held = request
+                break
+            batch.append(request)
+            size += len(request[0])
+        return batch
+
+    def _run(self):
+        while not self._stopped.is_set():
+            # Requests cancelled while they waited are dropped here, before they reach the model
+            batch = [request for request in self._collect_batch() if request[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            tensors, futures, _ = zip(*batch)
+            try:
+                results = self.batch_fn(self.model, torch.cat(tensors))
+                if results is None:
+                    raise RuntimeError("Inference failed for the batch")
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            self.batches_run += 1
+            self.images_run += len(results)
+            start = 0
+            for x, future, many in batch:
+                rows = results[start:start + len(x)]
+                start += len(x)
+                future.set_result(list(rows) if many else rows[0])
@@ -0,0 +1,195 @@
+"""
+Lightweight instrumentation of the request pipeline.
+
+Stages are timed with `with span("forward"): ...` and feed Prometheus histograms, served by
+init_app's /metrics route in the text exposition format. With TRACE_REQUESTS=1 the spans of each
+request are also collected into a trace: it is printed as one JSON line and returned in the
+Server-Timing header, under the request's X-Request-ID.
+With METRICS_ENABLED=0, span() returns a shared no-op context manager and nothing is recorded.
+"""
+import bisect
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import nullcontext
+
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '1') == '1'
+TRACE_REQUESTS = os.environ.get('TRACE_REQUESTS', '0') == '1'
+
+# Seconds, from a sub-millisecond decode to a slow LLM call
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _labels(names, values):
+    return ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+
+class Counter:
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{{{_labels(self.label_names, labels)}}} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, label_names, buckets=BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {} # labels -> [per-bucket counts (last one is +Inf), sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._series.items()):
+                label_text = _labels(self.label_names, labels)
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += bucket_count
+                    lines.append(f'{self.name}_bucket{{{label_text},le="{bound}"}} {cumulative}')
+                lines.append(f"{self.name}_sum{{{label_text}}} {total}")
+                lines.append(f"{self.name}_count{{{label_text}}} {count}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help_text, label_names=()):
+        self.metrics.append(Counter(name, help_text, label_names))
+        return self.metrics[-1]
+
+    def histogram(self, name, help_text, label_names=(), buckets=BUCKETS):
+        self.metrics.append(Histogram(name, help_text, label_names, buckets))
+        return self.metrics[-1]
+
+    def render(self):
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+registry = Registry()
+STAGE_SECONDS = registry.histogram("xray_stage_seconds", "Time spent in each pipeline stage.", ("stage",))
+STAGE_ERRORS = registry.counter("xray_stage_errors_total", "Pipeline stages that raised.", ("stage",))
+REQUEST_SECONDS = registry.histogram(
+    "xray_request_seconds", "Request latency until the response headers.", ("endpoint", "method")
+)
+REQUESTS = registry.counter("xray_requests_total", "Requests by endpoint and status.", ("endpoint", "method", "status"))
+
+class Trace:
+    __slots__ = ("request_id", "start", "spans")
+
+    def __init__(self, request_id, start):
+        self.request_id = request_id
+        self.start = start
+        self.spans = [] # (stage, offset from the request start, seconds, error)
+
+# Only the request's own thread sees its trace; stages on worker threads (e.g. the batched
+# forward pass) still feed the histograms
+_trace = contextvars.ContextVar("trace", default=None)
+
+def record(stage, seconds, start=None, error=False):
+    """Records one stage that took `seconds`, starting at perf_counter() `start` (default: `seconds` ago)."""
+    if not METRICS_ENABLED:
+        return
+    STAGE_SECONDS.observe(seconds, stage)
+    if error:
+        STAGE_ERRORS.inc(stage)
+    trace = _trace.get()
+    if trace is not None:
+        if start is None:
+            start = time.perf_counter() - seconds
+        trace.spans.append((stage, start - trace.start, seconds, error))
+
+class _Span:
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        record(self.stage, time.perf_counter() - self.start, self.start, error=exc_type is not None)
+        return False
+
+_NOOP = nullcontext()
+
+def span(stage):
+    """Context manager timing a block as one stage."""
+    return _Span(stage) if METRICS_ENABLED else _NOOP
+
+def init_app(app):
+    """
+    Adds /metrics to a Flask app, counts and times its requests by route, and tags every
+    response with an X-Request-ID (the client's, or a new one). Does nothing when disabled.
+    """
+    if not METRICS_ENABLED:
+        return
+    from flask import Response, g, request
+
+    @app.before_request
+    def start_request():
+        g.request_start = time.perf_counter()
+        g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+        if TRACE_REQUESTS:
+            g.trace_token = _trace.set(Trace(g.request_id, g.request_start))
+
+    @app.after_request
+    def finish_request(response):
+        seconds = time.perf_counter() - g.request_start
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        REQUEST_SECONDS.observe(seconds, endpoint, request.method)
+        REQUESTS.inc(endpoint, request.method, str(response.status_code))
+        response.headers['X-Request-ID'] = g.request_id
+        trace = _trace.get()
+        if trace is not None:
+            response.headers['Server-Timing'] = ", ".join(
+                f"{stage};dur={duration * 1000:.2f}" for stage, _, duration, _ in trace.spans
+            )
+            print(json.dumps({
+                "request_id": trace.request_id,
+                "endpoint": endpoint,
+                "status": response.status_code,
+                "seconds": round(seconds, 6),
+                "spans": [
+                    {"stage": stage, "offset": round(offset, 6), "seconds": round(duration, 6), "error": error}
+                    for stage, offset, duration, error in trace.spans
+                ],
+            }))
+        return response
+
+    @app.teardown_request
+    def end_trace(exc):
+        token = g.pop('trace_token', None)
+        if token is not None:
+            _trace.reset(token)
+
+    @app.route('/metrics')
+    def metrics():
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
@@ -1,8 +1,24 @@
+import json
+import os
+import re
+import time
+import warnings
 import torch  # ✨ ADD THIS LINE
 import torch.nn as nn
 import torch.nn.functional as F
 from torchvision import models
 
+from src.analyze import generate_gradcams
+from src.precision import optimize_model
+from src.utils import INPUT_SIZE
+
+# Local serialized weights; created from the torchvision weights the first time they are downloaded
+DEFAULT_CHECKPOINT = os.environ.get("MODEL_CHECKPOINT", os.path.join("models", "densenet121.pt"))
+# Optional compiled artifact (see `python -m src.export`); used instead of the eager model when it checks out
+DEFAULT_ARTIFACT = os.environ.get("MODEL_ARTIFACT") or None
+# Bump when the weights or the architecture change; part of the result cache key
+MODEL_VERSION = os.environ.get("MODEL_VERSION", "densenet121-imagenet-1")
+
 class CustomDenseNet(models.DenseNet):
     """
     A custom DenseNet class that overrides the forward pass to ensure
@@ -11,6 +27,10 @@ class CustomDenseNet(models.DenseNet):
     """
     def forward(self, x):
         features = self.features(x)
+        return self.head(features)
+
+    def head(self, features):
+        """Everything after the final feature map; Grad-CAM differentiates only through this part."""
         # The key change from the original: inplace=False
         out = F.relu(features, inplace=False)
         out = F.adaptive_avg_pool2d(out, (1, 1))
@@ -18,20 +38,262 @@ class CustomDenseNet(models.DenseNet):
         out = self.classifier(out)
         return out
 
-def load_model():
-    """Initializes the custom DenseNet model and loads pretrained weights."""
-    print("🧠 Loading pre-trained DenseNet-121 model...")
-    # These are the standard parameters for DenseNet-121
-    model = CustomDenseNet(
+    def cam_shift(self):
+        """
+        norm5's per-channel shift over the output channels of the last dense layer's conv, the layer
+        Grad-CAM explains. That conv's output is the last channels of the concatenation norm5
+        normalizes, so the final feature map holds it, scaled and shifted. optimize_model keeps a copy
+        (`frozen_cam_shift`) before replacing `features`.
+        """
+        norm = getattr(self.features, "norm5", None)
+        if norm is None:
+            return self.frozen_cam_shift
+        last_conv = [m for m in self.features.modules() if isinstance(m, nn.Conv2d)][-1]
+        scale = norm.weight / torch.sqrt(norm.running_var + norm.eps)
+        return (norm.bias - norm.running_mean * scale)[-last_conv.out_channels:].detach()
+
+    def cam_activations(self, features):
+        """
+        The last conv's output recovered from the final feature map, up to norm5's per-channel scale,
+        which cam_weights leaves out as well: the two scales cancel in the CAM.
+        Returns a (batch, conv channels, h, w) tensor.
+        """
+        shift = self.cam_shift().to(features.dtype)
+        return features[:, -len(shift):] - shift.view(1, -1, 1, 1)
+
+    def cam_weights(self, features, target_classes):
+        """
+        The Grad-CAM channel weights of the last conv, in closed form: the gradient of class c's score
+        with respect to final channel k at (i, j) is classifier.weight[c, k] / (h * w) where the feature
+        is positive (the ReLU mask) and 0 elsewhere, so its spatial mean needs no backward pass; through
+        norm5 it is also multiplied by the scale of channel k. Must be kept in line with `head`.
+        Returns a (batch, targets, conv channels) tensor, to contract with cam_activations.
+        """
+        channels = len(self.cam_shift())
+        height, width = features.shape[2:]
+        active = (features[:, -channels:] > 0).to(features.dtype).mean(dim=(2, 3)) # (batch, channels)
+        weight = self.classifier.weight[list(target_classes), -channels:].to(features.dtype) / (height * width)
+        return weight.unsqueeze(0) * active.unsqueeze(1)
+
+def build_model():
+    """Builds an uninitialized CustomDenseNet with the standard DenseNet-121 parameters."""
+    return CustomDenseNet(
         growth_rate=32,
         block_config=(6, 12, 24, 16),
         num_init_features=64,
         bn_size=4,
         drop_rate=0
     )
-    # Load weights from the standard pre-trained model
-    pretrained_state_dict = models.densenet121(weights=models.DenseNet121_Weights.DEFAULT).state_dict()
-    model.load_state_dict(pretrained_state_dict)
+
+def _remap_legacy_keys(state_dict):
+    """The torchvision DenseNet weights use 'norm.1'-style keys; rename them to 'norm1' (as densenet121 does)."""
+    pattern = re.compile(r"^(.*denselayer\d+\.(?:norm|relu|conv))\.((?:[12])\.(?:weight|bias|running_mean|running_var))$")
+    for key in list(state_dict.keys()):
+        res = pattern.match(key)
+        if res:
+            state_dict[res.group(1) + res.group(2)] = state_dict.pop(key)
+    return state_dict
+
+def save_checkpoint(model_or_state_dict, checkpoint_path=DEFAULT_CHECKPOINT):
+    """Serializes the model weights so later starts can load them locally."""
+    state_dict = model_or_state_dict
+    if isinstance(model_or_state_dict, nn.Module):
+        state_dict = model_or_state_dict.state_dict()
+    os.makedirs(os.path.dirname(checkpoint_path) or ".", exist_ok=True)
+    torch.save(state_dict, checkpoint_path)
+
+# --- COMPILED ARTIFACTS ---
+
+# export: torch.export program; aoti: AOTInductor-compiled package; torchscript: frozen TorchScript (works for int8)
+ARTIFACT_FORMATS = ("export", "aoti", "torchscript")
+
+class _ExportWrapper(nn.Module):
+    """What gets exported: the logits, plus the final feature map when `with_features` is set."""
+    def __init__(self, model, with_features):
+        super().__init__()
+        self.model = model
+        self.with_features = with_features
+
+    def forward(self, x):
+        features = self.model.features(x)
+        logits = self.model.head(features)
+        if self.with_features:
+            return logits, features
+        return logits
+
+class CompiledDenseNet(nn.Module):
+    """
+    A compiled artifact behind CustomDenseNet's interface (features, head, forward).
+    The whole network runs in the artifact; `head` also runs in eager fp32 from the same
+    classifier weights, so Grad-CAM can differentiate it.
+    """
+    def __init__(self, graph, classifier, with_features, metadata, cam_shift):
+        super().__init__()
+        self.graph = graph
+        self.classifier = classifier
+        self.with_features = with_features
+        self.metadata = metadata
+        self.frozen_cam_shift = cam_shift
+
+    def features(self, x):
+        if not self.with_features:
+            raise RuntimeError("This artifact was exported without its feature map; re-export it with features for Grad-CAM")
+        return self.graph(x)[1]
+
+    # Same computation as the eager model's head
+    head = CustomDenseNet.head
+    cam_activations = CustomDenseNet.cam_activations
+    cam_weights = CustomDenseNet.cam_weights
+
+    def cam_shift(self):
+        return self.frozen_cam_shift
+
+    def train(self, mode=True):
+        # The artifact is a frozen inference graph without a train mode of its own
+        self.training = mode
+        self.classifier.train(mode)
+        return self
+
+    def forward(self, x):
+        out = self.graph(x)
+        return out[0] if self.with_features else out
+
+def reference_input(batch_size=2):
+    """A fixed, RNG-free input batch used to check an artifact against the eager model."""
+    n = batch_size * 3 * INPUT_SIZE * INPUT_SIZE
+    return torch.sin(torch.arange(n, dtype=torch.float32) * 0.01).reshape(batch_size, 3, INPUT_SIZE, INPUT_SIZE)
+
+def _max_prob_diff(a, b):
+    return (torch.sigmoid(a.float()) - torch.sigmoid(b.float())).abs().max().item()
+
+def _load_graph(artifact_path, fmt):
+    with warnings.catch_warnings():
+        # TorchScript announces its own deprecation on every call
+        warnings.simplefilter("ignore")
+        if fmt == "torchscript":
+            return torch.jit.load(artifact_path, map_location="cpu")
+        if fmt == "aoti":
+            from torch._inductor import aoti_load_package
+            return aoti_load_package(artifact_path)
+        return torch.export.load(artifact_path).module()
+
+def export_artifact(model, artifact_path, fmt="export", precision="fp32", with_features=True, max_batch_size=64, atol=1e-4):
+    """
+    Exports `model` (already in its precision mode) as a frozen inference graph, checks that the
+    artifact reproduces the eager probabilities within `atol`, and writes its metadata next to it
+    as `<artifact>.json`. torch.export can't serialize the int8 model; use the torchscript format for it.
+    """
+    if fmt not in ARTIFACT_FORMATS:
+        raise ValueError(f"Unknown artifact format '{fmt}' (use one of {', '.join(ARTIFACT_FORMATS)})")
+    wrapper = _ExportWrapper(model.eval(), with_features).eval()
+    x = reference_input()
+    os.makedirs(os.path.dirname(artifact_path) or ".", exist_ok=True)
+
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        if fmt == "torchscript":
+            graph = torch.jit.freeze(torch.jit.trace(wrapper, x, check_trace=False))
+            torch.jit.save(graph, artifact_path)
+        else:
+            batch = torch.export.Dim("batch", min=1, max=max_batch_size)
+            program = torch.export.export(wrapper, (x,), dynamic_shapes=({0: batch},))
+            if fmt == "aoti":
+                from torch._inductor import aoti_compile_and_package
+                aoti_compile_and_package(program, package_path=artifact_path)
+            else:
+                torch.export.save(program, artifact_path)
+
+        expected = wrapper(x)
+        actual = _load_graph(artifact_path, fmt)(x)
+    if not with_features:
+        expected, actual = (expected,), (actual,)
+    diff = _max_prob_diff(expected[0], actual[0])
+    if diff > atol:
+        raise RuntimeError(f"Exported artifact differs from the eager model (max probability difference {diff:.2e})")
+
+    metadata = {
+        "format": fmt,
+        "precision": precision,
+        "model_version": MODEL_VERSION,
+        "with_features": with_features,
+        "max_batch_size": max_batch_size if fmt != "torchscript" else None,
+        "torch_version": torch.__version__,
+    }
+    with open(artifact_path + ".json", "w") as f:
+        json.dump(metadata, f, indent=2)
+    return metadata
+
+def load_artifact(model, artifact_path, precision="fp32", atol=1e-4, require_features=True):
+    """
+    Loads a compiled artifact for the eager `model` and checks it: same model version and precision,
+    the same probabilities as `model` on the reference input and, with `require_features`, the feature
+    map that Grad-CAM needs. Raises ValueError if it doesn't match.
+    """
+    with open(artifact_path + ".json") as f:
+        metadata = json.load(f)
+    if metadata["model_version"] != MODEL_VERSION or metadata["precision"] != precision:
+        raise ValueError(
+            f"artifact is {metadata['model_version']}/{metadata['precision']}, expected {MODEL_VERSION}/{precision}"
+        )
+    if require_features and not metadata["with_features"]:
+        raise ValueError("artifact was exported with --no-features, which only serves forward passes without Grad-CAM")
+
+    graph = _load_graph(artifact_path, metadata["format"])
+    compiled = CompiledDenseNet(graph, model.classifier, metadata["with_features"], metadata, model.cam_shift())
+    x = reference_input()
+    with torch.no_grad():
+        diff = _max_prob_diff(model(x), compiled(x))
+    if diff > atol:
+        raise ValueError(f"artifact output differs from the eager model (max probability difference {diff:.2e})")
+    return compiled
+
+# --- LOADING ---
+
+def load_model(checkpoint_path=DEFAULT_CHECKPOINT, mmap=False, precision="fp32", calibration_dir=None,
+               artifact_path=DEFAULT_ARTIFACT, require_features=True):
+    """
+    Initializes the custom DenseNet model and loads pretrained weights.
+    Weights come from the local checkpoint when it exists; otherwise the torchvision weights
+    are fetched once (straight into this model) and cached to the checkpoint for the next start.
+    With `mmap=True` the checkpoint is memory-mapped and its tensors are used in place.
+    `precision` selects the inference mode (fp32, fp32-fused, bf16 or int8, see src.precision);
+    int8 is calibrated on the images in `calibration_dir`.
+    When `artifact_path` points to a compiled artifact of the same version and precision whose
+    output matches the eager model, the artifact is returned instead; otherwise the eager model is.
+    An artifact without its feature map is only used when `require_features` is off (no Grad-CAM).
+    """
+    print("🧠 Loading pre-trained DenseNet-121 model...")
+    start = time.perf_counter()
+    model = build_model()
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        state_dict = torch.load(checkpoint_path, map_location="cpu", weights_only=True, mmap=mmap)
+        model.load_state_dict(state_dict, assign=mmap)
+    else:
+        state_dict = _remap_legacy_keys(models.DenseNet121_Weights.DEFAULT.get_state_dict(progress=True))
+        model.load_state_dict(state_dict)
+        if checkpoint_path:
+            save_checkpoint(state_dict, checkpoint_path)
+            print(f"💾 Cached weights to '{checkpoint_path}'")
     model.eval()
-    print("✅ Model loaded successfully.")
-    return model
\ No newline at end of file
+    if precision != "fp32":
+        optimize_model(model, precision, calibration_dir)
+        print(f"⚙️ Inference precision: {precision}")
+    if artifact_path and os.path.exists(artifact_path):
+        try:
+            model = load_artifact(model, artifact_path, precision, require_features=require_features)
+            print(f"⚡ Using compiled artifact '{artifact_path}' ({model.metadata['format']})")
+        except Exception as e:
+            print(f"⚠️ Compiled artifact '{artifact_path}' not used, falling back to eager: {e}")
+    print(f"✅ Model loaded successfully in {time.perf_counter() - start:.2f}s.")
+    return model
+
+def warmup_model(model, steps=1):
+    """
+    Runs forward and Grad-CAM passes on a dummy image so the first real request
+    doesn't pay for lazy initialization and allocator warm-up.
+    """
+    dummy = torch.zeros(1, 3, 224, 224)
+    for _ in range(steps):
+        with torch.no_grad():
+            model(dummy)
+        generate_gradcams(model, dummy, [0])
@@ -0,0 +1,113 @@
+"""
+Parity report for the inference precision modes.
+
+    python -m src.parity reference/ --calibration-dir calibration/
+    python -m src.parity reference/ --modes fp32-fused,bf16 --tolerance 0.01 -o parity.json
+
+Every mode in src.precision scores the same reference images as the fp32 model. The report gives,
+per mode, the largest and mean absolute difference of the probabilities, how often the set of
+detected findings is unchanged, the mean difference of the Grad-CAMs and the time per image,
+then recommends the fastest mode that stays within the tolerance.
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+import torch
+
+from src.analyze import CLASSES, detected_classes, forward_features, gradcams_from_features
+from src.batch import iter_image_paths
+from src.model import load_model
+from src.precision import PRECISION_MODES, optimized_copy
+from src.utils import preprocess_image
+
+def load_reference_images(source, limit):
+    tensors = []
+    for path in iter_image_paths(source):
+        x_tensor, _ = preprocess_image(path)
+        if x_tensor is not None:
+            tensors.append(x_tensor)
+        if len(tensors) >= limit:
+            break
+    if not tensors:
+        raise SystemExit(f"❌ No readable images in '{source}'")
+    return torch.cat(tensors)
+
+def score(model, images, batch_size):
+    """Returns the probabilities, the Grad-CAMs of every class and the seconds per image."""
+    classes = list(range(len(CLASSES)))
+    forward_features(model, images[:batch_size]) # Warm-up
+    probs, cams, elapsed = [], [], 0.0
+    for start in range(0, len(images), batch_size):
+        batch_start = time.perf_counter()
+        batch_probs, features = forward_features(model, images[start:start + batch_size])
+        elapsed += time.perf_counter() - batch_start
+        probs.append(batch_probs[:, :len(CLASSES)].numpy())
+        cams.append(gradcams_from_features(model, features, classes).numpy())
+    return np.concatenate(probs), np.concatenate(cams), elapsed / len(images)
+
+def compare(reference, candidate):
+    ref_probs, ref_cams, _ = reference
+    probs, cams, seconds = candidate
+    diff = np.abs(probs - ref_probs)
+    agreement = np.mean([detected_classes(a) == detected_classes(b) for a, b in zip(ref_probs, probs)])
+    return {
+        "max_abs_diff": round(float(diff.max()), 6),
+        "mean_abs_diff": round(float(diff.mean()), 6),
+        "detection_agreement": round(float(agreement), 4),
+        "cam_mean_abs_diff": round(float(np.abs(cams - ref_cams).mean()), 6),
+        "ms_per_image": round(seconds * 1000, 3),
+    }
+
+def run(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    modes = [mode.strip() for mode in args.modes.split(',') if mode.strip()]
+    unknown = [mode for mode in modes if mode not in PRECISION_MODES]
+    if unknown:
+        raise SystemExit(f"❌ Unknown modes: {', '.join(unknown)} (use {', '.join(PRECISION_MODES)})")
+
+    images = load_reference_images(args.source, args.limit)
+    print(f"🖼️ {len(images)} reference images")
+    # Always the eager model, never a compiled artifact
+    model = load_model(artifact_path=None)
+    reference = score(model, images, args.batch_size)
+
+    report = {"images": len(images), "tolerance": args.tolerance, "modes": {}}
+    for mode in modes:
+        if mode == "int8" and not args.calibration_dir:
+            print("⚠️ Skipping int8: it needs --calibration-dir")
+            continue
+        candidate = model if mode == "fp32" else optimized_copy(model, mode, args.calibration_dir)
+        report["modes"][mode] = compare(reference, score(candidate, images, args.batch_size))
+
+    print(f"{'mode':<12}{'max diff':>10}{'mean diff':>11}{'agreement':>11}{'cam diff':>10}{'ms/image':>10}")
+    for mode, row in report["modes"].items():
+        print(f"{mode:<12}{row['max_abs_diff']:>10.4f}{row['mean_abs_diff']:>11.5f}"
+              f"{row['detection_agreement']:>11.2%}{row['cam_mean_abs_diff']:>10.4f}{row['ms_per_image']:>10.1f}")
+
+    within = [mode for mode, row in report["modes"].items() if row["max_abs_diff"] <= args.tolerance]
+    report["recommended"] = min(within, key=lambda mode: report["modes"][mode]["ms_per_image"]) if within else None
+    print(f"✅ Fastest mode within {args.tolerance}: {report['recommended']}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"   Report: {args.output}")
+    return report
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the inference precision modes against fp32.")
+    parser.add_argument("source", help="Directory of reference images, or a text file with one image path per line")
+    parser.add_argument("--modes", default=','.join(PRECISION_MODES), help="Comma-separated modes (default: all)")
+    parser.add_argument("--calibration-dir", help="Calibration images for int8 (ideally not the reference images)")
+    parser.add_argument("--limit", type=int, default=64, help="Reference images to use (default: 64)")
+    parser.add_argument("--batch-size", type=int, default=8, help="Images per forward pass (default: 8)")
+    parser.add_argument("--tolerance", type=float, default=0.02, help="Largest acceptable probability difference")
+    parser.add_argument("--threads", type=int, default=0, help="torch intra-op threads (default: torch's)")
+    parser.add_argument("-o", "--output", help="Write the report as JSON")
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    run(parse_args())
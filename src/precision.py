@@ -0,0 +1,118 @@
+import copy
+import os
+import warnings
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from src.utils import preprocess_image
+
+# fp32:       the reference model, unchanged
+# fp32-fused: BatchNorm folded into the preceding convolutions, channels_last layout
+# bf16:       fp32-fused under bfloat16 autocast
+# int8:       static int8 quantization of the feature extractor, calibrated on local images
+PRECISION_MODES = ("fp32", "fp32-fused", "bf16", "int8")
+
+CALIBRATION_EXTENSIONS = {'.png', '.jpg', '.jpeg'}
+
+class InferenceFeatures(nn.Module):
+    """
+    Wraps an inference-only feature extractor. Inputs are converted to channels_last, the
+    extractor optionally runs under CPU autocast, and the feature map is always returned as fp32
+    so the classifier head (and Grad-CAM, which differentiates only the head) stays in fp32.
+    """
+    def __init__(self, features, autocast_dtype=None, channels_last=True):
+        super().__init__()
+        self.features = features
+        self.autocast_dtype = autocast_dtype
+        self.channels_last = channels_last
+
+    def forward(self, x):
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        if self.autocast_dtype is None:
+            return self.features(x).float()
+        with torch.autocast("cpu", dtype=self.autocast_dtype):
+            out = self.features(x)
+        return out.float()
+
+def fold_batchnorm(features):
+    """
+    Folds every BatchNorm that directly follows a convolution into that convolution's weights:
+    the stem's conv0/norm0 and each dense layer's conv1/norm2. The other norms of DenseNet come
+    before their convolution (pre-activation) and read concatenated inputs, so they stay.
+    Modifies `features` in place and returns it.
+    """
+    pairs = [(features, "conv0", "norm0")]
+    for module in features.modules():
+        if hasattr(module, "conv1") and hasattr(module, "norm2"):
+            pairs.append((module, "conv1", "norm2"))
+
+    for parent, conv_name, norm_name in pairs:
+        norm = getattr(parent, norm_name)
+        if isinstance(norm, nn.BatchNorm2d):
+            setattr(parent, conv_name, fuse_conv_bn_eval(getattr(parent, conv_name), norm))
+            setattr(parent, norm_name, nn.Identity())
+    return features
+
+def load_calibration_images(calibration_dir, limit=32):
+    """Preprocesses up to `limit` images from a directory into one (n, 3, 224, 224) batch."""
+    tensors = []
+    for name in sorted(os.listdir(calibration_dir)):
+        if os.path.splitext(name)[1].lower() not in CALIBRATION_EXTENSIONS:
+            continue
+        x_tensor, _ = preprocess_image(os.path.join(calibration_dir, name))
+        if x_tensor is not None:
+            tensors.append(x_tensor)
+        if len(tensors) >= limit:
+            break
+    if not tensors:
+        raise ValueError(f"No readable calibration images in '{calibration_dir}'")
+    return torch.cat(tensors)
+
+def quantize_features(features, calibration, batch_size=8):
+    """Static int8 quantization (FX graph mode, x86 backend) of a feature extractor, calibrated on a batch of images."""
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    with warnings.catch_warnings():
+        # torch.ao.quantization announces its own deprecation on every call
+        warnings.simplefilter("ignore")
+        prepared = prepare_fx(features, get_default_qconfig_mapping("x86"), example_inputs=(calibration[:1],))
+        with torch.no_grad():
+            for start in range(0, len(calibration), batch_size):
+                prepared(calibration[start:start + batch_size])
+        return convert_fx(prepared)
+
+def optimize_model(model, precision="fp32", calibration_dir=None):
+    """
+    Switches a loaded CustomDenseNet to an inference precision mode (see PRECISION_MODES).
+    Only `model.features` is replaced; the head stays fp32, so Grad-CAM keeps working in every mode.
+    `int8` needs `calibration_dir`, a directory of a few representative radiographs.
+    Modifies `model` in place and returns it.
+    """
+    if precision not in PRECISION_MODES:
+        raise ValueError(f"Unknown precision '{precision}' (use one of {', '.join(PRECISION_MODES)})")
+    if precision == "fp32":
+        return model
+
+    model.eval()
+    # Grad-CAM needs norm5's shift, which the optimized extractor no longer exposes
+    model.frozen_cam_shift = model.cam_shift()
+    features = fold_batchnorm(model.features)
+    if precision == "int8":
+        if not calibration_dir:
+            raise ValueError("int8 precision needs a calibration image directory")
+        calibration = load_calibration_images(calibration_dir)
+        # The quantized kernels pick their own layout, so the input is left as it is
+        model.features = InferenceFeatures(quantize_features(features, calibration), channels_last=False)
+    else:
+        features = features.to(memory_format=torch.channels_last)
+        autocast_dtype = torch.bfloat16 if precision == "bf16" else None
+        model.features = InferenceFeatures(features, autocast_dtype=autocast_dtype)
+    return model
+
+def optimized_copy(model, precision, calibration_dir=None):
+    """optimize_model on a deep copy, leaving `model` (e.g. the fp32 reference) untouched."""
+    return optimize_model(copy.deepcopy(model), precision, calibration_dir)
@@ -0,0 +1,79 @@
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import torch
+
+from src.utils import preprocess_image
+
+def _init_worker():
+    # One intra-op thread per decode worker, the cores belong to the model
+    torch.set_num_threads(1)
+
+def _preprocess_worker(image):
+    x_tensor, image_np = preprocess_image(image)
+    if x_tensor is None:
+        return None, None
+    # NumPy arrays cross process boundaries without torch's shared-memory file descriptors
+    return x_tensor.numpy(), image_np
+
+class PreprocessPool:
+    """
+    Decodes and preprocesses images on a pool of worker threads or processes, so that
+    decoding the next images overlaps with inference on the current ones.
+    At most `max_pending` images are queued or in progress at any time.
+    """
+    def __init__(self, workers=2, use_processes=False, max_pending=32):
+        if use_processes:
+            self._executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="preprocess")
+        self.workers = workers
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, image, block=True):
+        """
+        Queues an image (path, bytes, file-like or array) and returns a Future for its
+        (tensor as ndarray, resized image) pair. Raises queue.Full when `block` is False
+        and `max_pending` images are already queued.
+        """
+        if not self._slots.acquire(blocking=block):
+            raise queue.Full
+        future = self._executor.submit(_preprocess_worker, image)
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def preprocess(self, image, block=True):
+        """Same contract as preprocess_image, but the work runs on the pool."""
+        x_array, image_np = self.submit(image, block=block).result()
+        if x_array is None:
+            return None, None
+        return torch.from_numpy(x_array), image_np
+
+    def map(self, images):
+        """
+        Streams (image, tensor, resized image, error) in input order for an iterable of any length,
+        with a bounded number of images in flight.
+        """
+        in_flight = deque()
+        max_in_flight = self.workers * 4
+
+        def result(image, future):
+            try:
+                x_array, image_np = future.result()
+            except Exception as e:
+                return image, None, None, str(e)
+            if x_array is None:
+                return image, None, None, "could not read image"
+            return image, torch.from_numpy(x_array), image_np, None
+
+        for image in images:
+            in_flight.append((image, self.submit(image)))
+            if len(in_flight) >= max_in_flight:
+                yield result(*in_flight.popleft())
+        while in_flight:
+            yield result(*in_flight.popleft())
+
+    def close(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,74 @@
+import threading
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+class HeatmapRenderer:
+    """
+    Turns a stack of low-resolution CAMs into colorized overlays in a handful of vectorized
+    steps: one bilinear upsampling for all classes, then one colormap call and one blend over
+    the classes stacked vertically into a single image.
+    Buffers are allocated once per (classes, height, width) and reused, so the returned
+    array is only valid until the next call to `render` on the same renderer.
+    """
+    def __init__(self, image_weight=0.6, heatmap_weight=0.4, colormap=cv2.COLORMAP_JET):
+        self.image_weight = image_weight
+        self.heatmap_weight = heatmap_weight
+        self.colormap = colormap
+        self._shape = None
+
+    def _buffers(self, num_cams, height, width):
+        if self._shape is None or self._shape[0] < num_cams or self._shape[1:] != (height, width):
+            self._shape = (num_cams, height, width)
+            self._images = np.empty((num_cams, height, width, 3), dtype=np.uint8)
+            self._out = np.empty((num_cams, height, width, 3), dtype=np.uint8)
+        return self._images[:num_cams], self._out[:num_cams]
+
+    @staticmethod
+    def normalize(cams):
+        """ReLU and per-CAM max normalization to [0, 1] over a (..., h, w) tensor."""
+        cams = torch.relu(cams)
+        max_vals = cams.amax(dim=(-2, -1), keepdim=True)
+        return torch.where(max_vals > 0, cams / max_vals.clamp_min(1e-12), cams)
+
+    def upsample(self, cams, height, width, normalize=False):
+        """Bilinearly resizes (classes, h, w) CAMs to (classes, height, width) as 0-255 colormap indices."""
+        cams = torch.as_tensor(cams, dtype=torch.float32)
+        if normalize:
+            cams = self.normalize(cams)
+        cams = F.interpolate(cams.unsqueeze(0), size=(height, width), mode='bilinear', align_corners=False)[0]
+        # Truncation, like np.uint8(255 * heatmap)
+        return (cams * 255).clamp_(0, 255).to(torch.uint8).numpy()
+
+    def render(self, cams, image_bgr, normalize=False):
+        """
+        Overlays every CAM of a (classes, h, w) stack on a (height, width, 3) BGR uint8 image.
+        Returns a (classes, height, width, 3) uint8 array.
+        """
+        if image_bgr.ndim == 2: # Grayscale
+            image_bgr = cv2.cvtColor(image_bgr, cv2.COLOR_GRAY2BGR)
+        num_cams = len(cams)
+        height, width = image_bgr.shape[:2]
+        images, out = self._buffers(num_cams, height, width)
+
+        # Classes stacked vertically: (classes * height, width) is one image for OpenCV
+        indices = self.upsample(cams, height, width, normalize=normalize).reshape(num_cams * height, width)
+        heatmaps = cv2.applyColorMap(indices, self.colormap)
+        images[:] = image_bgr
+        cv2.addWeighted(
+            images.reshape(num_cams * height, width, 3), self.image_weight,
+            heatmaps, self.heatmap_weight, 0,
+            dst=out.reshape(num_cams * height, width, 3)
+        )
+        return out
+
+_local = threading.local()
+
+def get_renderer():
+    """Returns this thread's renderer, so concurrent requests never share output buffers."""
+    renderer = getattr(_local, "renderer", None)
+    if renderer is None:
+        renderer = _local.renderer = HeatmapRenderer()
+    return renderer
@@ -0,0 +1,150 @@
+"""
+Pre-forked multi-process server for main.py.
+
+    python -m src.serve --workers 4 --port 5000
+    python -m src.serve --workers 2 --threads 4
+
+The master process loads and warms up the model once, then forks the workers. Inference never
+writes the weights, so every worker keeps using the master's copy (copy-on-write pages), and
+gc.freeze() stops the garbage collector from touching the objects created before the fork.
+Each worker owns a slice of the CPUs: its affinity is pinned to the slice and torch runs one
+intra-op thread per CPU in it, so the workers don't oversubscribe the cores. All workers accept
+connections on the same listening socket; a worker that dies is replaced.
+
+Lazily computed heatmaps are shared through HEATMAP_SHARED_DIR (by default a temporary directory
+in /dev/shm), so any worker can serve the heatmaps of a study analyzed by another one. The result
+cache, /health and /metrics are per worker.
+"""
+import argparse
+import gc
+import os
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+
+import torch
+from werkzeug.serving import make_server
+
+# A worker dying sooner than this after its start is a crash loop, not a one-off failure
+MIN_WORKER_UPTIME_SECONDS = 5
+
+def available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def cpu_slices(cpus, workers, threads):
+    """Consecutive slices of `threads` CPUs, one per worker; they wrap around when there are too few CPUs."""
+    return [[cpus[(i * threads + k) % len(cpus)] for k in range(threads)] for i in range(workers)]
+
+def run_worker(index, cpus, listener, args, app, scheduler):
+    server = make_server(args.host, args.port, app, threaded=True, fd=listener.fileno())
+
+    def stop(signum, frame):
+        # serve_forever runs on this thread: shut it down from another one
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    if args.pin and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(len(cpus))
+    scheduler.start()
+    print(f"👷 Worker {index} (pid {os.getpid()}) serving on CPUs {cpus} with {len(cpus)} torch threads")
+    server.serve_forever()
+
+def run(args):
+    cpus = available_cpus()
+    threads = args.threads or max(1, len(cpus) // args.workers)
+    if args.workers * threads > len(cpus):
+        print(f"⚠️ {args.workers} workers x {threads} threads oversubscribe the {len(cpus)} available CPUs")
+    slices = cpu_slices(cpus, args.workers, threads)
+
+    shared_dir = None
+    if args.workers > 1 and not os.environ.get('HEATMAP_SHARED_DIR'):
+        shared_dir = tempfile.mkdtemp(prefix="xray-heatmaps-", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+        os.environ['HEATMAP_SHARED_DIR'] = shared_dir
+
+    # The master never runs parallel torch work: an OpenMP thread pool started before fork()
+    # is unusable in the children
+    torch.set_num_threads(1)
+    import main
+    # Threads don't survive fork(): every worker starts its own scheduler
+    main.scheduler.stop()
+
+    listener = socket.create_server((args.host, args.port), backlog=args.backlog)
+    gc.collect()
+    gc.freeze()
+
+    children = {} # pid -> (worker index, start time)
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(index, slices[index], listener, args, main.app, main.scheduler)
+            except BaseException as e:
+                print(f"❌ Worker {index} failed: {e}")
+                code = 1
+            finally:
+                os._exit(code) # Never return into the master's code
+        children[pid] = (index, time.monotonic())
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print(f"--- Serving on http://{args.host}:{args.port} with {args.workers} workers ---")
+    for index in range(args.workers):
+        spawn(index)
+
+    exit_code = 0
+    try:
+        while children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            index, started = children.pop(pid, (None, None))
+            if index is None or stopping:
+                continue
+            if time.monotonic() - started < MIN_WORKER_UPTIME_SECONDS:
+                print(f"❌ Worker {index} exited right after starting (status {status}), stopping the server")
+                exit_code = 1
+                stop(None, None)
+            else:
+                print(f"⚠️ Worker {index} exited (status {status}), starting a new one")
+                spawn(index)
+    finally:
+        listener.close()
+        if shared_dir:
+            shutil.rmtree(shared_dir, ignore_errors=True)
+    return exit_code
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serve main.py from pre-forked worker processes sharing one model.")
+    parser.add_argument("--workers", type=int, default=int(os.environ.get('SERVE_WORKERS', 2)),
+                        help="Worker processes (default: SERVE_WORKERS or 2)")
+    parser.add_argument("--threads", type=int, default=int(os.environ.get('SERVE_THREADS', 0)),
+                        help="CPUs and torch threads per worker (default: the available CPUs divided by the workers)")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--backlog", type=int, default=128, help="Listen backlog of the shared socket")
+    parser.add_argument("--no-pin", dest="pin", action="store_false", help="Don't pin the workers' CPU affinity")
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    raise SystemExit(run(parse_args()))
@@ -0,0 +1,133 @@
+"""
+Test-time augmentation: several views of one preprocessed image scored in a single batched forward pass.
+
+Every view is a geometric transform of the (1, 3, H, W) model input with a known inverse. The class
+probabilities of the views are aggregated (mean, max or trimmed mean) and, optionally, their CAMs are
+mapped back onto the original image frame and averaged where each view covers it.
+"""
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from src.render import HeatmapRenderer
+
+# Input pixels moved by the shift views, and the side of the centre crop of the zoom view
+SHIFT_PIXELS = 8
+ZOOM_FRACTION = 0.875
+# Fraction of the views dropped at each end, per class, by the trimmed mean (at least one with 3+ views)
+TRIM_FRACTION = 0.2
+
+# name -> (kind, parameters)
+VIEWS = {
+    "identity": ("identity", ()),
+    "zoom": ("zoom", (ZOOM_FRACTION,)),
+    "shift_left": ("shift", (-SHIFT_PIXELS, 0)),
+    "shift_right": ("shift", (SHIFT_PIXELS, 0)),
+    "shift_up": ("shift", (0, -SHIFT_PIXELS)),
+    "shift_down": ("shift", (0, SHIFT_PIXELS)),
+    # Last: a chest X-ray flipped left-right has its heart on the wrong side
+    "hflip": ("hflip", ()),
+}
+AGGREGATES = ("mean", "max", "trimmed")
+
+def _shift(x, dx, dy):
+    """Moves a (..., H, W) tensor by dx pixels right and dy pixels down, repeating the edge into the gap."""
+    height, width = x.shape[-2:]
+    padded = F.pad(x, (max(dx, 0), max(-dx, 0), max(dy, 0), max(-dy, 0)), mode='replicate')
+    top, left = max(-dy, 0), max(-dx, 0)
+    return padded[..., top:top + height, left:left + width]
+
+def _shift_coverage(height, width, dx, dy):
+    """Where a view shifted by (dx, dy) and shifted back still shows the original image."""
+    mask = torch.zeros(height, width)
+    mask[max(-dy, 0):height - max(dy, 0), max(-dx, 0):width - max(dx, 0)] = 1
+    return mask
+
+def _crop_box(height, width, fraction):
+    crop_h, crop_w = round(height * fraction), round(width * fraction)
+    return (height - crop_h) // 2, (width - crop_w) // 2, crop_h, crop_w
+
+class TestTimeAugmentation:
+    """
+    A set of views and how to aggregate them. `views` is a number of views (taken in the order of
+    VIEWS) or a list of view names; the identity view always comes first. `aggregate` combines the
+    probabilities, and with `cams` the CAMs of all the views are averaged instead of using the
+    identity view's.
+    """
+    def __init__(self, views=4, aggregate="mean", cams=False):
+        if isinstance(views, int):
+            if not 1 <= views <= len(VIEWS):
+                raise ValueError(f"The number of views must be between 1 and {len(VIEWS)}")
+            views = list(VIEWS)[:views]
+        unknown = [name for name in views if name not in VIEWS]
+        if unknown:
+            raise ValueError(f"Unknown views: {', '.join(unknown)}")
+        if aggregate not in AGGREGATES:
+            raise ValueError(f"Unknown aggregate '{aggregate}', expected one of {', '.join(AGGREGATES)}")
+        self.views = ["identity"] + [name for name in dict.fromkeys(views) if name != "identity"]
+        self.aggregate = aggregate
+        self.cams = cams
+
+    def __len__(self):
+        return len(self.views)
+
+    def key(self):
+        """Identifies the configuration in cache keys."""
+        return f"tta={'+'.join(self.views)}/{self.aggregate}/{'cams' if self.cams else 'identity-cams'}"
+
+    def batch(self, x_tensor):
+        """Returns the (views, 3, H, W) batch of all the views of a (1, 3, H, W) input."""
+        height, width = x_tensor.shape[-2:]
+        views = []
+        for name in self.views:
+            kind, params = VIEWS[name]
+            if kind == "hflip":
+                views.append(x_tensor.flip(-1))
+            elif kind == "shift":
+                views.append(_shift(x_tensor, *params))
+            elif kind == "zoom":
+                top, left, crop_h, crop_w = _crop_box(height, width, *params)
+                crop = x_tensor[..., top:top + crop_h, left:left + crop_w]
+                views.append(F.interpolate(crop, size=(height, width), mode='bilinear', align_corners=False))
+            else:
+                views.append(x_tensor)
+        return torch.cat(views)
+
+    def aggregate_probs(self, probs):
+        """Combines a (views, classes) array of probabilities into one (classes,) array."""
+        probs = np.asarray(probs)
+        if self.aggregate == "max":
+            return probs.max(axis=0)
+        if self.aggregate == "trimmed" and len(probs) >= 3:
+            trim = max(1, int(len(probs) * TRIM_FRACTION))
+            return np.sort(probs, axis=0)[trim:len(probs) - trim].mean(axis=0)
+        return probs.mean(axis=0)
+
+    def aggregate_cams(self, cams, height, width):
+        """
+        Maps a (views, classes, h, w) stack of CAMs back onto the original frame at the input
+        resolution (height, width) and averages each pixel over the views that cover it.
+        Returns a (classes, height, width) tensor normalized to [0, 1].
+        """
+        cams = F.interpolate(cams.float(), size=(height, width), mode='bilinear', align_corners=False)
+        total = torch.zeros(cams.shape[1:])
+        coverage = torch.zeros(height, width)
+        for name, cam in zip(self.views, cams):
+            kind, params = VIEWS[name]
+            mask = torch.ones(height, width)
+            if kind == "hflip":
+                cam = cam.flip(-1)
+            elif kind == "shift":
+                dx, dy = params
+                cam = _shift(cam, -dx, -dy)
+                mask = _shift_coverage(height, width, dx, dy)
+            elif kind == "zoom":
+                top, left, crop_h, crop_w = _crop_box(height, width, *params)
+                crop = F.interpolate(cam.unsqueeze(0), size=(crop_h, crop_w), mode='bilinear', align_corners=False)[0]
+                cam = torch.zeros_like(cam)
+                cam[:, top:top + crop_h, left:left + crop_w] = crop
+                mask = torch.zeros(height, width)
+                mask[top:top + crop_h, left:left + crop_w] = 1
+            total += cam * mask
+            coverage += mask
+        return HeatmapRenderer.normalize(total / coverage.clamp_min(1))
@@ -1,63 +1,52 @@
-import torch
 from torchvision import transforms
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
 import numpy as np
-import cv2
-
-def preprocess_image(image_path):
-    """Loads and transforms an image for model input."""
+from io import BytesIO
+
+INPUT_SIZE = 224
+
+# Standard ImageNet transformations, built once. The resize is done separately (and only once)
+# so that the same resized image feeds both the model and the heatmap overlay.
+MODEL_TRANSFORM = transforms.Compose([
+    transforms.ToTensor(),
+    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+])
+
+def load_image(image, draft_size=None):
+    """
+    Decodes an image into an RGB PIL image. Accepts a file path, raw bytes, a file-like
+    object (e.g. an upload stream), a PIL image or an already-decoded RGB/grayscale array.
+    With `draft_size`, JPEGs are decoded at the smallest reduced resolution (1/2, 1/4, 1/8)
+    that is still at least that size.
+    """
+    if isinstance(image, Image.Image):
+        return image.convert("RGB")
+    if isinstance(image, np.ndarray):
+        return Image.fromarray(image).convert("RGB")
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        image = BytesIO(image)
+    image = Image.open(image)
+    if draft_size is not None:
+        image.draft(None, draft_size) # No-op for formats other than JPEG
+    return image.convert("RGB")
+
+def preprocess_image(image):
+    """Decodes (if needed) and transforms an image for model input."""
     try:
-        image = Image.open(image_path).convert("RGB")
+        image = load_image(image, draft_size=(INPUT_SIZE, INPUT_SIZE))
     except FileNotFoundError:
-        print(f"❌ Error: Image file not found at '{image_path}'")
+        print(f"❌ Error: Image file not found at '{image}'")
+        return None, None
+    except UnidentifiedImageError:
+        print("❌ Error: Could not decode the image")
         return None, None
-        
-    # Standard ImageNet transformations
-    transform = transforms.Compose([
-        transforms.Resize((224, 224)),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-    ])
-    
-    # Return the tensor for the model and a resized version of the original image for plotting
-    return transform(image).unsqueeze(0), np.array(image.resize((224, 224)))
-
-def generate_gradcam(model, input_tensor, target_class):
-    """Generates the Grad-CAM heatmap for a specific class."""
-    features = []
-    gradients = []
-
-    def forward_hook(module, input, output):
-        features.append(output.clone())
-
-    def backward_hook(module, grad_in, grad_out):
-        gradients.append(grad_out[0].clone())
-
-    last_feature_block = model.features
-    h1 = last_feature_block.register_forward_hook(forward_hook)
-    h2 = last_feature_block.register_full_backward_hook(backward_hook)
-
-    input_tensor.requires_grad_(True)
-    model.zero_grad()
-    
-    output = model(input_tensor)
-    loss = output[0, target_class]
-    loss.backward()
-
-    feature_map = features[0][0].detach()
-    grads = gradients[0][0].detach()
 
-    weights = torch.mean(grads, dim=[1, 2])
-    cam = torch.zeros(feature_map.shape[1:], dtype=torch.float32)
-    for i, w in enumerate(weights):
-        cam += w * feature_map[i, :, :]
+    return transform_image(image)
 
-    cam = cam.cpu().numpy()
-    cam = np.maximum(cam, 0)
-    cam = cv2.resize(cam, (224, 224))
-    if np.max(cam) > 0:
-        cam = (cam - np.min(cam)) / np.max(cam)
+def transform_image(image):
+    """Resizes a decoded RGB PIL image and transforms it for model input. Returns the tensor and the resized image."""
+    # Resize once; reducing_gap shrinks large images by an integer factor first, which is much cheaper
+    resized = image.resize((INPUT_SIZE, INPUT_SIZE), Image.BILINEAR, reducing_gap=3.0)
     
-    h1.remove()
-    h2.remove()
-    return cam
\ No newline at end of file
+    # Return the tensor for the model and the resized image for plotting
+    return MODEL_TRANSFORM(resized).unsqueeze(0), np.array(resized)
@@ -138,7 +138,7 @@ const Upload = () => {
             e('div', { className: 'heatmap-grid' },
                 heatmaps.map((heatmap, index) =>
                     e('div', { className: 'heatmap-card', key: index, style: { animationDelay: `${index * 0.15}s` } },
-                        e('img', { src: `data:image/png;base64,${heatmap.image}` }),
+                        e('img', { src: heatmap.url || `data:image/png;base64,${heatmap.image}`, loading: 'lazy' }),
                         e('h4', null, heatmap.disease)
                     )
                 )
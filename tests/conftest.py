@@ -0,0 +1,26 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+import src.model
+from tests.helpers import build_tiny_model
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture
+def tiny_model():
+    return build_tiny_model()
+
+@pytest.fixture(scope="session")
+def server():
+    """The Flask server of main.py on the tiny model, imported as `server_main` (xray_analyzer has its own `main`)."""
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv("WARMUP_STEPS", "0")
+        patch.setattr(src.model, "load_model", lambda *args, **kwargs: build_tiny_model())
+        spec = importlib.util.spec_from_file_location("server_main", os.path.join(REPO_ROOT, "main.py"))
+        module = sys.modules["server_main"] = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    yield module
+    module.scheduler.stop()
@@ -0,0 +1,30 @@
+import io
+import os
+
+import numpy as np
+import torch
+from PIL import Image
+
+from src.model import CustomDenseNet
+
+def build_tiny_model():
+    """A CustomDenseNet small enough for tests, whose classifier bias makes a few findings positive."""
+    torch.manual_seed(0)
+    model = CustomDenseNet(growth_rate=4, block_config=(2, 2), num_init_features=8, bn_size=2, drop_rate=0, num_classes=14)
+    with torch.no_grad():
+        model.classifier.bias[:10] = torch.tensor([3., -3, 2, 1, -1, 3, 0, -2, 2, 0.5])
+    return model.eval()
+
+def write_image(path, seed, size=96):
+    """Writes a random grayscale PNG (with the parent directories) and returns its path."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    rng = np.random.default_rng(seed)
+    Image.fromarray(rng.integers(0, 256, (size, size), dtype=np.uint8)).save(path)
+    return str(path)
+
+def upload(seed=0):
+    """The form data of a random grayscale PNG upload, for the Flask test client."""
+    rng = np.random.default_rng(seed)
+    buffer = io.BytesIO()
+    Image.fromarray(rng.integers(0, 256, (96, 96), dtype=np.uint8)).save(buffer, format="PNG")
+    return {"file": (io.BytesIO(buffer.getvalue()), "xray.png")}
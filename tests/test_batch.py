@@ -0,0 +1,67 @@
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from src import batch
+from tests.helpers import write_image
+
+def run_batch(source, output, *extra):
+    batch.run(batch.parse_args([str(source), "-o", str(output), "--workers", "1", "--batch-size", "2", *extra]))
+
+@pytest.fixture
+def scored_with(monkeypatch, tiny_model):
+    monkeypatch.setattr(batch, "load_model", lambda *args, **kwargs: tiny_model)
+
+def test_heatmaps_of_same_named_images_do_not_collide(tmp_path, scored_with):
+    source = tmp_path / "images"
+    write_image(source / "a" / "001.png", seed=1)
+    write_image(source / "b" / "001.png", seed=2)
+    output = tmp_path / "results.jsonl"
+    run_batch(source, output, "--gradcam")
+
+    rows = [json.loads(line) for line in output.read_text().splitlines()]
+    heatmaps = [path for row in rows for path in row["heatmaps"]]
+    assert len(rows) == 2 and all(row["heatmaps"] for row in rows)
+    assert len(set(heatmaps)) == len(heatmaps)
+    assert all(os.path.exists(path) for path in heatmaps)
+
+def test_file_list_heatmaps_are_named_by_path():
+    assert batch.heatmap_stem("x/001.png", "list.txt") != batch.heatmap_stem("y/001.png", "list.txt")
+    assert batch.heatmap_stem("data/a/001.png", "data") == os.path.join("a", "001")
+
+# Runs src.batch on the tiny model and kills the process (no cleanup at all) while the second batch is scored
+CRASHING_RUN = """
+import os
+from tests.helpers import build_tiny_model
+from src import batch
+batch.load_model = lambda *args, **kwargs: build_tiny_model()
+score_batch, calls = batch.score_batch, []
+def crash_on_second_batch(*args, **kwargs):
+    calls.append(1)
+    if len(calls) == 2:
+        os._exit(1)
+    return score_batch(*args, **kwargs)
+batch.score_batch = crash_on_second_batch
+batch.run(batch.parse_args([{source!r}, "-o", {output!r}, "--workers", "1", "--batch-size", "2"]))
+"""
+
+def test_resume_after_a_crash_loses_no_parquet_rows(tmp_path, scored_with):
+    pq = pytest.importorskip("pyarrow.parquet")
+    source = tmp_path / "images"
+    paths = [write_image(source / f"{i:03d}.png", seed=i) for i in range(6)]
+    output = tmp_path / "results.parquet"
+
+    script = CRASHING_RUN.format(source=str(source), output=str(output))
+    repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    crashed = subprocess.run([sys.executable, "-c", script], cwd=repo_root, capture_output=True)
+    assert crashed.returncode == 1, crashed.stderr.decode()
+    checkpointed = (tmp_path / "results.parquet.checkpoint").read_text().split()
+    assert len(checkpointed) == 2
+    # Every checkpointed row is already in a readable part file
+    assert sorted(pq.read_table(str(output)).column("path").to_pylist()) == sorted(checkpointed)
+
+    run_batch(source, output)
+    assert sorted(pq.read_table(str(output)).column("path").to_pylist()) == sorted(paths)
@@ -0,0 +1,39 @@
+import numpy as np
+import torch
+
+from src.cache import ResultCache
+
+def pixels(seed, shape=(4, 4, 3)):
+    return np.random.default_rng(seed).integers(0, 256, shape, dtype=np.uint8)
+
+def test_keys_follow_the_pixels_the_parameters_and_the_model_version():
+    cache = ResultCache("v1")
+    image = pixels(0)
+    key = cache.make_key((torch.from_numpy(image.astype(np.float32)), image), 50, "lazy")
+
+    assert cache.make_key((torch.from_numpy(image.astype(np.float32)), image.copy()), 50, "lazy") == key
+    assert cache.make_key((torch.from_numpy(image.astype(np.float32)), pixels(1)), 50, "lazy") != key
+    assert cache.make_key((torch.from_numpy(image.astype(np.float32)), image), 50, "inline") != key
+    assert cache.make_key((torch.from_numpy(image.astype(np.float32)), image), 60, "lazy") != key
+    assert ResultCache("v2").make_key((torch.from_numpy(image.astype(np.float32)), image), 50, "lazy") != key
+    # Same bytes in another shape
+    assert cache.make_key((image.reshape(3, 4, 4),), 50) != cache.make_key((image,), 50)
+
+def test_entries_are_evicted_least_recently_used_first_by_size():
+    # Each entry is 67 bytes of JSON: two of them fit
+    cache = ResultCache("v1", max_bytes=150)
+    for key in ("a", "b", "c"):
+        cache.put(key, [{"name": key * 20}], [])
+    assert cache.get("a") is None
+    assert cache.get("b") is not None
+    cache.put("d", [{"name": "d" * 20}], [])
+    # b was used more recently than c
+    assert cache.get("c") is None
+    assert cache.get("b") == ([{"name": "b" * 20}], [])
+    assert cache.stats()["entries"] == 2
+
+def test_disk_tier_survives_a_restart(tmp_path):
+    ResultCache("v1", disk_dir=str(tmp_path)).put("k", [{"name": "Edema", "confidence": 71}], [{"disease": "Edema"}])
+    restarted = ResultCache("v1", disk_dir=str(tmp_path))
+    assert restarted.get("k") == ([{"name": "Edema", "confidence": 71}], [{"disease": "Edema"}])
+    assert restarted.stats()["disk_hits"] == 1
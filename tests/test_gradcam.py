@@ -0,0 +1,50 @@
+import torch
+
+from src.analyze import find_target_layer, forward_features, generate_gradcams, gradcams_from_features
+from src.model import export_artifact, load_artifact
+from src.precision import optimized_copy
+from tests.helpers import build_tiny_model
+
+CLASSES = [0, 2, 5, 9]
+
+def trained_looking_model():
+    """The tiny model with non-trivial BatchNorm statistics, so that norm5 really shifts and scales."""
+    model = build_tiny_model()
+    generator = torch.Generator().manual_seed(1)
+    with torch.no_grad():
+        for module in model.modules():
+            if isinstance(module, torch.nn.BatchNorm2d):
+                size = module.num_features
+                module.running_mean.copy_(torch.randn(size, generator=generator) * 0.3)
+                module.running_var.copy_(torch.rand(size, generator=generator) + 0.5)
+                module.weight.copy_(torch.rand(size, generator=generator) + 0.5)
+                module.bias.copy_(torch.randn(size, generator=generator) * 0.3)
+    return model
+
+def last_conv_gradcams(model, x):
+    """The original Grad-CAM: gradients hooked on the last conv layer of the features."""
+    cams, _, _ = generate_gradcams(model, x, CLASSES, target_layer=find_target_layer(model))
+    return cams
+
+def test_cams_from_the_feature_map_match_the_last_conv_layer():
+    model = trained_looking_model()
+    x = torch.randn(2, 3, 96, 96, generator=torch.Generator().manual_seed(2))
+    _, features = forward_features(model, x)
+    torch.testing.assert_close(gradcams_from_features(model, features, CLASSES), last_conv_gradcams(model, x), atol=1e-5, rtol=1e-4)
+    cams, _, _ = generate_gradcams(model, x, CLASSES)
+    torch.testing.assert_close(cams, last_conv_gradcams(model, x), atol=1e-5, rtol=1e-4)
+
+def test_optimized_and_compiled_models_keep_the_last_conv_cams(tmp_path):
+    model = trained_looking_model()
+    x = torch.randn(1, 3, 224, 224, generator=torch.Generator().manual_seed(3))
+    expected = last_conv_gradcams(model, x)
+
+    fused = optimized_copy(model, "fp32-fused")
+    _, features = forward_features(fused, x)
+    torch.testing.assert_close(gradcams_from_features(fused, features, CLASSES), expected, atol=1e-4, rtol=1e-3)
+
+    artifact = str(tmp_path / "tiny.ts")
+    export_artifact(model, artifact, fmt="torchscript")
+    compiled = load_artifact(model, artifact)
+    _, features = forward_features(compiled, x)
+    torch.testing.assert_close(gradcams_from_features(compiled, features, CLASSES), expected, atol=1e-4, rtol=1e-3)
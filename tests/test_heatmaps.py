@@ -0,0 +1,111 @@
+import time
+import types
+
+import numpy as np
+import torch
+
+from src import heatmaps
+from src.heatmaps import HeatmapStore
+
+DISEASES = ["Edema", "Mass"]
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+def store(**kwargs):
+    """A store whose CAM of a disease is filled with the disease's index, counting the cam_fn calls."""
+    calls = []
+
+    def cam_fn(features, diseases):
+        calls.append(list(diseases))
+        return {d: np.full((2, 2), DISEASES.index(d), dtype=np.float32) for d in diseases}
+
+    return HeatmapStore(cam_fn, DISEASES, **kwargs), calls
+
+def put(store, study_id, seed=0):
+    image = np.random.default_rng(seed).integers(0, 256, (8, 8, 3), dtype=np.uint8)
+    store.put(study_id, image, torch.ones(1, 4, 2, 2))
+
+def test_cams_are_computed_once_per_disease():
+    heatmap_store, calls = store()
+    put(heatmap_store, "aa11")
+    assert heatmap_store.compute("aa11", ["Mass", "Unknown"])["Mass"][0, 0] == 1
+    assert set(heatmap_store.compute("aa11", ["Edema", "Mass"])) == {"Edema", "Mass"}
+    assert calls == [["Mass"], ["Edema"]]
+    png, mimetype = heatmap_store.encode("aa11", "Edema")
+    assert mimetype == "image/png" and png.startswith(b"\x89PNG")
+    assert heatmap_store.compute("bb22", ["Edema"]) is None
+
+def test_studies_expire_after_the_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(heatmaps, "time", types.SimpleNamespace(monotonic=clock.monotonic, time=clock.time))
+    heatmap_store, _ = store(ttl_seconds=60)
+    put(heatmap_store, "aa11")
+    clock.now += 59
+    assert heatmap_store.contains("aa11")
+    clock.now += 2
+    assert not heatmap_store.contains("aa11")
+    assert heatmap_store.stats()["bytes_held"] == 0
+
+def test_least_recently_used_studies_are_dropped_beyond_the_cap():
+    # 8 * 8 * 3 image bytes + 16 float32 features = 256 bytes a study: three fit
+    heatmap_store, _ = store(max_bytes=800)
+    for study_id in ("aa01", "aa02", "aa03"):
+        put(heatmap_store, study_id)
+    assert heatmap_store.contains("aa01")
+    put(heatmap_store, "aa04")
+    assert not heatmap_store.contains("aa02")
+    assert all(heatmap_store.contains(s) for s in ("aa01", "aa03", "aa04"))
+    assert heatmap_store.stats()["bytes_held"] == 3 * 256
+
+def test_processes_share_studies_through_the_shared_dir(tmp_path, monkeypatch):
+    # Shared files expire by their modification time
+    clock = Clock(time.time())
+    monkeypatch.setattr(heatmaps, "time", types.SimpleNamespace(monotonic=clock.monotonic, time=clock.time))
+    writer, _ = store(ttl_seconds=60, shared_dir=str(tmp_path))
+    reader, calls = store(ttl_seconds=60, shared_dir=str(tmp_path))
+    put(writer, "0123abcd")
+
+    assert reader.compute("0123abcd", ["Mass"])["Mass"][0, 0] == 1
+    assert calls == [["Mass"]]
+    assert reader.stats()["shared_loads"] == 1
+    # Only study ids are looked up on disk
+    assert not reader.contains("../0123abcd")
+
+    other, _ = store(ttl_seconds=60, shared_dir=str(tmp_path))
+    clock.now += 61
+    assert not other.contains("0123abcd")
+
+def test_aliases_share_one_study_and_count_its_bytes_once():
+    heatmap_store, calls = store()
+    image = np.zeros((8, 8, 3), dtype=np.uint8)
+    heatmap_store.put("aa01", image, torch.ones(1, 4, 2, 2), key="c0ffee00")
+    assert not heatmap_store.alias("deadbeef", "aa02")
+    assert heatmap_store.alias("c0ffee00", "aa02")
+    heatmap_store.compute("aa01", ["Mass"])
+    heatmap_store.compute("aa02", ["Mass"])
+    assert calls == [["Mass"]]
+    assert heatmap_store.stats()["bytes_held"] == 256 + 16
+    # The key is only a handle for alias, never a study id
+    assert not heatmap_store.contains("c0ffee00")
+
+    # A new study of the same key is aliased from then on; the ids already handed out keep the old one
+    heatmap_store.put("aa03", image, torch.zeros(1, 4, 2, 2), key="c0ffee00")
+    assert heatmap_store.alias("c0ffee00", "aa04")
+    assert heatmap_store._get("aa04") is heatmap_store._get("aa03")
+    assert heatmap_store._get("aa02") is heatmap_store._get("aa01")
+
+def test_aliases_work_across_processes(tmp_path):
+    writer, _ = store(ttl_seconds=60, shared_dir=str(tmp_path))
+    reader, _ = store(ttl_seconds=60, shared_dir=str(tmp_path))
+    writer.put("0123abcd", np.zeros((8, 8, 3), dtype=np.uint8), torch.ones(1, 4, 2, 2), key="c0ffee00")
+    assert reader.contains("0123abcd")
+    assert reader.alias("c0ffee00", "4567cdef")
+    assert writer.contains("4567cdef")
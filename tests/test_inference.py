@@ -0,0 +1,77 @@
+import queue
+
+import pytest
+import torch
+
+from src.inference import InferenceScheduler
+
+def recording_scheduler(max_batch_size=8, max_queue_size=64):
+    """A scheduler whose batch function records the size of every batch and echoes each image's first pixel."""
+    sizes = []
+
+    def batch_fn(model, x_batch):
+        sizes.append(len(x_batch))
+        return [(x[0, 0, 0].item(), {}) for x in x_batch]
+
+    scheduler = InferenceScheduler(None, max_batch_size, max_wait_ms=50, max_queue_size=max_queue_size, batch_fn=batch_fn)
+    return scheduler, sizes
+
+def images(n, first=0):
+    return torch.arange(first, first + n, dtype=torch.float32).reshape(n, 1, 1, 1).expand(n, 3, 2, 2)
+
+def test_predict_many_runs_none_of_the_views_when_the_queue_is_full():
+    scheduler, sizes = recording_scheduler(max_queue_size=2)
+    scheduler.submit(images(1, first=100))
+    scheduler.submit(images(1, first=101))
+    with pytest.raises(queue.Full):
+        scheduler.predict_many(images(4))
+
+    scheduler.start()
+    try:
+        assert [pred for pred, _ in scheduler.predict_many(images(3, first=10), timeout=5)] == [10, 11, 12]
+    finally:
+        scheduler.stop()
+    # The two images queued first and the later three views
+    assert sum(sizes) == 5
+    assert scheduler.images_run == 5
+
+def test_the_views_of_one_image_are_never_split_across_batches():
+    scheduler, sizes = recording_scheduler(max_batch_size=4)
+    singles = [scheduler.submit(x) for x in images(3).split(1)]
+    views = scheduler.submit_many(images(3, first=10))
+    last = scheduler.submit(images(1, first=3))
+    oversized = scheduler.submit_many(images(6, first=20))
+    scheduler.start()
+    try:
+        assert [future.result(timeout=5)[0] for future in singles + [last]] == [0, 1, 2, 3]
+        assert [pred for pred, _ in views.result(timeout=5)] == [10, 11, 12]
+        assert [pred for pred, _ in oversized.result(timeout=5)] == list(range(20, 26))
+    finally:
+        scheduler.stop()
+    # The views don't fit next to the three singles, so they open the next batch; the six views run alone
+    assert sizes == [3, 4, 6]
+
+def test_concurrent_images_share_a_batch_up_to_its_size():
+    scheduler, sizes = recording_scheduler(max_batch_size=3)
+    # Queued before the worker starts, so they are all waiting when it collects its first batch
+    futures = [scheduler.submit(x) for x in images(5).split(1)]
+    scheduler.start()
+    try:
+        assert [future.result(timeout=5)[0] for future in futures] == [0, 1, 2, 3, 4]
+    finally:
+        scheduler.stop()
+    assert sizes == [3, 2]
+    assert (scheduler.batches_run, scheduler.images_run) == (2, 5)
+
+def test_a_failed_batch_fails_each_of_its_requests():
+    def broken(model, x_batch):
+        raise RuntimeError("out of memory")
+
+    scheduler = InferenceScheduler(None, max_batch_size=4, max_wait_ms=50, batch_fn=broken).start()
+    try:
+        futures = [scheduler.submit(x) for x in images(2).split(1)]
+        for future in futures:
+            with pytest.raises(RuntimeError, match="out of memory"):
+                future.result(timeout=5)
+    finally:
+        scheduler.stop()
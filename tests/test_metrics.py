@@ -0,0 +1,68 @@
+import re
+
+import pytest
+
+from src import metrics
+from tests.helpers import upload
+
+def sample(text, series, default=None):
+    """The value of `series` in the exposition `text`, or `default` when it has no line."""
+    values = [float(line.rsplit(" ", 1)[1]) for line in text.splitlines() if line.startswith(series + " ")]
+    if not values and default is not None:
+        return default
+    assert len(values) == 1, series
+    return values[0]
+
+def test_histograms_render_cumulative_buckets():
+    registry = metrics.Registry()
+    latency = registry.histogram("demo_seconds", "Demo latency.", ("stage",), buckets=(0.1, 1.0))
+    calls = registry.counter("demo_total", "Demo calls.", ("stage",))
+    for seconds in (0.05, 0.5, 5.0):
+        latency.observe(seconds, "forward")
+    calls.inc("forward", amount=3)
+
+    text = registry.render()
+    assert "# HELP demo_seconds Demo latency.\n# TYPE demo_seconds histogram\n" in text
+    assert "# TYPE demo_total counter" in text
+    assert sample(text, 'demo_seconds_bucket{stage="forward",le="0.1"}') == 1
+    assert sample(text, 'demo_seconds_bucket{stage="forward",le="1.0"}') == 2
+    assert sample(text, 'demo_seconds_bucket{stage="forward",le="+Inf"}') == 3
+    assert sample(text, 'demo_seconds_sum{stage="forward"}') == pytest.approx(5.55)
+    assert sample(text, 'demo_seconds_count{stage="forward"}') == 3
+    assert sample(text, 'demo_total{stage="forward"}') == 3
+
+def test_spans_time_stages_and_count_errors():
+    def count(stage):
+        text = metrics.registry.render()
+        return (sample(text, f'xray_stage_seconds_count{{stage="{stage}"}}', default=0),
+                sample(text, f'xray_stage_errors_total{{stage="{stage}"}}', default=0))
+
+    with metrics.span("test-stage"):
+        pass
+    with pytest.raises(ValueError):
+        with metrics.span("test-stage"):
+            raise ValueError
+    assert count("test-stage") == (2, 1)
+
+def test_metrics_route_and_request_ids(server):
+    client = server.app.test_client()
+    response = client.post("/analyze", data=upload(), headers={"X-Request-ID": "req-42"})
+    assert response.status_code == 200
+    assert response.headers["X-Request-ID"] == "req-42"
+    assert re.fullmatch(r"[0-9a-f]{32}", client.get("/health").headers["X-Request-ID"])
+
+    response = client.get("/metrics")
+    assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    text = response.get_data(as_text=True)
+    assert sample(text, 'xray_requests_total{endpoint="/analyze",method="POST",status="200"}') >= 1
+    assert sample(text, 'xray_request_seconds_count{endpoint="/analyze",method="POST"}') >= 1
+    # Heatmaps are encoded lazily, when /heatmaps is requested
+    for stage in ("upload", "preprocess", "forward", "serialize"):
+        assert sample(text, f'xray_stage_seconds_count{{stage="{stage}"}}') >= 1, stage
+
+def test_traces_add_server_timing(server, monkeypatch, capsys):
+    monkeypatch.setattr(metrics, "TRACE_REQUESTS", True)
+    response = server.app.test_client().post("/analyze", data=upload(), headers={"X-Request-ID": "traced"})
+    stages = [entry.split(";")[0] for entry in response.headers["Server-Timing"].split(", ")]
+    assert "upload" in stages and "serialize" in stages
+    assert '"request_id": "traced"' in capsys.readouterr().out
@@ -0,0 +1,92 @@
+import os
+import re
+import types
+
+import pytest
+import torch
+
+import src.model as model_module
+from src.model import export_artifact, load_artifact, load_model
+from tests.helpers import build_tiny_model
+
+def export_tiny(path, with_features):
+    export_artifact(build_tiny_model(), str(path), fmt="torchscript", with_features=with_features)
+    return str(path)
+
+def test_artifact_without_features_is_rejected_for_gradcam(tmp_path):
+    artifact = export_tiny(tmp_path / "logits.ts", with_features=False)
+    with pytest.raises(ValueError, match="no-features"):
+        load_artifact(build_tiny_model(), artifact)
+    assert not load_artifact(build_tiny_model(), artifact, require_features=False).with_features
+
+def test_load_model_falls_back_to_eager_without_features(tmp_path, monkeypatch):
+    monkeypatch.setattr(model_module, "build_model", build_tiny_model)
+    checkpoint = tmp_path / "tiny.pt"
+    torch.save(build_tiny_model().state_dict(), checkpoint)
+    artifact = export_tiny(tmp_path / "logits.ts", with_features=False)
+
+    model = load_model(str(checkpoint), artifact_path=artifact)
+    assert isinstance(model, model_module.CustomDenseNet)
+    model.features(torch.zeros(1, 3, 224, 224))
+
+    compiled = load_model(str(checkpoint), artifact_path=artifact, require_features=False)
+    assert isinstance(compiled, model_module.CompiledDenseNet)
+
+def test_artifact_with_features_serves_gradcam(tmp_path):
+    artifact = export_tiny(tmp_path / "full.ts", with_features=True)
+    compiled = load_artifact(build_tiny_model(), artifact)
+    x = torch.zeros(1, 3, 224, 224)
+    torch.testing.assert_close(compiled.features(x), build_tiny_model().features(x), atol=1e-5, rtol=1e-4)
+
+def legacy_state_dict(state_dict):
+    """A state dict as torchvision's DenseNet weights have it: 'norm.1'-style dense layer keys, no num_batches_tracked."""
+    return {
+        re.sub(r"(denselayer\d+\.(?:norm|relu|conv))([12])\.", r"\1.\2.", key): value
+        for key, value in state_dict.items() if not key.endswith("num_batches_tracked")
+    }
+
+def spy_on_torch_load(monkeypatch):
+    """Records every state dict torch.load returns, with its mmap flag."""
+    loaded = []
+    real_load = torch.load
+
+    def load(*args, **kwargs):
+        state_dict = real_load(*args, **kwargs)
+        loaded.append((kwargs.get("mmap", False), state_dict))
+        return state_dict
+
+    monkeypatch.setattr(torch, "load", load)
+    return loaded
+
+def test_legacy_keys_are_renamed(tiny_model):
+    state_dict = tiny_model.state_dict()
+    legacy = legacy_state_dict(state_dict)
+    assert "features.denseblock1.denselayer1.norm.1.weight" in legacy
+    expected = {key for key in state_dict if not key.endswith("num_batches_tracked")}
+    assert set(model_module._remap_legacy_keys(dict(legacy))) == expected
+
+def test_first_start_caches_the_checkpoint_and_later_starts_map_it(tmp_path, monkeypatch, tiny_model):
+    monkeypatch.setattr(model_module, "build_model", build_tiny_model)
+    weights = types.SimpleNamespace(get_state_dict=lambda progress: legacy_state_dict(tiny_model.state_dict()))
+    monkeypatch.setattr(model_module, "models", types.SimpleNamespace(DenseNet121_Weights=types.SimpleNamespace(DEFAULT=weights)))
+    checkpoint = str(tmp_path / "models" / "tiny.pt")
+    x = torch.zeros(1, 3, 224, 224)
+    expected = tiny_model(x)
+
+    torch.testing.assert_close(load_model(checkpoint, artifact_path=None)(x), expected)
+    assert os.path.exists(checkpoint)
+
+    # The downloaded weights are not needed any more
+    monkeypatch.setattr(weights, "get_state_dict", None)
+    loaded = spy_on_torch_load(monkeypatch)
+    copied = load_model(checkpoint, artifact_path=None)
+    mapped = load_model(checkpoint, mmap=True, artifact_path=None)
+    torch.testing.assert_close(copied(x), expected)
+    torch.testing.assert_close(mapped(x), expected)
+
+    # With mmap the parameters are the mapped tensors themselves, not copies
+    (copy_flag, copy_state), (mmap_flag, mmap_state) = loaded
+    assert (copy_flag, mmap_flag) == (False, True)
+    key = "features.conv0.weight"
+    assert copied.state_dict()[key].data_ptr() != copy_state[key].data_ptr()
+    assert mapped.state_dict()[key].data_ptr() == mmap_state[key].data_ptr()
@@ -0,0 +1,69 @@
+import pytest
+import torch
+
+import src.parity as parity
+from src.analyze import forward_features, gradcams_from_features
+from src.precision import optimize_model, optimized_copy
+from tests.helpers import build_tiny_model, write_image
+
+CLASSES = list(range(10))
+
+def randomized_norms(model):
+    """Non-trivial BatchNorm statistics, so that folding them into the convolutions changes the weights."""
+    torch.manual_seed(1)
+    with torch.no_grad():
+        for module in model.modules():
+            if isinstance(module, torch.nn.BatchNorm2d):
+                module.running_mean.normal_(0, 0.2)
+                module.running_var.uniform_(0.5, 1.5)
+    return model
+
+def images(n=4, seed=0):
+    torch.manual_seed(seed)
+    return torch.randn(n, 3, 224, 224)
+
+def outputs(model, x):
+    probs, features = forward_features(model, x)
+    return probs, gradcams_from_features(model, features, CLASSES)
+
+@pytest.mark.parametrize("precision, atol", [("fp32-fused", 1e-5), ("bf16", 0.02)])
+def test_precision_modes_match_fp32(precision, atol):
+    model = randomized_norms(build_tiny_model())
+    x = images()
+    probs, cams = outputs(model, x)
+    optimized = optimized_copy(model, precision)
+    assert optimized.features is not model.features
+    fast_probs, fast_cams = outputs(optimized, x)
+    torch.testing.assert_close(fast_probs, probs, atol=atol, rtol=0)
+    # The CAMs still use norm5's shift, frozen before the features were replaced
+    assert (fast_cams - cams).abs().mean() < max(atol, 1e-4) * 5
+
+def test_int8_is_calibrated_on_local_images(tmp_path):
+    calibration = tmp_path / "calibration"
+    for seed in range(4):
+        write_image(calibration / f"{seed}.png", seed, size=224)
+    model = randomized_norms(build_tiny_model())
+    x = images()
+    probs, _ = outputs(model, x)
+    quantized_probs, _ = outputs(optimized_copy(model, "int8", str(calibration)), x)
+    torch.testing.assert_close(quantized_probs, probs, atol=0.1, rtol=0)
+
+    with pytest.raises(ValueError, match="calibration"):
+        optimize_model(build_tiny_model(), "int8")
+    with pytest.raises(ValueError, match="Unknown precision"):
+        optimize_model(build_tiny_model(), "fp8")
+
+def test_parity_report_recommends_the_fastest_mode_within_tolerance(tmp_path, monkeypatch):
+    model = randomized_norms(build_tiny_model())
+    monkeypatch.setattr(parity, "load_model", lambda **kwargs: model)
+    for seed in range(3):
+        write_image(tmp_path / "reference" / f"{seed}.png", seed)
+
+    report = parity.run(parity.parse_args([str(tmp_path / "reference"), "--modes", "fp32,fp32-fused", "--batch-size", "2"]))
+    assert report["images"] == 3
+    assert report["modes"]["fp32"]["max_abs_diff"] == 0
+    assert report["modes"]["fp32-fused"]["detection_agreement"] == 1
+    assert report["recommended"] in ("fp32", "fp32-fused")
+
+    strict = parity.run(parity.parse_args([str(tmp_path / "reference"), "--modes", "bf16", "--tolerance", "0"]))
+    assert strict["recommended"] is None
@@ -0,0 +1,76 @@
+import importlib.util
+import json
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("fpdf")
+
+REPORT_GENERATOR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend", "app", "api", "demo_files", "report_generator.py")
+
+@pytest.fixture(scope="module")
+def report_generator():
+    spec = importlib.util.spec_from_file_location("report_generator", REPORT_GENERATOR)
+    # Registered so the PDF process pool can find render_pdf by name
+    module = sys.modules["report_generator"] = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def test_escaped_record_ids_do_not_share_a_pdf(report_generator, tmp_path):
+    ids = ["a/b", "a_b", "a:b", "plain-id.1"]
+    names = [report_generator.safe_record_id(record_id) for record_id in ids]
+    assert len(set(names)) == len(ids)
+    assert names[1] == "a_b" and names[3] == "plain-id.1"
+
+    source = tmp_path / "patients.jsonl"
+    source.write_text("".join(json.dumps({"id": record_id, "patient_details": {"name": record_id}}) + "\n" for record_id in ids))
+    output_dir = tmp_path / "reports"
+    args = report_generator.parse_args(["--batch", str(source), "-o", str(output_dir), "--stub", "--stub-latency", "0", "--pdf-workers", "1"])
+    report_generator.run_batch(args)
+    assert sorted(os.listdir(output_dir)) == sorted([f"{name}.pdf" for name in names] + ["errors.jsonl"])
+
+def test_single_report_keeps_its_one_block_layout(report_generator, tmp_path, monkeypatch):
+    cells = []
+
+    class RecordingFPDF(report_generator.FPDF):
+        def multi_cell(self, w, h, txt='', *args, **kwargs):
+            cells.append((h, txt))
+            return super().multi_cell(w, h, txt, *args, **kwargs)
+
+    monkeypatch.setattr(report_generator, "FPDF", RecordingFPDF)
+    text = "1. Potential Causes:\nStub content.\n\n2. Disclaimer:\nStub content."
+    assert report_generator.create_pdf_report("Report", text, str(tmp_path / "single.pdf"), quiet=True)
+    assert cells == [(10, text)]
+
+    cells.clear()
+    assert report_generator.create_pdf_report("Report", text, str(tmp_path / "batch.pdf"), quiet=True, sections=True)
+    assert [txt for _, txt in cells] == [line for line in text.split("\n") if line]
+
+def test_records_that_are_not_objects_fail_on_their_own(report_generator, tmp_path):
+    source = tmp_path / "patients.jsonl"
+    source.write_text('[1, 2]\n"text"\n{"id": "ok", "patient_details": {"name": "A"}}\n')
+    output_dir = tmp_path / "reports"
+    args = report_generator.parse_args(["--batch", str(source), "-o", str(output_dir), "--stub", "--stub-latency", "0", "--pdf-workers", "1"])
+    report_generator.run_batch(args)
+    assert sorted(os.listdir(output_dir)) == ["errors.jsonl", "ok.pdf"]
+    errors = [json.loads(line) for line in (output_dir / "errors.jsonl").read_text().splitlines()]
+    assert sorted(error["id"] for error in errors) == ["line-000001", "line-000002"]
+
+def test_a_failed_render_leaves_no_temporary_file(report_generator, tmp_path, monkeypatch):
+    def partial_pdf(title, report_text, filename, **kwargs):
+        with open(filename, "w") as f:
+            f.write("%PDF-")
+        return False
+
+    monkeypatch.setattr(report_generator, "create_pdf_report", partial_pdf)
+    with pytest.raises(RuntimeError):
+        report_generator.render_pdf("Report", "text", str(tmp_path / "a.pdf"))
+    assert os.listdir(tmp_path) == []
+
+def test_the_stub_is_the_api_servers(report_generator):
+    stub = report_generator.StubClient(latency=0)
+    assert type(stub.backend).__name__ == "StubBackend"
+    assert "Stub content" in stub.generate("prompt")
+    with pytest.raises(RuntimeError):
+        report_generator.StubClient(latency=0, failure_rate=1).generate("prompt")
@@ -0,0 +1,66 @@
+import base64
+import json
+
+import numpy as np
+
+from tests.helpers import upload
+
+def test_tta_cams_need_inline_heatmaps(server):
+    client = server.app.test_client()
+    response = client.post("/analyze?tta=3&tta_cams=1", data=upload())
+    assert response.status_code == 400
+    assert "heatmaps=inline" in response.get_json()["error"]
+
+    response = client.post("/analyze?tta=3&tta_cams=1&heatmaps=inline", data=upload())
+    assert response.status_code == 200
+    heatmaps = response.get_json()["heatmaps"]
+    assert heatmaps and all(h["image"] for h in heatmaps)
+
+def test_repeated_uploads_get_new_study_ids_for_the_same_study(server):
+    client = server.app.test_client()
+    first = client.post("/analyze", data=upload(seed=7)).get_json()
+    second = client.post("/analyze", data=upload(seed=7)).get_json()
+    assert first["study_id"] != second["study_id"]
+    assert first["predictions"] == second["predictions"]
+
+    computed = server.heatmap_store.cams_computed
+    for study in (first, second):
+        response = client.get(f"/heatmaps/{study['study_id']}/Edema?format=cam")
+        assert response.status_code == 200
+    # Both ids point at one stored study, whose CAM is computed once
+    assert server.heatmap_store.cams_computed == computed + 1
+
+def test_heatmaps_are_served_in_each_format(server):
+    client = server.app.test_client()
+    study = client.post("/analyze", data=upload(seed=3)).get_json()
+    assert "image" not in json.dumps(study["heatmaps"])
+    base = f"/heatmaps/{study['study_id']}/Mass"
+
+    signatures = {"png": b"\x89PNG", "jpeg": b"\xff\xd8", "webp": b"RIFF"}
+    for fmt, signature in signatures.items():
+        response = client.get(f"{base}?format={fmt}&quality=50")
+        assert response.status_code == 200
+        assert response.mimetype == f"image/{fmt}" and response.data.startswith(signature)
+
+    response = client.get(f"{base}?format=cam")
+    shape = tuple(int(d) for d in response.headers["X-CAM-Shape"].split(","))
+    cam = np.frombuffer(response.data, dtype="<f2").reshape(shape)
+    assert response.headers["X-CAM-Dtype"] == "float16"
+    assert cam.min() >= 0 and cam.max() <= 1
+
+    assert client.get(f"{base}?format=gif").status_code == 400
+    assert client.get(f"{base}?quality=high").status_code == 400
+    assert client.get("/heatmaps/0123abcd/Mass").status_code == 404
+
+def test_study_gradcams_stream_in_the_requested_order(server):
+    client = server.app.test_client()
+    study_id = client.post("/analyze", data=upload(seed=4)).get_json()["study_id"]
+    response = client.get(f"/studies/{study_id}/gradcam?diseases=Edema,Atelectasis&format=cam")
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert [line["disease"] for line in lines] == ["Edema", "Atelectasis"]
+    for line in lines:
+        cam = np.frombuffer(base64.b64decode(line["data"]), dtype="<f2")
+        assert cam.size == np.prod(line["shape"])
+
+    assert client.get(f"/studies/{study_id}/gradcam?diseases=Unknown").status_code == 400
+    assert client.get("/studies/0123abcd/gradcam").status_code == 404
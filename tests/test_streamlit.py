@@ -0,0 +1,46 @@
+import base64
+import io
+
+from PIL import Image
+
+from src.analyze import (
+    CLASSES, create_heatmap_figs, create_probability_fig, detected_diseases, get_predictions, get_predictions_for_api
+)
+from tests.helpers import upload
+
+def upload_bytes(seed=0):
+    return upload(seed)["file"][0].getvalue()
+
+def test_findings_follow_the_api_rounding():
+    results = dict.fromkeys(CLASSES, 0.1)
+    # 50.4% rounds to 50%, which /analyze does not report
+    results.update({"Edema": 0.504, "Mass": 0.506, "Effusion": 0.9})
+    assert list(detected_diseases(results).items()) == [("Effusion", 0.9), ("Mass", 0.506)]
+
+def test_the_app_shows_what_the_api_returns(tiny_model):
+    image_bytes = upload_bytes()
+    results, image, features = get_predictions(image_bytes, tiny_model)
+    assert list(results) == CLASSES
+    assert image.shape == (224, 224, 3) and features is not None
+
+    predictions, heatmaps = get_predictions_for_api(image_bytes, tiny_model)
+    detected = detected_diseases(results)
+    assert {p["name"]: p["confidence"] for p in predictions} == {c: round(p * 100) for c, p in results.items()}
+    # The findings and their overlays are /analyze's, from the same forward pass
+    figs = create_heatmap_figs(list(detected), features, tiny_model, image)
+    assert list(figs) == [h["disease"] for h in heatmaps]
+    assert all(figs[h["disease"]] == base64.b64decode(h["image"]) for h in heatmaps)
+    assert Image.open(io.BytesIO(next(iter(figs.values())))).size == (224, 224)
+    assert create_heatmap_figs([], features, tiny_model, image) == {}
+
+def test_unreadable_uploads_have_no_results(tiny_model):
+    assert get_predictions(b"not an image", tiny_model) == (None, None, None)
+
+def test_probability_chart_highlights_the_findings():
+    results = dict.fromkeys(CLASSES, 0.1)
+    results.update({"Edema": 0.504, "Mass": 0.506, "Effusion": 0.9})
+    spec = create_probability_fig(results, title="Findings")
+    values = spec["data"]["values"]
+    assert [v["pathology"] for v in values[:3]] == ["Effusion", "Mass", "Edema"]
+    assert [v["pathology"] for v in values if v["detected"]] == list(detected_diseases(results))
+    assert values[0]["confidence"] == 90.0 and spec["title"] == "Findings"
@@ -0,0 +1,32 @@
+import io
+
+import numpy as np
+import torch
+from PIL import Image
+from werkzeug.datastructures import FileStorage
+
+from src.utils import INPUT_SIZE, preprocess_image
+from tests.helpers import upload, write_image
+
+def test_uploads_decode_from_memory_like_files_on_disk(tmp_path):
+    path = write_image(tmp_path / "xray.png", seed=3)
+    with open(path, "rb") as f:
+        data = f.read()
+    expected, expected_image = preprocess_image(path)
+    assert expected.shape == (1, 3, INPUT_SIZE, INPUT_SIZE)
+    for image in (data, bytearray(data), memoryview(data), io.BytesIO(data), np.array(Image.open(path))):
+        x_tensor, resized = preprocess_image(image)
+        torch.testing.assert_close(x_tensor, expected)
+        np.testing.assert_array_equal(resized, expected_image)
+
+def test_unreadable_uploads_are_rejected():
+    assert preprocess_image(b"not an image") == (None, None)
+
+def test_analyze_never_writes_the_upload_to_disk(server, monkeypatch):
+    def no_save(*args, **kwargs):
+        raise AssertionError("the upload was saved to disk")
+
+    monkeypatch.setattr(FileStorage, "save", no_save)
+    response = server.app.test_client().post("/analyze?heatmaps=inline", data=upload(seed=11))
+    assert response.status_code == 200
+    assert response.get_json()["predictions"]
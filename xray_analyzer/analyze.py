@@ -1,11 +1,12 @@
 import torch
 import cv2
 import numpy as np
-from PIL import Image
 import base64
 from io import BytesIO
 
 from utils import preprocess_image
+from render import HeatmapRenderer, get_renderer
+from metrics import span
 
 CLASSES = [
     "Atelectasis", "Cardiomegaly", "Effusion", "Infiltration",
@@ -13,78 +14,204 @@ CLASSES = [
     "Consolidation", "Edema"
 ]
 
-def generate_gradcam(model, input_tensor, target_class, original_image_np):
+def find_target_layer(model):
+    for layer in reversed(list(model.features.modules())):
+        if isinstance(layer, torch.nn.Conv2d):
+            return layer
+    return None
+
+def generate_gradcams(model, input_tensor, target_classes, target_layer=None):
+    """
+    One forward pass, Grad-CAMs for all target classes at once (see src/analyze.py).
+    `target_classes` is a list of class indices or a callable over the probabilities.
+    Models with `cam_weights` get the CAMs in closed form, without autograd; pass `target_layer`
+    (or use another model) for the hook and backward pass.
+    Returns (cams [batch, targets, h, w], probabilities, target classes).
+    """
     model.eval()
-    features, gradients = [], []
+    if target_layer is None and hasattr(model, "cam_weights"):
+        return _closed_form_gradcams(model, input_tensor, target_classes)
+    target_layer = target_layer or find_target_layer(model)
+    if target_layer is None: return None, None, []
 
-    def forward_hook(module, input, output): features.append(output)
-    def backward_hook(module, grad_in, grad_out): gradients.append(grad_out[0])
+    features = []
 
-    last_conv_layer = None
-    for layer in reversed(list(model.features.modules())):
-        if isinstance(layer, torch.nn.Conv2d):
-            last_conv_layer = layer
-            break
-    
-    if not last_conv_layer: return None
+    def forward_hook(module, input, output):
+        output = output.detach().requires_grad_(True)
+        features.append(output)
+        return output
 
-    h1 = last_conv_layer.register_forward_hook(forward_hook)
-    h2 = last_conv_layer.register_full_backward_hook(backward_hook)
+    handle = target_layer.register_forward_hook(forward_hook)
+    try:
+        with span("forward"), torch.enable_grad():
+            output = model(input_tensor.detach())
+    finally:
+        handle.remove()
 
-    input_tensor.requires_grad_(True)
-    model.zero_grad()
-    output = model(input_tensor)
-    loss = output[0, target_class]
-    loss.backward()
+    probs = torch.sigmoid(output.detach())
+    feature_map = features[0]
+    if callable(target_classes): target_classes = target_classes(probs)
+    target_classes = list(target_classes)
+    if not target_classes:
+        return feature_map.new_zeros((feature_map.shape[0], 0) + feature_map.shape[2:]), probs, []
 
-    feature_map = features[0][0].detach()
-    grads = gradients[0][0].detach()
+    with span("gradcam"):
+        scores = output[:, target_classes]
+        num_targets = len(target_classes)
+        grad_outputs = torch.eye(num_targets, dtype=scores.dtype, device=scores.device)
+        grad_outputs = grad_outputs.unsqueeze(1).expand(num_targets, *scores.shape)
+        try:
+            grads, = torch.autograd.grad(scores, feature_map, grad_outputs=grad_outputs, is_grads_batched=True)
+        except RuntimeError:
+            grads = torch.stack([
+                torch.autograd.grad(scores, feature_map, grad_outputs=grad_outputs[k], retain_graph=True)[0]
+                for k in range(num_targets)
+            ])
 
-    weights = torch.mean(grads, dim=[1, 2])
-    cam = torch.zeros(feature_map.shape[1:], dtype=torch.float32)
-    for i, w in enumerate(weights):
-        cam += w * feature_map[i, :, :]
+        weights = grads.mean(dim=(3, 4))
+        cams = HeatmapRenderer.normalize(torch.einsum('kbc,bchw->bkhw', weights, feature_map.detach()))
+    return cams, probs, target_classes
 
-    cam = torch.maximum(cam, torch.tensor(0.0)).cpu().numpy()
-    if np.max(cam) > 0: cam = cam / np.max(cam)
-    
-    h1.remove(); h2.remove()
-    
-    heatmap = cv2.resize(cam, (original_image_np.shape[1], original_image_np.shape[0]))
-    heatmap = np.uint8(255 * heatmap)
-    heatmap = cv2.applyColorMap(heatmap, cv2.COLORMAP_JET)
+def _closed_form_gradcams(model, input_tensor, target_classes):
+    with span("forward"), torch.no_grad():
+        features = model.features(input_tensor)
+        probs = torch.sigmoid(model.head(features))
+    if callable(target_classes): target_classes = target_classes(probs)
+    target_classes = list(target_classes)
+    if not target_classes:
+        return features.new_zeros((features.shape[0], 0) + features.shape[2:]), probs, []
 
-    original_image_bgr = cv2.cvtColor(np.array(original_image_np), cv2.COLOR_RGB2BGR)
-    superimposed_img = cv2.addWeighted(original_image_bgr, 0.6, heatmap, 0.4, 0)
-    
-    return superimposed_img
-
-def get_predictions_for_api(image_path, model):
-    x_tensor, original_image = preprocess_image(image_path)
-    if x_tensor is None: return None, None
-        
-    with torch.no_grad():
-        pred = torch.sigmoid(model(x_tensor))
+    with span("gradcam"), torch.no_grad():
+        weights = model.cam_weights(features, target_classes)
+        cams = HeatmapRenderer.normalize(torch.einsum('bkc,bchw->bkhw', weights, model.cam_activations(features)))
+    return cams, probs, target_classes
+
+def overlay_heatmaps(cams, original_image_np):
+    """All (classes, h, w) CAMs over the RGB image at once; the result is reused by the next call (see render.py)."""
+    return get_renderer().render(cams, cv2.cvtColor(np.array(original_image_np), cv2.COLOR_RGB2BGR))
+
+def overlay_heatmap(cam, original_image_np):
+    return overlay_heatmaps(np.asarray(cam)[None], original_image_np)[0].copy()
+
+def generate_gradcam(model, input_tensor, target_class, original_image_np):
+    cams, _, _ = generate_gradcams(model, input_tensor, [target_class])
+    if cams is None: return None
+    return overlay_heatmap(cams[0, 0].cpu().numpy(), original_image_np)
+
+def detected_classes(pred):
+    pred = pred[:len(CLASSES)]
+    detected = [i for i, prob in enumerate(pred) if round(float(prob) * 100) > 50]
+    return sorted(detected, key=lambda i: pred[i], reverse=True)
+
+def predict_batch(model, x_batch):
+    """Returns (probabilities, {class index: CAM}) for every image of the batch."""
+    def batch_targets(probs):
+        return sorted(set(c for pred in probs.cpu().numpy() for c in detected_classes(pred)))
+
+    cams, probs, target_classes = generate_gradcams(model, x_batch, batch_targets)
+    if probs is None: return None
+
+    cams = cams.cpu().numpy()
+    probs = probs.cpu().numpy()[:, :len(CLASSES)]
+    return [
+        (pred, {c: cams[i, target_classes.index(c)] for c in detected_classes(pred)})
+        for i, pred in enumerate(probs)
+    ]
+
+def predict_image(image, model, scheduler=None, preprocess_pool=None):
+    """
+    Returns (predictions json, {class index: CAM}, resized image) for one image, or None if it can't be read.
+    `image` can be a path, raw bytes, a file-like object or a decoded array; it is decoded on the
+    PreprocessPool when one is given (queue.Full when the pool is saturated).
+    """
+    with span("preprocess"):
+        if preprocess_pool is not None:
+            x_tensor, original_image = preprocess_pool.preprocess(image, block=False)
+        else:
+            x_tensor, original_image = preprocess_image(image)
+    if x_tensor is None: return None
+
+    # Forward + Grad-CAMs, including the wait for a batch when a scheduler is given
+    with span("inference"):
+        if scheduler is not None:
+            pred, cams = scheduler.predict(x_tensor)
+        else:
+            results = predict_batch(model, x_tensor)
+            if results is None: return None
+            pred, cams = results[0]
     
-    pred = pred.cpu().numpy()[0][:len(CLASSES)]
+    return predictions_json(pred), cams, original_image
+
+def predictions_json(pred):
+    """The predictions json of /analyze: every class with its confidence in %, most confident first."""
     results = {label: float(prob) for label, prob in zip(CLASSES, pred)}
     
     sorted_results = sorted(results.items(), key=lambda item: item[1], reverse=True)
-    predictions_json = [{"name": label, "confidence": round(prob * 100)} for label, prob in sorted_results]
-    
-    heatmaps_json = []
-    detected_diseases = [p for p in predictions_json if p['confidence'] > 50]
-
-    if detected_diseases:
-        for disease in detected_diseases:
-            target_class_index = CLASSES.index(disease['name'])
-            superimposed_img = generate_gradcam(model, x_tensor, target_class_index, np.array(original_image))
-            
-            if superimposed_img is not None:
-                is_success, buffer = cv2.imencode(".png", superimposed_img)
-                if is_success:
-                    img_bytes = BytesIO(buffer)
-                    base64_string = base64.b64encode(img_bytes.read()).decode()
-                    heatmaps_json.append({"disease": disease['name'], "image": base64_string})
-
-    return predictions_json, heatmaps_json
\ No newline at end of file
+    return [{"name": label, "confidence": round(prob * 100)} for label, prob in sorted_results]
+
+def encode_heatmaps(cams, original_image):
+    """Yields {"disease", "image": base64 PNG} for each CAM, one at a time, so callers can stream them."""
+    if not cams: return
+    # A copy: between two steps of this generator the thread's renderer may draw another request's overlays
+    superimposed_imgs = overlay_heatmaps(np.stack(list(cams.values())), original_image).copy()
+    for target_class_index, superimposed_img in zip(cams, superimposed_imgs):
+        with span("encode"):
+            is_success, buffer = cv2.imencode(".png", superimposed_img)
+            if is_success:
+                img_bytes = BytesIO(buffer)
+                base64_string = base64.b64encode(img_bytes.read()).decode()
+        if is_success:
+            yield {"disease": CLASSES[target_class_index], "image": base64_string}
+
+def get_predictions_for_api(image, model, scheduler=None, preprocess_pool=None):
+    result = predict_image(image, model, scheduler, preprocess_pool)
+    if result is None: return None, None
+    predictions_json, cams, original_image = result
+    return predictions_json, list(encode_heatmaps(cams, original_image))
+
+# --- Streamlit app ---
+def get_predictions(image, model):
+    """
+    One pass over an image (path, bytes, file-like or array): ({class: probability}, resized image,
+    {disease: CAM} of the detected classes), or (None, None, None) if the image can't be read.
+    """
+    x_tensor, original_image = preprocess_image(image)
+    if x_tensor is None: return None, None, None
+    results = predict_batch(model, x_tensor)
+    if results is None: return None, None, None
+    pred, cams = results[0]
+    probabilities = {label: float(prob) for label, prob in zip(CLASSES, pred)}
+    return probabilities, original_image, {CLASSES[c]: cam for c, cam in cams.items()}
+
+def create_probability_fig(results, title=None):
+    """A Vega-Lite bar chart of the class probabilities (for st.vega_lite_chart), most confident first."""
+    values = [
+        {"pathology": label, "confidence": round(prob * 100, 1), "detected": round(prob * 100) > 50}
+        for label, prob in sorted(results.items(), key=lambda item: item[1], reverse=True)
+    ]
+    spec = {
+        "data": {"values": values},
+        "mark": {"type": "bar", "cornerRadiusEnd": 3},
+        "encoding": {
+            "y": {"field": "pathology", "type": "nominal", "sort": None, "title": None},
+            "x": {"field": "confidence", "type": "quantitative", "title": "Confidence (%)", "scale": {"domain": [0, 100]}},
+            "color": {
+                "field": "detected", "type": "nominal", "legend": None,
+                "scale": {"domain": [False, True], "range": ["#3498DB", "#E74C3C"]},
+            },
+            "tooltip": [{"field": "pathology"}, {"field": "confidence", "title": "Confidence (%)"}],
+        },
+    }
+    if title: spec["title"] = title
+    return spec
+
+def create_heatmap_figs(diseases, cams, original_image):
+    """Overlays of the given diseases' CAMs (from get_predictions) as {disease: PNG bytes}, ready for st.image."""
+    diseases = [d for d in diseases if d in cams]
+    if not diseases: return {}
+    overlays = overlay_heatmaps(np.stack([cams[d] for d in diseases]), original_image)
+    figs = {}
+    for disease, overlay in zip(diseases, overlays):
+        is_success, buffer = cv2.imencode(".png", overlay)
+        if is_success: figs[disease] = buffer.tobytes()
+    return figs
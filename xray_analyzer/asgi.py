@@ -0,0 +1,274 @@
+"""
+ASGI variant of the API server in main.py, on Starlette, for many slow connections in one process.
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+    python asgi.py
+
+Same routes, requests and responses as main.py, without a thread per request. Request bodies are
+read as the client sends them, uploads are decoded on the PreprocessPool, heatmap encoding runs on
+a small dedicated thread pool, forward passes are batched on the scheduler's thread, and reports are
+streamed from the provider's async API on the event loop. A slow upload or a slow report then only holds a coroutine.
+"""
+import asyncio
+import json
+import os
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+# Loads and warms up the model and starts the batching scheduler, shared with main.py
+from server_state import (
+    REPORT_CONCURRENCY, REPORT_JOB_TTL_SECONDS, REPORT_MAX_PENDING, STARTUP_METRICS,
+    allowed_file, astream_cached_report, log_internal_error, preprocess_pool, report_cache, scheduler
+)
+from analyze import encode_heatmaps, predictions_json
+from report_jobs import AsyncReportJobQueue
+from metrics import METRICS_ENABLED, registry, span, starlette_middleware
+
+# Threads for the heatmap encoding; uploads are decoded on the PreprocessPool
+ASGI_CPU_WORKERS = int(os.environ.get('ASGI_CPU_WORKERS', 2))
+ASGI_MAX_UPLOAD_MB = int(os.environ.get('ASGI_MAX_UPLOAD_MB', 16))
+KEEPALIVE_SECONDS = 15
+
+cpu_executor = ThreadPoolExecutor(max_workers=ASGI_CPU_WORKERS, thread_name_prefix="asgi-cpu")
+report_jobs = AsyncReportJobQueue(astream_cached_report, REPORT_CONCURRENCY, REPORT_MAX_PENDING, REPORT_JOB_TTL_SECONDS)
+
+def error_response(message, status):
+    return JSONResponse({"error": message}, status)
+
+async def run_cpu(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(cpu_executor, fn, *args)
+
+# --- Pipeline ---
+
+async def predict_upload(image_bytes):
+    """predict_image off the event loop: decoded on the PreprocessPool, batched forward on the scheduler's thread."""
+    with span("preprocess"):
+        decoded = await asyncio.wrap_future(preprocess_pool.submit(image_bytes, block=False))
+    x_tensor, original_image = preprocess_pool.to_tensor(decoded)
+    if x_tensor is None:
+        return None
+    # The scheduler's Future resolves on its thread; awaiting it holds no thread here
+    with span("inference"):
+        pred, cams = await asyncio.wrap_future(scheduler.submit(x_tensor))
+    return predictions_json(pred), cams, original_image
+
+async def aencode_heatmaps(cams, original_image):
+    """
+    encode_heatmaps with each heatmap encoded on the CPU pool. Its steps can run on different pool
+    threads, interleaved with other requests, which is why encode_heatmaps works on its own copy of the overlays.
+    """
+    heatmaps = encode_heatmaps(cams, original_image)
+    while True:
+        heatmap = await run_cpu(next, heatmaps, None)
+        if heatmap is None:
+            return
+        yield heatmap
+
+def check_body_size(request, limit=ASGI_MAX_UPLOAD_MB * 1024 * 1024):
+    """
+    Rejects a body over `limit` bytes before reading it: 400 for a malformed Content-Length, 411 without
+    one (the server never accepts more than the declared length), 413 past the limit.
+    """
+    try:
+        length = int(request.headers["content-length"])
+    except KeyError:
+        raise HTTPException(411, "Content-Length required")
+    except ValueError:
+        raise HTTPException(400, "Malformed Content-Length header")
+    if length < 0:
+        raise HTTPException(400, "Malformed Content-Length header")
+    if length > limit:
+        raise HTTPException(413, "Request body too large")
+
+async def read_upload(request):
+    """The upload of a multipart request as (form, image bytes), or an error response, like main.py's checks."""
+    check_body_size(request)
+    with span("upload"):
+        form = await request.form()
+        file = form.get('file')
+        if file is None or isinstance(file, str):
+            return None, error_response("No file part", 400)
+        if not file.filename:
+            return None, error_response("No file selected", 400)
+        if not allowed_file(file.filename):
+            return None, error_response("File type not allowed", 400)
+        image_bytes = await file.read()
+    return (form, image_bytes), None
+
+# --- API ROUTES ---
+
+async def health(request):
+    return JSONResponse({"status": "ready", "startup": STARTUP_METRICS, "reports": report_jobs.stats(), "report_cache": report_cache.stats()})
+
+async def metrics_route(request):
+    return Response(registry.render(), media_type="text/plain; version=0.0.4")
+
+async def analyze_image(request):
+    request_start = time.perf_counter()
+    upload, error = await read_upload(request)
+    if error:
+        return error
+    try:
+        result = await predict_upload(upload[1])
+        if result is None: return error_response("Could not process image", 500)
+        predictions, cams, original_image = result
+        heatmaps = [heatmap async for heatmap in aencode_heatmaps(cams, original_image)]
+        if STARTUP_METRICS["first_request_seconds"] is None:
+            STARTUP_METRICS["first_request_seconds"] = round(time.perf_counter() - request_start, 4)
+        with span("serialize"):
+            return JSONResponse({"predictions": predictions, "heatmaps": heatmaps})
+    except queue.Full:
+        return error_response("Server is busy, please retry shortly", 503)
+    except Exception:
+        return error_response(log_internal_error("/analyze"), 500)
+
+async def generate_report_job(request):
+    """Queues a report and returns its job id at once (202); poll /reports/<id> or follow /reports/<id>/events."""
+    check_body_size(request)
+    try:
+        patient_data = json.loads(await request.body() or b"null")
+    except ValueError:
+        patient_data = None
+    if not patient_data:
+        return error_response("No patient data provided", 400)
+
+    try:
+        job_id = report_jobs.submit(patient_data, key=report_cache.make_key(patient_data))
+    except queue.Full:
+        return error_response("Too many reports in progress, please retry shortly", 503)
+    print(f"Queued report job {job_id}")
+    return JSONResponse({
+        "job_id": job_id,
+        "status": "queued",
+        "status_url": f"/reports/{job_id}",
+        "events_url": f"/reports/{job_id}/events"
+    }, 202)
+
+async def get_report(request):
+    job = report_jobs.get(request.path_params["job_id"])
+    if job is None: return error_response("Unknown or expired report job", 404)
+    return JSONResponse(job.to_json())
+
+async def report_events(request):
+    """The server-sent events of main.py's /reports/<id>/events: `status`, `chunk`s, then `done` or `failed`."""
+    job = report_jobs.get(request.path_params["job_id"])
+    if job is None: return error_response("Unknown or expired report job", 404)
+
+    async def generate():
+        yield f"event: status\ndata: {json.dumps(job.to_json())}\n\n"
+        sent = 0
+        while True:
+            chunks = await job.wait_for_chunks(sent, timeout=KEEPALIVE_SECONDS)
+            for chunk in chunks:
+                yield f"event: chunk\ndata: {json.dumps({'text': chunk})}\n\n"
+            sent += len(chunks)
+            if job.done.is_set() and sent == len(job.chunks):
+                break
+            if not chunks:
+                yield ": keep-alive\n\n"
+        event = "done" if job.status == "done" else "failed"
+        yield f"event: {event}\ndata: {json.dumps(job.to_json())}\n\n"
+
+    return StreamingResponse(generate(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+async def analyze_and_report(request):
+    """main.py's /analyze-and-report: NDJSON `predictions`, `heatmap`s and `report_chunk`s, then `report_done` or `report_failed`."""
+    request_start = time.perf_counter()
+    upload, error = await read_upload(request)
+    if error:
+        return error
+    form, image_bytes = upload
+    try:
+        patient_data = json.loads(form.get('patient') or 'null')
+    except (TypeError, ValueError):
+        return error_response("patient must be a JSON object", 400)
+    if not isinstance(patient_data, dict) or not patient_data:
+        return error_response("No patient data provided", 400)
+
+    try:
+        result = await predict_upload(image_bytes)
+        if result is None: return error_response("Could not process image", 500)
+        predictions, cams, original_image = result
+        report_data = dict(patient_data, xray_findings=predictions)
+        job_id = report_jobs.submit(report_data, key=report_cache.make_key(report_data))
+    except queue.Full:
+        return error_response("Server is busy, please retry shortly", 503)
+    except Exception:
+        return error_response(log_internal_error("/analyze-and-report"), 500)
+    job = report_jobs.get(job_id)
+
+    def event(name, **fields):
+        return json.dumps(dict(fields, event=name)) + "\n"
+
+    async def generate():
+        yield event("predictions", predictions=predictions, job_id=job_id,
+                    seconds=round(time.perf_counter() - request_start, 3))
+        sent = 0
+        async for heatmap in aencode_heatmaps(cams, original_image):
+            yield event("heatmap", **heatmap)
+            # Forward whatever the report produced meanwhile, without waiting
+            for chunk in job.chunks[sent:]:
+                yield event("report_chunk", text=chunk)
+                sent += 1
+        while not (job.done.is_set() and sent == len(job.chunks)):
+            for chunk in await job.wait_for_chunks(sent, timeout=KEEPALIVE_SECONDS):
+                yield event("report_chunk", text=chunk)
+                sent += 1
+        seconds = round(time.perf_counter() - request_start, 3)
+        if job.status == "done":
+            yield event("report_done", report_text=job.report_text, seconds=seconds)
+        else:
+            yield event("report_failed", error=job.error, seconds=seconds)
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+async def http_error(request, exc):
+    """Starlette's own errors (unknown route, wrong method, body checks) in the API's {"error": ...} shape."""
+    return JSONResponse({"error": exc.detail}, exc.status_code, headers=exc.headers)
+
+# --- ASGI APPLICATION ---
+
+routes = [
+    Route("/health", health),
+    Route("/analyze", analyze_image, methods=["POST"]),
+    Route("/generate-report", generate_report_job, methods=["POST"]),
+    Route("/reports/{job_id}", get_report),
+    Route("/reports/{job_id}/events", report_events),
+    Route("/analyze-and-report", analyze_and_report, methods=["POST"]),
+]
+if METRICS_ENABLED:
+    routes.append(Route("/metrics", metrics_route))
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    await report_jobs.close()
+    scheduler.stop()
+    cpu_executor.shutdown(wait=False)
+    preprocess_pool.close()
+
+# CORS for any origin, like flask_cors does for main.py; metrics and X-Request-ID like metrics.init_app
+app = Starlette(
+    routes=routes,
+    middleware=[Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])] + starlette_middleware(),
+    exception_handlers={HTTPException: http_error},
+    lifespan=lifespan,
+)
+
+# --- MAIN EXECUTION ---
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit("❌ The ASGI server needs uvicorn: pip install uvicorn")
+    print("--- Starting ASGI API server at http://127.0.0.1:5000 ---")
+    uvicorn.run(app, host='0.0.0.0', port=5000)
@@ -1,20 +1,52 @@
-import google.generativeai as genai
+import asyncio
 import os
 import json
+import random
+import threading
+import time
 from dotenv import load_dotenv # ✨ 1. Import load_dotenv
 
+from metrics import record, span
+
 load_dotenv() # ✨ 2. Load the variables from your .env file
 
 # --- Configuration ---
 # ✨ 3. Read the key securely from the environment
 API_KEY = os.environ.get("GEMINI_API_KEY")
+GEMINI_MODEL = os.environ.get("GEMINI_MODEL", "gemini-1.5-flash-latest")
+# "gemini" calls the API; "stub" returns a canned report offline (tests, load tests, demos)
+REPORT_BACKEND = os.environ.get("REPORT_BACKEND", "gemini")
+STUB_LATENCY_SECONDS = float(os.environ.get("STUB_LATENCY_SECONDS", 0.5))
+# Load testing: latency spread (sigma of a lognormal around STUB_LATENCY_SECONDS, 0 = constant) and
+# the fraction of calls failing before any output (like a 429/503) or midway through the stream
+STUB_LATENCY_SIGMA = float(os.environ.get("STUB_LATENCY_SIGMA", 0))
+STUB_ERROR_RATE = float(os.environ.get("STUB_ERROR_RATE", 0))
+STUB_STREAM_ERROR_RATE = float(os.environ.get("STUB_STREAM_ERROR_RATE", 0))
+
+# Bump whenever the template in generate_prompt changes; part of the report cache key
+PROMPT_VERSION = "1"
+
+def format_findings(predictions):
+    """The chest X-ray findings paragraph of the prompt, from /analyze's predictions json."""
+    detected = [f"{p['name']} ({p['confidence']}%)" for p in predictions if p["confidence"] > 50]
+    findings = ", ".join(detected) if detected else "no pathology above 50% confidence"
+    return (
+        "\n\n    A chest X-ray of this patient was analyzed by an AI model (DenseNet-121). "
+        f"Detected findings: {findings}. Take these imaging findings into account."
+    )
 
 def generate_prompt(patient_data):
-    """Generates the prompt for the Gemini API from a dictionary."""
+    """
+    Generates the prompt for the Gemini API from a dictionary.
+    An "xray_findings" entry (the predictions json of /analyze) becomes its own paragraph.
+    """
+    patient_data = dict(patient_data)
+    findings = patient_data.pop("xray_findings", None)
     patient_data_str = json.dumps(patient_data, indent=2)
+    findings_str = format_findings(findings) if findings is not None else ""
     prompt = f"""
     Based on the following patient data:
-    {patient_data_str}
+    {patient_data_str}{findings_str}
 
     Please provide a structured medical analysis report covering the following sections. Use clear headings for each section.
     1. **Potential Illnesses or Conditions:** Analyze the symptoms, medical history, and lab results to suggest potential conditions.
@@ -26,27 +58,145 @@ def generate_prompt(patient_data):
     """
     return prompt
 
+def clean_report_text(text):
+    """Strips the markdown emphasis from the response for better display."""
+    return text.replace('**', '').replace('*', '')
+
+def clean_report_chunks(chunks):
+    """
+    clean_report_text for a stream of chunks. The cleaning drops every asterisk, which gives the
+    same result chunk by chunk as on the whole text, so a `**` split across two chunks needs no
+    carry-over. Empty chunks are skipped.
+    """
+    for chunk in chunks:
+        chunk = chunk.replace('*', '')
+        if chunk:
+            yield chunk
+
+# --- Backends ---
+
+class GeminiBackend:
+    """The Gemini client, configured once and shared by every report."""
+    def __init__(self, api_key=API_KEY, model_name=GEMINI_MODEL):
+        if not api_key or api_key == "YOUR_GEMINI_API_KEY_HERE":
+            raise RuntimeError("The Gemini API key is not configured on the server.")
+        import google.generativeai as genai
+        genai.configure(api_key=api_key)
+        self.model = genai.GenerativeModel(model_name)
+
+    def stream(self, prompt):
+        """Yields the response text chunk by chunk, as the provider streams it."""
+        for chunk in self.model.generate_content(prompt, stream=True):
+            yield chunk.text
+
+    async def astream(self, prompt):
+        """stream over the client's async API: no thread is held while waiting for the provider."""
+        response = await self.model.generate_content_async(prompt, stream=True)
+        async for chunk in response:
+            yield chunk.text
+
+class StubBackend:
+    """
+    Offline stand-in for Gemini: streams a canned report in the same format, in small chunks
+    spread over `latency_seconds`. For load tests the latency can be drawn from a lognormal
+    (`latency_sigma`), and calls can fail up front (`error_rate`) or mid-stream (`stream_error_rate`).
+    """
+    def __init__(self, latency_seconds=STUB_LATENCY_SECONDS, chunk_size=48, latency_sigma=STUB_LATENCY_SIGMA,
+                 error_rate=STUB_ERROR_RATE, stream_error_rate=STUB_STREAM_ERROR_RATE):
+        self.latency_seconds = latency_seconds
+        self.chunk_size = chunk_size
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.stream_error_rate = stream_error_rate
+
+    def _plan(self, prompt):
+        """Draws this call's outcome: returns its chunks, the delay before each one and the chunk it fails at (or None)."""
+        if random.random() < self.error_rate:
+            raise RuntimeError("stub: simulated provider error")
+        latency = self.latency_seconds
+        if self.latency_sigma > 0:
+            latency *= random.lognormvariate(0, self.latency_sigma)
+        sections = [
+            "Potential Illnesses or Conditions", "Potential Causes", "Recommended Precautions",
+            "Potential Risk Factors", "Medication Suggestions", "Disclaimer",
+        ]
+        body = "\n\n".join(
+            f"**{i}. {title}:**\n* Stub content for offline testing ({len(prompt)} prompt characters)."
+            for i, title in enumerate(sections, 1)
+        )
+        text = "**Medical Analysis Report (stub)**\n\n" + body
+        chunks = [text[i:i + self.chunk_size] for i in range(0, len(text), self.chunk_size)]
+        interrupt_at = len(chunks) // 2 if random.random() < self.stream_error_rate else None
+        return chunks, latency / len(chunks), interrupt_at
+
+    def stream(self, prompt):
+        chunks, delay, interrupt_at = self._plan(prompt)
+        for i, chunk in enumerate(chunks):
+            if i == interrupt_at:
+                raise RuntimeError("stub: simulated stream interruption")
+            time.sleep(delay)
+            yield chunk
+
+    async def astream(self, prompt):
+        chunks, delay, interrupt_at = self._plan(prompt)
+        for i, chunk in enumerate(chunks):
+            if i == interrupt_at:
+                raise RuntimeError("stub: simulated stream interruption")
+            await asyncio.sleep(delay)
+            yield chunk
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_backend():
+    """Returns the report backend selected by REPORT_BACKEND, created on first use and then reused."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = StubBackend() if REPORT_BACKEND == "stub" else GeminiBackend()
+        return _backend
+
+def stream_report(patient_data, backend=None):
+    """Yields the cleaned report as the backend streams it. Raises if the backend is not configured or the call fails."""
+    backend = backend or get_backend()
+    prompt = generate_prompt(patient_data)
+    print("Streaming report from the report backend...")
+    start = time.perf_counter()
+    first_chunk = True
+    with span("report_generate"):
+        for chunk in clean_report_chunks(backend.stream(prompt)):
+            if first_chunk:
+                record("report_first_chunk", time.perf_counter() - start, start)
+                first_chunk = False
+            yield chunk
+
+async def astream_report(patient_data, backend=None):
+    """stream_report for asyncio servers, over the backend's async streaming API."""
+    backend = backend or get_backend()
+    prompt = generate_prompt(patient_data)
+    start = time.perf_counter()
+    first_chunk = True
+    with span("report_generate"):
+        async for chunk in backend.astream(prompt):
+            chunk = chunk.replace('*', '') # clean_report_chunks, chunk by chunk
+            if not chunk:
+                continue
+            if first_chunk:
+                record("report_first_chunk", time.perf_counter() - start, start)
+                first_chunk = False
+            yield chunk
+
+def generate_report(patient_data, backend=None):
+    """Generates and cleans a whole report. Raises if the backend is not configured or the call fails."""
+    return "".join(stream_report(patient_data, backend))
+
 def generate_report_from_gemini(patient_data):
     """
     Takes patient data, calls the Gemini API, and returns the generated report text.
+    Errors are returned as text, so this never raises.
     """
-    if not API_KEY or API_KEY == "YOUR_GEMINI_API_KEY_HERE":
-        print("ERROR: Gemini API Key is not configured in gemini_handler.py")
-        return "Error: The Gemini API key is not configured on the server."
-
     try:
-        genai.configure(api_key=API_KEY)
-        model = genai.GenerativeModel('gemini-1.5-flash-latest')
-        
-        prompt = generate_prompt(patient_data)
-        print("Sending request to Gemini API for report generation...")
-        response = model.generate_content(prompt)
-        
-        # Clean up the response text from markdown for better display
-        cleaned_text = response.text.replace('**', '').replace('*', '')
-        print("Successfully received and cleaned response from Gemini.")
-        return cleaned_text
-        
+        return generate_report(patient_data)
     except Exception as e:
         print(f"\nAn error occurred while contacting the Gemini API: {e}")
-        return f"An error occurred while generating the report: {e}"    
\ No newline at end of file
+        return f"An error occurred while generating the report: {e}"
@@ -0,0 +1,93 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+from analyze import predict_batch
+
+class InferenceScheduler:
+    """
+    Collects preprocessed tensors from concurrent requests into micro-batches and runs
+    them through the model on a single worker thread. A batch is closed once it holds
+    `max_batch_size` images or the first image has waited `max_wait_ms` milliseconds.
+    At most `max_queue_size` images wait in the queue; beyond that `submit` raises queue.Full.
+    """
+    def __init__(self, model, max_batch_size=8, max_wait_ms=10, max_queue_size=64, batch_fn=predict_batch):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.batch_fn = batch_fn
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = None
+        self._stopped = threading.Event()
+        self.batches_run = 0
+        self.images_run = 0
+
+    def start(self):
+        """Starts the worker thread that owns the model."""
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run, name="inference-scheduler", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops the worker thread once the batch in flight is done."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, x_tensor):
+        """Queues a (1, 3, H, W) tensor and returns a Future for its (probabilities, cams) result."""
+        future = Future()
+        self._queue.put_nowait((x_tensor, future))
+        return future
+
+    def predict(self, x_tensor, timeout=None):
+        """Blocking helper for request threads: submits the tensor and waits for its result."""
+        return self.submit(x_tensor).result(timeout=timeout)
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def _collect_batch(self):
+        """Blocks for the first request, then gathers more until the batch is full or the wait expires."""
+        try:
+            batch = [self._queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stopped.is_set():
+            batch = self._collect_batch()
+            if not batch:
+                continue
+
+            tensors, futures = zip(*batch)
+            try:
+                results = self.batch_fn(self.model, torch.cat(tensors))
+                if results is None:
+                    raise RuntimeError("Inference failed for the batch")
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            self.batches_run += 1
+            self.images_run += len(batch)
+            for future, result in zip(futures, results):
+                future.set_result(result)
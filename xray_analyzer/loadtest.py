@@ -0,0 +1,286 @@
+"""
+Load generator for the analysis and report API.
+
+    # The server, with the offline report backend standing in for Gemini
+    REPORT_BACKEND=stub STUB_LATENCY_SECONDS=2 STUB_LATENCY_SIGMA=0.5 STUB_ERROR_RATE=0.02 python main.py
+
+    python loadtest.py http://127.0.0.1:5000 --mix analyze=4,report=1 --rps 1,2,4,8 --duration 30 -o load.json
+    python loadtest.py http://127.0.0.1:5000 --mix analyze=1 --concurrency 1,2,4,8,16
+
+Every step of the sweep runs for --duration seconds: open loop at a fixed arrival rate (--rps, latency
+counted from the scheduled send time, so a slow server can't hide its backlog) or closed loop with N
+clients sending back to back (--concurrency). /analyze uploads cycle through the images in --images;
+/generate-report posts --patient (made unique per request unless --repeat-reports, so the report cache
+doesn't answer them) and follows the job's event stream until the report is done.
+
+Per step and request kind the report gives the achieved throughput, the error rate and the latency
+percentiles (plus the time to the first report chunk). The saturation point is the first step that
+misses its offered rate, breaks the --slo-ms p95 or --max-error-rate, or, for closed loop, adds less
+than 10% throughput.
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_PATIENT = os.path.join(HERE, "..", "backend", "app", "api", "demo_files", "patient.json")
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg'}
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+def multipart_body(field, filename, data):
+    boundary = uuid.uuid4().hex
+    head = (f'--{boundary}\r\nContent-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            'Content-Type: application/octet-stream\r\n\r\n').encode()
+    return head + data + f'\r\n--{boundary}--\r\n'.encode(), f'multipart/form-data; boundary={boundary}'
+
+class Workload:
+    """Builds and sends the requests of the mix. Every send returns a result dict, errors included."""
+    def __init__(self, base_url, mix, images, patient, unique_reports=True, analyze_query="", timeout=120, seed=0):
+        self.base_url = base_url.rstrip('/')
+        self.kinds, self.weights = zip(*mix.items())
+        self.images = images
+        self.patient = patient
+        self.unique_reports = unique_reports
+        self.analyze_query = analyze_query
+        self.timeout = timeout
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._sent = 0
+
+    def next_request(self):
+        with self._lock:
+            self._sent += 1
+            return self._random.choices(self.kinds, self.weights)[0], self._sent
+
+    def send(self, kind, n):
+        start = time.perf_counter()
+        result = {"kind": kind, "ok": False, "error": None, "first_chunk": None}
+        try:
+            if kind == "analyze":
+                self._analyze(n)
+            else:
+                result["first_chunk"] = self._report(n, start)
+            result["ok"] = True
+        except urllib.error.HTTPError as e:
+            result["error"] = f"http {e.code}"
+        except Exception as e:
+            result["error"] = type(e).__name__ if not str(e) else str(e)[:80]
+        result["end"] = time.perf_counter()
+        return result
+
+    def _analyze(self, n):
+        filename, data = self.images[n % len(self.images)]
+        body, content_type = multipart_body('file', filename, data)
+        request = urllib.request.Request(f"{self.base_url}/analyze{self.analyze_query}", data=body,
+                                         headers={'Content-Type': content_type})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+    def _report(self, n, start):
+        """Submits a report and reads its events until it finishes. Returns the seconds to the first chunk."""
+        payload = dict(self.patient, loadtest={"request": n, "run": uuid.uuid4().hex}) if self.unique_reports else self.patient
+        request = urllib.request.Request(f"{self.base_url}/generate-report", data=json.dumps(payload).encode(),
+                                         headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            events_url = json.loads(response.read())["events_url"]
+
+        first_chunk = None
+        event = None
+        with urllib.request.urlopen(f"{self.base_url}{events_url}", timeout=self.timeout) as response:
+            for line in response:
+                line = line.decode().rstrip('\n')
+                if line.startswith('event: '):
+                    event = line[len('event: '):]
+                    if event == 'chunk' and first_chunk is None:
+                        first_chunk = time.perf_counter() - start
+                    elif event in ('done', 'failed'):
+                        break
+        if event != 'done':
+            raise RuntimeError("report failed" if event == 'failed' else "event stream ended early")
+        return first_chunk
+
+def run_open_loop(workload, rps, duration, max_inflight):
+    """Sends at `rps` for `duration` seconds; each latency counts from the request's scheduled time."""
+    results = []
+    with ThreadPoolExecutor(max_workers=max_inflight) as executor:
+        futures = []
+        start = time.perf_counter()
+        for i in range(int(rps * duration)):
+            scheduled = start + i / rps
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            kind, n = workload.next_request()
+            futures.append((scheduled, executor.submit(workload.send, kind, n)))
+        for scheduled, future in futures:
+            result = future.result()
+            result["latency"] = result["end"] - scheduled
+            results.append(result)
+    # Never less than the send window, so a step can't beat its offered rate by finishing early
+    return results, max(time.perf_counter() - start, duration)
+
+def run_closed_loop(workload, clients, duration):
+    """`clients` threads, each sending its next request as soon as the previous one is answered."""
+    results = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client():
+        while time.perf_counter() < deadline:
+            kind, n = workload.next_request()
+            sent = time.perf_counter()
+            result = workload.send(kind, n)
+            result["latency"] = result["end"] - sent
+            with lock:
+                results.append(result)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+def summarize(results, elapsed):
+    latencies = [r["latency"] * 1000 for r in results if r["ok"]]
+    first_chunks = [r["first_chunk"] * 1000 for r in results if r["first_chunk"] is not None]
+    errors = {}
+    for r in results:
+        if not r["ok"]:
+            errors[r["error"]] = errors.get(r["error"], 0) + 1
+    summary = {
+        "requests": len(results),
+        "answered_per_second": round(len(results) / elapsed, 3) if elapsed else 0.0,
+        "throughput": round(sum(r["ok"] for r in results) / elapsed, 3) if elapsed else 0.0,
+        "error_rate": round(1 - len(latencies) / len(results), 4) if results else 0.0,
+        "errors": errors,
+    }
+    for q in (50, 95, 99):
+        value = percentile(latencies, q)
+        summary[f"p{q}_ms"] = round(value, 1) if value is not None else None
+    if first_chunks:
+        summary["first_chunk_p50_ms"] = round(percentile(first_chunks, 50), 1)
+        summary["first_chunk_p95_ms"] = round(percentile(first_chunks, 95), 1)
+    return summary
+
+def find_saturation(steps, open_loop, slo_ms, max_error_rate):
+    """The first step past the service's capacity, with the reason, or None if every step kept up."""
+    previous = previous_level = None
+    for step in steps:
+        total = step["total"]
+        reason = None
+        if total["error_rate"] > max_error_rate:
+            reason = f"error rate {total['error_rate']:.1%} > {max_error_rate:.1%}"
+        elif slo_ms and total["p95_ms"] is not None and total["p95_ms"] > slo_ms:
+            reason = f"p95 {total['p95_ms']:.0f} ms > {slo_ms:.0f} ms"
+        elif open_loop and total["answered_per_second"] < 0.9 * step["level"]:
+            reason = f"{total['answered_per_second']:.2f} answers/s < 90% of the offered {step['level']}/s"
+        elif not open_loop and previous is not None and total["throughput"] < 1.1 * previous["throughput"]:
+            reason = f"throughput {total['throughput']:.2f}/s, under 10% more than with {previous_level} clients"
+        if reason:
+            return {"level": step["level"], "reason": reason}
+        previous, previous_level = total, step["level"]
+    return None
+
+def load_images(source):
+    images = []
+    for name in sorted(os.listdir(source)):
+        if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+            with open(os.path.join(source, name), 'rb') as f:
+                images.append((name, f.read()))
+    if not images:
+        raise SystemExit(f"❌ No images in '{source}'")
+    return images
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        kind, _, weight = part.partition('=')
+        kind = kind.strip()
+        if kind not in ("analyze", "report"):
+            raise SystemExit(f"❌ Unknown request kind '{kind}' (use analyze and report)")
+        mix[kind] = float(weight or 1)
+    return mix
+
+def run(args):
+    if bool(args.rps) == bool(args.concurrency):
+        raise SystemExit("❌ Give either --rps or --concurrency")
+    open_loop = bool(args.rps)
+    levels = [float(level) if open_loop else int(level) for level in (args.rps or args.concurrency).split(',')]
+    mix = parse_mix(args.mix)
+    patient = None
+    if "report" in mix:
+        with open(args.patient) as f:
+            patient = json.load(f)
+    workload = Workload(args.url, mix, load_images(args.images) if "analyze" in mix else [], patient,
+                        unique_reports=not args.repeat_reports, analyze_query=args.analyze_query,
+                        timeout=args.timeout, seed=args.seed)
+
+    unit = "rps" if open_loop else "clients"
+    print(f"{unit:>8}{'kind':>9}{'reqs':>7}{'ok/s':>8}{'errors':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'1st chunk':>11}")
+    steps = []
+    for level in levels:
+        if open_loop:
+            results, elapsed = run_open_loop(workload, level, args.duration, args.max_inflight)
+        else:
+            results, elapsed = run_closed_loop(workload, level, args.duration)
+        step = {"level": level, "total": summarize(results, elapsed), "kinds": {}}
+        for kind in mix:
+            step["kinds"][kind] = summarize([r for r in results if r["kind"] == kind], elapsed)
+        steps.append(step)
+        for kind, row in [("total", step["total"])] + list(step["kinds"].items()):
+            p = [f"{row[f'p{q}_ms']:>9.0f}" if row[f"p{q}_ms"] is not None else f"{'-':>9}" for q in (50, 95, 99)]
+            first = f"{row['first_chunk_p50_ms']:>11.0f}" if "first_chunk_p50_ms" in row else f"{'-':>11}"
+            print(f"{level:>8}{kind:>9}{row['requests']:>7}{row['throughput']:>8.2f}{row['error_rate']:>8.1%}{''.join(p)}{first}")
+        if args.cooldown:
+            time.sleep(args.cooldown)
+
+    saturation = find_saturation(steps, open_loop, args.slo_ms, args.max_error_rate)
+    if saturation:
+        print(f"📈 Saturated at {saturation['level']} {unit}: {saturation['reason']}")
+    else:
+        print(f"✅ No saturation up to {levels[-1]} {unit}")
+
+    report = {"url": args.url, "mode": "open" if open_loop else "closed", "mix": mix, "duration": args.duration,
+              "steps": steps, "saturation": saturation}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"   Report: {args.output}")
+    return report
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test the analysis and report API.")
+    parser.add_argument("url", help="Base URL of the server, e.g. http://127.0.0.1:5000")
+    parser.add_argument("--rps", help="Comma-separated arrival rates to sweep (open loop)")
+    parser.add_argument("--concurrency", help="Comma-separated client counts to sweep (closed loop)")
+    parser.add_argument("--mix", default="analyze=4,report=1", help="Request weights (default: analyze=4,report=1)")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds per step (default: 30)")
+    parser.add_argument("--images", default=os.path.join(HERE, "data"), help="Directory of images to upload")
+    parser.add_argument("--patient", default=DEFAULT_PATIENT, help="Patient JSON posted to /generate-report")
+    parser.add_argument("--repeat-reports", action="store_true", help="Post the same payload every time (measures the report cache)")
+    parser.add_argument("--analyze-query", default="", help="Query string for /analyze, e.g. '?heatmaps=inline' on main.py")
+    parser.add_argument("--slo-ms", type=float, default=0, help="p95 latency objective; a step above it is saturated")
+    parser.add_argument("--max-error-rate", type=float, default=0.05, help="Error rate beyond which a step is saturated")
+    parser.add_argument("--max-inflight", type=int, default=256, help="Open loop: most requests in flight at once")
+    parser.add_argument("--timeout", type=float, default=120, help="Seconds before a request is abandoned")
+    parser.add_argument("--cooldown", type=float, default=2, help="Pause between steps, so queues drain (default: 2)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the request mix")
+    parser.add_argument("-o", "--output", help="Write the report as JSON")
+    return parser.parse_args(argv)
+
+if __name__ == '__main__':
+    run(parse_args())
@@ -1,62 +1,175 @@
-import os
-from flask import Flask, request, jsonify
+import json
+import queue
+import time
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
-from werkzeug.utils import secure_filename
-import torch
 
-from model import load_model
-from analyze import get_predictions_for_api
-from gemini_handler import generate_report_from_gemini # ✨ NEW IMPORT
-
-UPLOAD_FOLDER = 'uploads'
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+# Loads and warms up the model and starts the batching scheduler, shared with asgi.py
+from server_state import (
+    REPORT_CONCURRENCY, REPORT_JOB_TTL_SECONDS, REPORT_MAX_PENDING, STARTUP_METRICS,
+    allowed_file, log_internal_error, model, preprocess_pool, report_cache, report_setup, scheduler,
+    stream_cached_report
+)
+from analyze import get_predictions_for_api, predict_image, encode_heatmaps
+from gemini_handler import get_backend
+from report_jobs import ReportJobQueue
+import metrics
+from metrics import span
 
 app = Flask(__name__)
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 CORS(app)
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# /metrics, per-route latency and X-Request-ID; METRICS_ENABLED=0 turns it off, TRACE_REQUESTS=1 adds traces
+metrics.init_app(app)
 
-print("--- CXR-Vision AI API Server is starting up ---")
-model = load_model()
-print("--- Model loaded successfully ---")
+report_jobs = ReportJobQueue(stream_cached_report, REPORT_CONCURRENCY, REPORT_MAX_PENDING, REPORT_JOB_TTL_SECONDS)
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+@app.route('/health')
+def health():
+    return jsonify({"status": "ready", "startup": STARTUP_METRICS, "reports": report_jobs.stats(), "report_cache": report_cache.stats()})
 
-# --- X-Ray Analysis Endpoint (Unchanged) ---
+# --- X-Ray Analysis Endpoint ---
 @app.route('/analyze', methods=['POST'])
 def analyze_image():
-    # This function remains the same as before
+    request_start = time.perf_counter()
     if 'file' not in request.files: return jsonify({"error": "No file part"}), 400
     file = request.files['file']
     if file.filename == '': return jsonify({"error": "No file selected"}), 400
     if file and allowed_file(file.filename):
-        filepath = None
         try:
-            filename = secure_filename(file.filename)
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            file.save(filepath)
-            predictions, heatmaps = get_predictions_for_api(filepath, model)
+            # Decoded from memory, the upload is never written to disk
+            with span("upload"):
+                image_bytes = file.read()
+            predictions, heatmaps = get_predictions_for_api(image_bytes, model, scheduler=scheduler, preprocess_pool=preprocess_pool)
             if predictions is None: return jsonify({"error": "Could not process image"}), 500
-            return jsonify({ "predictions": predictions, "heatmaps": heatmaps })
-        except Exception as e:
-            return jsonify({"error": f"An internal error occurred: {e}"}), 500
-        finally:
-            if filepath and os.path.exists(filepath): os.remove(filepath)
+            if STARTUP_METRICS["first_request_seconds"] is None:
+                STARTUP_METRICS["first_request_seconds"] = round(time.perf_counter() - request_start, 4)
+            with span("serialize"):
+                return jsonify({ "predictions": predictions, "heatmaps": heatmaps })
+        except queue.Full:
+            return jsonify({"error": "Server is busy, please retry shortly"}), 503
+        except Exception:
+            return jsonify({"error": log_internal_error("/analyze")}), 500
     else:
         return jsonify({"error": "File type not allowed"}), 400
 
-# --- ✨ NEW Report Generation Endpoint ---
+# --- Report Generation Endpoints ---
 @app.route('/generate-report', methods=['POST'])
-def generate_report():
+def generate_report_job():
+    """Queues a report and returns its job id at once (202); poll /reports/<id> or follow /reports/<id>/events."""
     patient_data = request.get_json()
     if not patient_data:
         return jsonify({"error": "No patient data provided"}), 400
     
-    print("Received request to generate report...")
-    report_text = generate_report_from_gemini(patient_data)
-    
-    return jsonify({"report_text": report_text})
+    try:
+        # Resubmits of a report still in progress join the existing job
+        job_id = report_jobs.submit(patient_data, key=report_cache.make_key(patient_data))
+    except queue.Full:
+        return jsonify({"error": "Too many reports in progress, please retry shortly"}), 503
+    print(f"Queued report job {job_id}")
+    return jsonify({
+        "job_id": job_id,
+        "status": "queued",
+        "status_url": f"/reports/{job_id}",
+        "events_url": f"/reports/{job_id}/events"
+    }), 202
+
+@app.route('/reports/<job_id>')
+def get_report(job_id):
+    job = report_jobs.get(job_id)
+    if job is None: return jsonify({"error": "Unknown or expired report job"}), 404
+    return jsonify(job.to_json())
+
+@app.route('/reports/<job_id>/events')
+def report_events(job_id):
+    """
+    Server-sent events: a `status` event now, a `chunk` event ({"text"}) for each piece of the report
+    as the backend streams it, then one `done` (or `failed`) event with the whole job.
+    """
+    job = report_jobs.get(job_id)
+    if job is None: return jsonify({"error": "Unknown or expired report job"}), 404
+
+    def generate():
+        yield f"event: status\ndata: {json.dumps(job.to_json())}\n\n"
+        sent = 0
+        while True:
+            chunks = job.wait_for_chunks(sent, timeout=15)
+            for chunk in chunks:
+                yield f"event: chunk\ndata: {json.dumps({'text': chunk})}\n\n"
+            sent += len(chunks)
+            if job.done.is_set() and sent == len(job.chunks):
+                break
+            if not chunks:
+                yield ": keep-alive\n\n"
+        event = "done" if job.status == "done" else "failed"
+        yield f"event: {event}\ndata: {json.dumps(job.to_json())}\n\n"
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+# --- Combined Analysis + Report Endpoint ---
+@app.route('/analyze-and-report', methods=['POST'])
+def analyze_and_report():
+    """
+    Takes the image (`file`) and the patient data (`patient`, a JSON string) in one multipart request
+    and streams NDJSON events as each result is ready: `predictions`, one `heatmap` per finding,
+    `report_chunk`s, then `report_done` (or `report_failed`). The report prompt includes the findings,
+    so the LLM call starts once the forward pass is done; only the backend setup runs during inference.
+    The heatmaps are encoded and streamed while the report is being generated.
+    """
+    request_start = time.perf_counter()
+    if 'file' not in request.files: return jsonify({"error": "No file part"}), 400
+    file = request.files['file']
+    if file.filename == '' or not allowed_file(file.filename):
+        return jsonify({"error": "No file selected or file type not allowed"}), 400
+    with span("upload"):
+        image_bytes = file.read()
+
+    try:
+        patient_data = json.loads(request.form.get('patient') or 'null')
+    except ValueError:
+        return jsonify({"error": "patient must be a JSON object"}), 400
+    if not isinstance(patient_data, dict) or not patient_data:
+        return jsonify({"error": "No patient data provided"}), 400
+
+    try:
+        # Creating the backend (client and connection) doesn't need the findings
+        report_setup.submit(get_backend)
+        result = predict_image(image_bytes, model, scheduler=scheduler, preprocess_pool=preprocess_pool)
+        if result is None: return jsonify({"error": "Could not process image"}), 500
+        predictions, cams, original_image = result
+        report_data = dict(patient_data, xray_findings=predictions)
+        job_id = report_jobs.submit(report_data, key=report_cache.make_key(report_data))
+    except queue.Full:
+        return jsonify({"error": "Server is busy, please retry shortly"}), 503
+    except Exception:
+        return jsonify({"error": log_internal_error("/analyze-and-report")}), 500
+    job = report_jobs.get(job_id)
+
+    def event(name, **fields):
+        return json.dumps(dict(fields, event=name)) + "\n"
+
+    def generate():
+        yield event("predictions", predictions=predictions, job_id=job_id,
+                    seconds=round(time.perf_counter() - request_start, 3))
+        sent = 0
+        for heatmap in encode_heatmaps(cams, original_image):
+            yield event("heatmap", **heatmap)
+            # Forward whatever the report produced meanwhile, without waiting
+            for chunk in job.wait_for_chunks(sent, timeout=0):
+                yield event("report_chunk", text=chunk)
+                sent += 1
+        while not (job.done.is_set() and sent == len(job.chunks)):
+            for chunk in job.wait_for_chunks(sent, timeout=15):
+                yield event("report_chunk", text=chunk)
+                sent += 1
+        seconds = round(time.perf_counter() - request_start, 3)
+        if job.status == "done":
+            yield event("report_done", report_text=job.report_text, seconds=seconds)
+        else:
+            yield event("report_failed", error=job.error, seconds=seconds)
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
 # --- MAIN EXECUTION ---
 if __name__ == '__main__':
@@ -1,27 +1,91 @@
+import os
+import re
+import time
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torchvision import models
 
+from analyze import generate_gradcams
+
+DEFAULT_CHECKPOINT = os.environ.get("MODEL_CHECKPOINT", os.path.join("models", "densenet121.pt"))
+
 class CustomDenseNet(models.DenseNet):
     def forward(self, x):
-        features = self.features(x)
+        return self.head(self.features(x))
+
+    def head(self, features):
+        """Everything after the final feature map: ReLU, global average pooling and the classifier."""
         out = F.relu(features, inplace=False)
         out = F.adaptive_avg_pool2d(out, (1, 1))
         out = torch.flatten(out, 1)
         out = self.classifier(out)
         return out
 
-def load_model():
-    print("🧠 Loading pre-trained DenseNet-121 model...")
-    model = CustomDenseNet(
+    # Closed-form Grad-CAM of the last conv layer from the final feature map (see src/model.py)
+
+    def cam_shift(self):
+        """norm5's per-channel shift over the output channels of the last dense layer's conv."""
+        norm = self.features.norm5
+        last_conv = [m for m in self.features.modules() if isinstance(m, nn.Conv2d)][-1]
+        scale = norm.weight / torch.sqrt(norm.running_var + norm.eps)
+        return (norm.bias - norm.running_mean * scale)[-last_conv.out_channels:].detach()
+
+    def cam_activations(self, features):
+        """The last conv's output up to norm5's scale, which cancels against cam_weights."""
+        shift = self.cam_shift().to(features.dtype)
+        return features[:, -len(shift):] - shift.view(1, -1, 1, 1)
+
+    def cam_weights(self, features, target_classes):
+        """Mean gradient of each class score over the last conv's channels: classifier weights times the ReLU mask."""
+        channels = len(self.cam_shift())
+        height, width = features.shape[2:]
+        active = (features[:, -channels:] > 0).to(features.dtype).mean(dim=(2, 3))
+        weight = self.classifier.weight[list(target_classes), -channels:].to(features.dtype) / (height * width)
+        return weight.unsqueeze(0) * active.unsqueeze(1)
+
+def build_model():
+    return CustomDenseNet(
         growth_rate=32,
         block_config=(6, 12, 24, 16),
         num_init_features=64,
         bn_size=4,
         drop_rate=0
     )
-    pretrained_state_dict = models.densenet121(weights=models.DenseNet121_Weights.DEFAULT).state_dict()
-    model.load_state_dict(pretrained_state_dict)
+
+def _remap_legacy_keys(state_dict):
+    # torchvision's DenseNet weights use 'norm.1'-style keys, the modules are named 'norm1'
+    pattern = re.compile(r"^(.*denselayer\d+\.(?:norm|relu|conv))\.((?:[12])\.(?:weight|bias|running_mean|running_var))$")
+    for key in list(state_dict.keys()):
+        res = pattern.match(key)
+        if res: state_dict[res.group(1) + res.group(2)] = state_dict.pop(key)
+    return state_dict
+
+def save_checkpoint(model_or_state_dict, checkpoint_path=DEFAULT_CHECKPOINT):
+    state_dict = model_or_state_dict
+    if isinstance(model_or_state_dict, nn.Module): state_dict = model_or_state_dict.state_dict()
+    os.makedirs(os.path.dirname(checkpoint_path) or ".", exist_ok=True)
+    torch.save(state_dict, checkpoint_path)
+
+def load_model(checkpoint_path=DEFAULT_CHECKPOINT, mmap=False):
+    """Loads the local checkpoint (optionally memory-mapped); downloads and caches the weights once otherwise."""
+    print("🧠 Loading pre-trained DenseNet-121 model...")
+    start = time.perf_counter()
+    model = build_model()
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        state_dict = torch.load(checkpoint_path, map_location="cpu", weights_only=True, mmap=mmap)
+        model.load_state_dict(state_dict, assign=mmap)
+    else:
+        state_dict = _remap_legacy_keys(models.DenseNet121_Weights.DEFAULT.get_state_dict(progress=True))
+        model.load_state_dict(state_dict)
+        if checkpoint_path: save_checkpoint(state_dict, checkpoint_path)
     model.eval()
-    return model
\ No newline at end of file
+    print(f"Model loaded in {time.perf_counter() - start:.2f}s")
+    return model
+
+def warmup_model(model, steps=1):
+    """Forward and Grad-CAM passes on a dummy image so the first request skips lazy initialization."""
+    dummy = torch.zeros(1, 3, 224, 224)
+    for _ in range(steps):
+        with torch.no_grad(): model(dummy)
+        generate_gradcams(model, dummy, [0])
@@ -0,0 +1,54 @@
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import torch
+
+from utils import preprocess_image
+
+def _init_worker():
+    # One intra-op thread per decode worker, the cores belong to the model
+    torch.set_num_threads(1)
+
+def _preprocess_worker(image):
+    x_tensor, resized = preprocess_image(image)
+    if x_tensor is None: return None, None
+    # NumPy arrays cross process boundaries without torch's shared-memory file descriptors
+    return x_tensor.numpy(), resized
+
+class PreprocessPool:
+    """
+    Decodes and preprocesses uploads on worker threads or processes (see src/preprocess.py), so that
+    decoding the next images overlaps with inference. At most `max_pending` images are queued or in progress.
+    """
+    def __init__(self, workers=2, use_processes=False, max_pending=32):
+        if use_processes:
+            self._executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker)
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="preprocess")
+        self._slots = threading.BoundedSemaphore(max_pending)
+
+    def submit(self, image, block=True):
+        """
+        Queues an image and returns a Future for its (tensor as ndarray, resized image) pair.
+        Raises queue.Full when `block` is False and `max_pending` images are already queued.
+        """
+        if not self._slots.acquire(blocking=block):
+            raise queue.Full
+        future = self._executor.submit(_preprocess_worker, image)
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    @staticmethod
+    def to_tensor(result):
+        """preprocess_image's (tensor, resized image) from a submit() result."""
+        x_array, resized = result
+        if x_array is None: return None, None
+        return torch.from_numpy(x_array), resized
+
+    def preprocess(self, image, block=True):
+        """Same contract as preprocess_image, but the work runs on the pool."""
+        return self.to_tensor(self.submit(image, block=block).result())
+
+    def close(self):
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,213 @@
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+def canonical_patient_json(patient_data):
+    """One JSON text per payload: sorted keys, compact separators, surrounding whitespace stripped from strings."""
+    def strip(value):
+        if isinstance(value, dict):
+            return {key: strip(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [strip(item) for item in value]
+        if isinstance(value, str):
+            return value.strip()
+        return value
+    return json.dumps(strip(patient_data), sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+class ReportCache:
+    """
+    Cache of generated reports, keyed by the canonical patient JSON and the prompt version.
+    Entries expire after `ttl_seconds`; the in-memory tier keeps the `max_entries` most
+    recently used, and the optional disk tier (one JSON file per key) survives restarts.
+    Concurrent misses on the same key share a single upstream call.
+    """
+    def __init__(self, prompt_version, ttl_seconds=24 * 3600, max_entries=1024, disk_dir=None):
+        self.prompt_version = prompt_version
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self._entries = OrderedDict() # key -> (created_at, report_text, generation seconds)
+        self._inflight = {} # key -> Future of the upstream call
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.upstream_calls = 0
+        self.saved_seconds = 0.0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def make_key(self, patient_data):
+        h = hashlib.blake2b(digest_size=20)
+        h.update(canonical_patient_json(patient_data).encode())
+        h.update(f"|{self.prompt_version}".encode())
+        return h.hexdigest()
+
+    def get_or_generate(self, key, generate):
+        """
+        Returns the report for `key`, calling `generate()` only if it isn't cached and no other
+        request is already generating it. Failures are not cached.
+        """
+        return "".join(self.stream(key, lambda: [generate()]))
+
+    def stream(self, key, generate_chunks):
+        """
+        get_or_generate for streamed reports: yields a cached (or concurrently generated) report
+        as one chunk, and a new one chunk by chunk as `generate_chunks()` yields them.
+        """
+        report_text, future, leader = self._claim(key)
+        if report_text is not None:
+            yield report_text
+            return
+        if not leader:
+            yield future.result()
+            return
+
+        start = time.perf_counter()
+        parts = []
+        try:
+            for chunk in generate_chunks():
+                parts.append(chunk)
+                yield chunk
+        except BaseException as e:
+            self._abandon(key, future, e)
+            raise
+        self._complete(key, future, "".join(parts), start)
+
+    async def astream(self, key, generate_chunks):
+        """stream for asyncio: `generate_chunks()` is an async iterator, and followers await the leader's report."""
+        report_text, future, leader = self._claim(key)
+        if report_text is not None:
+            yield report_text
+            return
+        if not leader:
+            yield await asyncio.wrap_future(future)
+            return
+
+        start = time.perf_counter()
+        parts = []
+        try:
+            async for chunk in generate_chunks():
+                parts.append(chunk)
+                yield chunk
+        except BaseException as e:
+            self._abandon(key, future, e)
+            raise
+        self._complete(key, future, "".join(parts), start)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses + self.coalesced
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "coalesced": self.coalesced,
+                "misses": self.misses,
+                "upstream_calls": self.upstream_calls,
+                "hit_rate": round((lookups - self.misses) / lookups, 4) if lookups else 0.0,
+                "saved_seconds": round(self.saved_seconds, 3),
+            }
+
+    def _claim(self, key):
+        """
+        Looks the key up in memory, in flight and on disk. Returns (cached report text, None, False)
+        on a hit, (None, the leader's Future, False) when another request is generating it, and
+        (None, a new Future, True) when the caller must generate it and resolve the Future.
+        """
+        with self._lock:
+            entry = self._fresh(self._entries.get(key))
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.saved_seconds += entry[2]
+                return entry[1], None, False
+            future = self._inflight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return None, future, False
+
+        entry = self._read_disk(key)
+        if entry is not None:
+            with self._lock:
+                self.disk_hits += 1
+                self.saved_seconds += entry[2]
+                self._insert(key, entry)
+            return entry[1], None, False
+
+        with self._lock:
+            # Another request may have started the same report meanwhile
+            future = self._inflight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return None, future, False
+            future = self._inflight[key] = Future()
+            self.misses += 1
+            self.upstream_calls += 1
+            return None, future, True
+
+    def _abandon(self, key, future, error):
+        # Includes a consumer that stops early: the followers must not wait forever
+        with self._lock:
+            del self._inflight[key]
+        future.set_exception(error if isinstance(error, Exception) else RuntimeError("Report generation was abandoned"))
+
+    def _complete(self, key, future, report_text, start):
+        entry = (time.time(), report_text, time.perf_counter() - start)
+        with self._lock:
+            self._insert(key, entry)
+            del self._inflight[key]
+        self._write_disk(key, entry)
+        future.set_result(report_text)
+
+    def _fresh(self, entry):
+        if entry is None or entry[0] + self.ttl_seconds < time.time():
+            return None
+        return entry
+
+    def _insert(self, key, entry):
+        # Caller holds the lock
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        entry = self._fresh((data["created_at"], data["report_text"], data["generation_seconds"]))
+        if entry is None:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return entry
+
+    def _write_disk(self, key, entry):
+        if not self.disk_dir:
+            return
+        created_at, report_text, generation_seconds = entry
+        payload = {"created_at": created_at, "report_text": report_text, "generation_seconds": generation_seconds}
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(payload, f)
+            os.replace(tmp_path, path) # Atomic, so readers never see a partial file
+        except OSError as e:
+            print(f"⚠️ Could not write report cache entry to disk: {e}")
@@ -0,0 +1,230 @@
+import asyncio
+import queue
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+class ReportJob:
+    __slots__ = ("job_id", "status", "chunks", "report_text", "error", "created_at", "first_chunk_at",
+                 "finished_at", "done", "changed")
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.status = "queued"
+        self.chunks = [] # The report so far, as streamed by the backend
+        self.report_text = None
+        self.error = None
+        self.created_at = time.time()
+        self.first_chunk_at = None
+        self.finished_at = None
+        self.done = threading.Event()
+        self.changed = threading.Condition()
+
+    def wait_for_chunks(self, start, timeout=None):
+        """Returns the chunks after the first `start` ones, waiting up to `timeout` for new ones if there are none yet."""
+        with self.changed:
+            if len(self.chunks) <= start and not self.done.is_set():
+                self.changed.wait(timeout)
+            return self.chunks[start:]
+
+    def to_json(self):
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            # Partial text while the report is still being generated
+            "report_text": self.report_text if self.report_text is not None else "".join(self.chunks) or None,
+            "error": self.error,
+            "first_chunk_seconds": round(self.first_chunk_at - self.created_at, 3) if self.first_chunk_at else None,
+            "seconds": round((self.finished_at or time.time()) - self.created_at, 3),
+        }
+
+class ReportJobQueue:
+    """
+    Runs report generation in the background so requests return a job id right away.
+    `generate_fn(patient_data)` returns the report as an iterable of text chunks, which are
+    available to readers as they arrive.
+    At most `max_concurrency` reports are generated at once (the limit toward the provider);
+    at most `max_pending` jobs wait or run, beyond that `submit` raises queue.Full.
+    Finished jobs can be read for `ttl_seconds`. Submitting a `key` that matches a job still
+    queued or running returns that job instead of starting another one.
+    """
+    job_class = ReportJob
+
+    def __init__(self, generate_fn, max_concurrency=4, max_pending=64, ttl_seconds=600):
+        self.generate_fn = generate_fn
+        self.max_pending = max_pending
+        self.ttl_seconds = ttl_seconds
+        self._executor = self._make_executor(max_concurrency)
+        self._jobs = {}
+        self._inflight = {} # key -> job id
+        self._pending = 0
+        self._lock = threading.Lock()
+        self.completed = 0
+        self.failed = 0
+        self.deduplicated = 0
+
+    def submit(self, patient_data, key=None):
+        """Queues a report and returns its job id."""
+        with self._lock:
+            self._evict()
+            if key is not None and key in self._inflight:
+                self.deduplicated += 1
+                return self._inflight[key]
+            if self._pending >= self.max_pending:
+                raise queue.Full
+            job = self.job_class(uuid.uuid4().hex)
+            self._jobs[job.job_id] = job
+            self._pending += 1
+            if key is not None:
+                self._inflight[key] = job.job_id
+        self._start(job, patient_data, key)
+        return job.job_id
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def wait(self, job_id, timeout=None):
+        """Blocks until the job is finished or `timeout` expires. Returns the job, or None if unknown."""
+        job = self.get(job_id)
+        if job is not None:
+            job.done.wait(timeout)
+        return job
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending": self._pending,
+                "jobs": len(self._jobs),
+                "completed": self.completed,
+                "failed": self.failed,
+                "deduplicated": self.deduplicated,
+            }
+
+    def _make_executor(self, max_concurrency):
+        return ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="report")
+
+    def _start(self, job, patient_data, key):
+        self._executor.submit(self._run, job, patient_data, key)
+
+    def _run(self, job, patient_data, key):
+        job.status = "running"
+        try:
+            for chunk in self.generate_fn(patient_data):
+                with job.changed:
+                    if job.first_chunk_at is None:
+                        job.first_chunk_at = time.time()
+                    job.chunks.append(chunk)
+                    job.changed.notify_all()
+            job.report_text = "".join(job.chunks)
+            job.status = "done"
+        except Exception as e:
+            print(f"❌ Report job {job.job_id} failed: {e}")
+            job.error = str(e)
+            job.status = "error"
+        self._finish(job, key)
+        with job.changed:
+            job.done.set()
+            job.changed.notify_all()
+
+    def _finish(self, job, key):
+        job.finished_at = time.time()
+        with self._lock:
+            self._pending -= 1
+            self._inflight.pop(key, None)
+            if job.status == "done":
+                self.completed += 1
+            else:
+                self.failed += 1
+
+    def _evict(self):
+        # Caller holds the lock
+        cutoff = time.time() - self.ttl_seconds
+        for job_id in [j for j, job in self._jobs.items() if job.finished_at and job.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+class AsyncReportJob(ReportJob):
+    """A ReportJob whose readers are coroutines: `done` and `changed` are asyncio primitives."""
+    __slots__ = ()
+
+    def __init__(self, job_id):
+        super().__init__(job_id)
+        self.done = asyncio.Event()
+        self.changed = asyncio.Condition()
+
+    async def wait_for_chunks(self, start, timeout=None):
+        """Returns the chunks after the first `start` ones, waiting up to `timeout` for new ones if there are none yet."""
+        async with self.changed:
+            if len(self.chunks) <= start and not self.done.is_set():
+                try:
+                    await asyncio.wait_for(self.changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return self.chunks[start:]
+
+class AsyncReportJobQueue(ReportJobQueue):
+    """
+    ReportJobQueue for an asyncio server: `generate_fn(patient_data)` is an async iterator of
+    chunks and each job is a task on the event loop, so a report waiting on the provider holds no
+    thread. Submit and read jobs from the loop's thread.
+    """
+    job_class = AsyncReportJob
+
+    def __init__(self, *args, **kwargs):
+        self._tasks = set() # The loop only keeps weak references to its tasks
+        super().__init__(*args, **kwargs)
+
+    def _make_executor(self, max_concurrency):
+        # Bounds the jobs generating at once; the others wait on it as queued tasks
+        return asyncio.Semaphore(max_concurrency)
+
+    def _start(self, job, patient_data, key):
+        task = asyncio.get_running_loop().create_task(self._run_async(job, patient_data, key))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_async(self, job, patient_data, key):
+        async with self._executor:
+            job.status = "running"
+            try:
+                async for chunk in self.generate_fn(patient_data):
+                    async with job.changed:
+                        if job.first_chunk_at is None:
+                            job.first_chunk_at = time.time()
+                        job.chunks.append(chunk)
+                        job.changed.notify_all()
+                job.report_text = "".join(job.chunks)
+                job.status = "done"
+            except Exception as e:
+                print(f"❌ Report job {job.job_id} failed: {e}")
+                job.error = str(e)
+                job.status = "error"
+            except asyncio.CancelledError:
+                job.error = "The server is shutting down"
+                job.status = "error"
+                raise
+            finally:
+                self._finish(job, key)
+                async with job.changed:
+                    job.done.set()
+                    job.changed.notify_all()
+
+    async def wait(self, job_id, timeout=None):
+        """Waits until the job is finished or `timeout` expires. Returns the job, or None if unknown."""
+        job = self.get(job_id)
+        if job is not None:
+            try:
+                await asyncio.wait_for(job.done.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return job
+
+    async def close(self):
+        """Cancels the jobs still queued or running."""
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
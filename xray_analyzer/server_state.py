@@ -0,0 +1,77 @@
+"""
+What both API servers serve from: the configuration, the model (loaded and warmed up once per
+process), the batching scheduler, the upload decoding pool, the report cache and the shared executors.
+main.py (Flask) and asgi.py (Starlette) import it, so running either one loads the model only once
+and never builds the other.
+"""
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from model import load_model, warmup_model
+from inference import InferenceScheduler
+from preprocess import PreprocessPool
+from gemini_handler import astream_report, stream_report, PROMPT_VERSION, REPORT_BACKEND, GEMINI_MODEL
+from report_cache import ReportCache
+
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 8))
+MAX_BATCH_WAIT_MS = float(os.environ.get('MAX_BATCH_WAIT_MS', 10))
+MAX_QUEUE_SIZE = int(os.environ.get('MAX_QUEUE_SIZE', 64))
+# Uploads are decoded on these workers, in parallel with the forward passes
+PREPROCESS_WORKERS = int(os.environ.get('PREPROCESS_WORKERS', 2))
+PREPROCESS_PROCESSES = os.environ.get('PREPROCESS_PROCESSES', '0') == '1'
+MODEL_MMAP = os.environ.get('MODEL_MMAP', '0') == '1'
+WARMUP_STEPS = int(os.environ.get('WARMUP_STEPS', 1))
+# Reports run in the background: at most REPORT_CONCURRENCY calls to the provider at once
+REPORT_CONCURRENCY = int(os.environ.get('REPORT_CONCURRENCY', 4))
+REPORT_MAX_PENDING = int(os.environ.get('REPORT_MAX_PENDING', 64))
+REPORT_JOB_TTL_SECONDS = int(os.environ.get('REPORT_JOB_TTL_SECONDS', 600))
+# Identical patient payloads are answered from the report cache
+REPORT_CACHE_TTL_SECONDS = int(os.environ.get('REPORT_CACHE_TTL_SECONDS', 24 * 3600))
+REPORT_CACHE_ENTRIES = int(os.environ.get('REPORT_CACHE_ENTRIES', 1024))
+REPORT_CACHE_DIR = os.environ.get('REPORT_CACHE_DIR') or None
+
+# What clients see of an unexpected error; the details only go to the server's log
+INTERNAL_ERROR = "An internal error occurred"
+
+print("--- CXR-Vision AI API Server is starting up ---")
+startup_start = time.perf_counter()
+model = load_model(mmap=MODEL_MMAP)
+print("--- Model loaded successfully ---")
+load_seconds = time.perf_counter() - startup_start
+warmup_model(model, steps=WARMUP_STEPS)
+STARTUP_METRICS = {
+    "model_load_seconds": round(load_seconds, 4),
+    "warmup_seconds": round(time.perf_counter() - startup_start - load_seconds, 4),
+    "startup_seconds": round(time.perf_counter() - startup_start, 4),
+    "first_request_seconds": None,
+}
+scheduler = InferenceScheduler(model, MAX_BATCH_SIZE, MAX_BATCH_WAIT_MS, MAX_QUEUE_SIZE).start()
+preprocess_pool = PreprocessPool(PREPROCESS_WORKERS, use_processes=PREPROCESS_PROCESSES, max_pending=MAX_QUEUE_SIZE)
+report_cache = ReportCache(
+    f"{PROMPT_VERSION}|{REPORT_BACKEND}|{GEMINI_MODEL}",
+    ttl_seconds=REPORT_CACHE_TTL_SECONDS,
+    max_entries=REPORT_CACHE_ENTRIES,
+    disk_dir=REPORT_CACHE_DIR
+)
+# Sets up the report backend while /analyze-and-report's image is being analyzed
+report_setup = ThreadPoolExecutor(max_workers=1, thread_name_prefix="report-setup")
+
+def stream_cached_report(patient_data):
+    key = report_cache.make_key(patient_data)
+    return report_cache.stream(key, lambda: stream_report(patient_data))
+
+def astream_cached_report(patient_data):
+    key = report_cache.make_key(patient_data)
+    return report_cache.astream(key, lambda: astream_report(patient_data))
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+def log_internal_error(route):
+    """Prints the exception being handled, with its traceback; returns the generic message for the client."""
+    print(f"❌ {route} failed:")
+    traceback.print_exc()
+    return INTERNAL_ERROR
@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+import torch
+
+# The server's modules use flat imports (`from analyze import ...`)
+XRAY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, XRAY_DIR)
+# Set before any test imports gemini_handler, which reads them at import time
+os.environ.setdefault("REPORT_BACKEND", "stub")
+os.environ.setdefault("STUB_LATENCY_SECONDS", "0.05")
+
+@pytest.fixture(scope="session")
+def asgi_app():
+    """The asgi module, on a randomly initialized model and the stub report backend."""
+    # Ahead of the repository root, whose own main.py the src tests put on the path
+    sys.path.insert(0, XRAY_DIR)
+    os.environ.setdefault("WARMUP_STEPS", "0")
+    import model
+
+    def random_model(*args, **kwargs):
+        torch.manual_seed(0)
+        return model.build_model().eval()
+
+    model.load_model = random_model
+    import asgi
+    yield asgi
+    asgi.scheduler.stop()
@@ -0,0 +1,51 @@
+import io
+import json
+import threading
+
+import numpy as np
+from PIL import Image
+
+def png_bytes(seed):
+    rng = np.random.default_rng(seed)
+    buffer = io.BytesIO()
+    Image.fromarray(rng.integers(0, 256, (96, 96), dtype=np.uint8)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def test_backend_is_set_up_while_the_image_is_analyzed(asgi_app, monkeypatch):
+    import main
+    get_backend, predict_image = main.get_backend, main.predict_image
+    setup_started = threading.Event()
+    overlapped = []
+
+    def watched_get_backend():
+        setup_started.set()
+        return get_backend()
+
+    def watched_predict_image(*args, **kwargs):
+        overlapped.append(setup_started.wait(timeout=5))
+        return predict_image(*args, **kwargs)
+
+    monkeypatch.setattr(main, "get_backend", watched_get_backend)
+    monkeypatch.setattr(main, "predict_image", watched_predict_image)
+    response = main.app.test_client().post("/analyze-and-report", data={
+        "file": (io.BytesIO(png_bytes(0)), "xray.png"),
+        "patient": json.dumps({"age": 63, "symptoms": "cough"}),
+    })
+    events = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+    assert overlapped == [True]
+    assert events[0]["event"] == "predictions"
+    assert events[-1]["event"] == "report_done"
+    assert "".join(e["text"] for e in events if e["event"] == "report_chunk") == events[-1]["report_text"]
+
+def test_flask_internal_errors_are_logged_not_returned(asgi_app, monkeypatch, capsys):
+    import main
+
+    def broken(*args, **kwargs):
+        raise RuntimeError("secret detail")
+
+    monkeypatch.setattr(main, "get_predictions_for_api", broken)
+    response = main.app.test_client().post("/analyze", data={"file": (io.BytesIO(png_bytes(0)), "xray.png")})
+    assert response.status_code == 500
+    assert response.get_json() == {"error": "An internal error occurred"}
+    assert "secret detail" in capsys.readouterr().err
@@ -0,0 +1,107 @@
+import asyncio
+import json
+import os
+
+async def call(app, method, path, body=b"", headers=()):
+    """Runs one request through the ASGI app; returns (status, headers, body)."""
+    scope = {
+        "type": "http", "method": method, "path": path, "query_string": b"",
+        "headers": [(k.encode(), v.encode()) for k, v in headers],
+    }
+    if not any(k.lower() == "content-length" for k, _ in headers):
+        scope["headers"].append((b"content-length", str(len(body)).encode()))
+    sent = False
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await asyncio.sleep(3600)
+
+    response = {"status": None, "headers": {}, "body": b""}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = {k.decode(): v.decode() for k, v in message["headers"]}
+        else:
+            response["body"] += message.get("body", b"")
+
+    await app(scope, receive, send)
+    return response["status"], response["headers"], response["body"]
+
+def test_report_events_stream_the_whole_report(asgi_app):
+    async def run():
+        status, _, body = await call(asgi_app.app, "POST", "/generate-report", json.dumps({"age": 41}).encode())
+        assert status == 202
+        job = json.loads(body)
+        status, headers, body = await call(asgi_app.app, "GET", job["events_url"])
+        return status, headers, body.decode()
+
+    status, headers, body = asyncio.run(run())
+    assert status == 200
+    assert headers["content-type"].startswith("text/event-stream")
+    events = [line[len("event: "):] for line in body.splitlines() if line.startswith("event: ")]
+    assert events[0] == "status" and events[-1] == "done"
+    chunks = [json.loads(line[len("data: "):])["text"] for line, previous in zip(body.splitlines()[1:], body.splitlines())
+              if previous == "event: chunk"]
+    done = json.loads(body.strip().splitlines()[-1][len("data: "):])
+    assert chunks and "".join(chunks) == done["report_text"]
+
+def test_unknown_routes_and_methods(asgi_app):
+    status, headers, body = asyncio.run(call(asgi_app.app, "GET", "/nope", headers=[("x-request-id", "abc123")]))
+    assert status == 404 and "error" in json.loads(body)
+    assert headers["x-request-id"] == "abc123"
+    assert asyncio.run(call(asgi_app.app, "GET", "/analyze"))[0] == 405
+    status, _, body = asyncio.run(call(asgi_app.app, "POST", "/analyze", b"", [("content-type", "multipart/form-data; boundary=x")]))
+    assert status == 400 and json.loads(body) == {"error": "No file part"}
+
+def test_cors_preflight_allows_any_origin(asgi_app):
+    status, headers, _ = asyncio.run(call(asgi_app.app, "OPTIONS", "/analyze", headers=[
+        ("origin", "http://example.com"), ("access-control-request-method", "POST")
+    ]))
+    assert status == 200
+    assert headers["access-control-allow-origin"] == "*"
+    assert "POST" in headers["access-control-allow-methods"]
+
+def test_body_size_checks(asgi_app):
+    for content_length, expected in [("abc", 400), ("-1", 400), (str(1 << 40), 413)]:
+        status, _, body = asyncio.run(call(asgi_app.app, "POST", "/generate-report", b"{}", [("content-length", content_length)]))
+        assert status == expected and "error" in json.loads(body)
+
+def multipart(fields, files, boundary="test-boundary"):
+    """A multipart/form-data body and its content-type header."""
+    parts = [f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode() for name, value in fields.items()]
+    parts += [
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+        f'Content-Type: application/octet-stream\r\n\r\n'.encode() + data + b"\r\n"
+        for name, (filename, data) in files.items()
+    ]
+    return b"".join(parts) + f"--{boundary}--\r\n".encode(), ("content-type", f"multipart/form-data; boundary={boundary}")
+
+def test_analyze_and_report_streams_predictions_heatmaps_and_report(asgi_app):
+    with open(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data", "xray.jpg"), "rb") as f:
+        image = f.read()
+    body, content_type = multipart({"patient": json.dumps({"age": 63})}, {"file": ("xray.jpg", image)})
+    status, headers, body = asyncio.run(call(asgi_app.app, "POST", "/analyze-and-report", body, [content_type]))
+
+    assert status == 200
+    assert headers["content-type"] == "application/x-ndjson"
+    events = [json.loads(line) for line in body.decode().splitlines()]
+    assert events[0]["event"] == "predictions" and events[-1]["event"] == "report_done"
+    names = {p["name"] for p in events[0]["predictions"]}
+    heatmaps = [e for e in events if e["event"] == "heatmap"]
+    assert heatmaps and all(e["disease"] in names and e["image"] for e in heatmaps)
+    assert "".join(e["text"] for e in events if e["event"] == "report_chunk") == events[-1]["report_text"]
+
+def test_internal_errors_are_logged_not_returned(asgi_app, monkeypatch, capsys):
+    async def broken_predict(image_bytes):
+        raise RuntimeError("secret detail")
+
+    monkeypatch.setattr(asgi_app, "predict_upload", broken_predict)
+    body, content_type = multipart({}, {"file": ("xray.png", b"not really a png")})
+    status, _, body = asyncio.run(call(asgi_app.app, "POST", "/analyze", body, [content_type]))
+    assert status == 500
+    assert json.loads(body) == {"error": "An internal error occurred"}
+    assert "secret detail" in capsys.readouterr().err
@@ -0,0 +1,35 @@
+import torch
+
+from analyze import find_target_layer, generate_gradcams
+from model import CustomDenseNet
+
+CLASSES = [0, 3, 7]
+
+def small_model():
+    """A small CustomDenseNet with non-trivial BatchNorm statistics, so that norm5 shifts and scales."""
+    torch.manual_seed(0)
+    model = CustomDenseNet(growth_rate=4, block_config=(2, 2), num_init_features=8, bn_size=2, drop_rate=0, num_classes=14)
+    with torch.no_grad():
+        for module in model.modules():
+            if isinstance(module, torch.nn.BatchNorm2d):
+                module.running_mean.normal_(0, 0.3)
+                module.running_var.uniform_(0.5, 1.5)
+                module.weight.uniform_(0.5, 1.5)
+                module.bias.normal_(0, 0.3)
+    return model.eval()
+
+def test_closed_form_cams_match_the_hooked_last_conv():
+    model = small_model()
+    x = torch.randn(2, 3, 96, 96)
+    cams, probs, classes = generate_gradcams(model, x, CLASSES)
+    expected, expected_probs, _ = generate_gradcams(model, x, CLASSES, target_layer=find_target_layer(model))
+    assert classes == CLASSES
+    torch.testing.assert_close(probs, expected_probs)
+    torch.testing.assert_close(cams, expected, atol=1e-5, rtol=1e-4)
+
+def test_closed_form_cams_need_no_autograd():
+    model = small_model()
+    x = torch.randn(1, 3, 96, 96)
+    with torch.inference_mode():
+        cams, _, _ = generate_gradcams(model, x, lambda probs: CLASSES)
+    assert cams.shape == (1, len(CLASSES)) + model.features(x).shape[2:]
@@ -0,0 +1,39 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from analyze import encode_heatmaps
+
+def study(seed, num_cams=3):
+    rng = np.random.default_rng(seed)
+    image = rng.integers(0, 256, (224, 224, 3), dtype=np.uint8)
+    cams = {c: rng.random((7, 7)).astype(np.float32) for c in range(num_cams)}
+    return cams, image
+
+def test_interleaved_studies_keep_their_own_overlays():
+    # Both generators render on this thread's renderer; each must still encode its own overlays
+    (cams_a, image_a), (cams_b, image_b) = study(1), study(2)
+    expected_a = list(encode_heatmaps(cams_a, image_a))
+    expected_b = list(encode_heatmaps(cams_b, image_b))
+
+    gen_a, gen_b = encode_heatmaps(cams_a, image_a), encode_heatmaps(cams_b, image_b)
+    got_a, got_b = [next(gen_a)], [next(gen_b)]
+    got_a += list(gen_a)
+    got_b += list(gen_b)
+    assert got_a == expected_a
+    assert got_b == expected_b
+
+def test_concurrent_asgi_requests_do_not_mix_heatmaps(asgi_app, monkeypatch):
+    # One pool thread: the steps of both requests interleave on the same renderer
+    monkeypatch.setattr(asgi_app, "cpu_executor", ThreadPoolExecutor(max_workers=1))
+    studies = [study(seed) for seed in range(4)]
+    expected = [list(encode_heatmaps(cams, image)) for cams, image in studies]
+
+    async def encode(cams, image):
+        return [heatmap async for heatmap in asgi_app.aencode_heatmaps(cams, image)]
+
+    async def run():
+        return await asyncio.gather(*[encode(cams, image) for cams, image in studies])
+
+    assert asyncio.run(run()) == expected
@@ -0,0 +1,45 @@
+import io
+import queue
+import threading
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+import preprocess
+from analyze import predict_image
+from model import build_model
+from preprocess import PreprocessPool
+
+def png_bytes(seed):
+    rng = np.random.default_rng(seed)
+    buffer = io.BytesIO()
+    Image.fromarray(rng.integers(0, 256, (96, 96), dtype=np.uint8)).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+def test_pool_decodes_like_preprocess_image():
+    torch.manual_seed(0)
+    model = build_model().eval()
+    pool = PreprocessPool(workers=1)
+    try:
+        predictions, cams, _ = predict_image(png_bytes(0), model, preprocess_pool=pool)
+        unreadable = predict_image(b"not an image", model, preprocess_pool=pool)
+    finally:
+        pool.close()
+    expected, expected_cams, _ = predict_image(png_bytes(0), model)
+    assert predictions == expected
+    assert cams.keys() == expected_cams.keys()
+    assert unreadable is None
+
+def test_a_saturated_pool_rejects_uploads(monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(preprocess, "_preprocess_worker", lambda image: release.wait(5))
+    pool = PreprocessPool(workers=1, max_pending=1)
+    try:
+        pool.submit(png_bytes(0))
+        with pytest.raises(queue.Full):
+            predict_image(png_bytes(1), None, preprocess_pool=pool)
+    finally:
+        release.set()
+        pool.close()
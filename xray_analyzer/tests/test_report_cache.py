@@ -0,0 +1,60 @@
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import report_cache
+from report_cache import ReportCache
+
+def test_keys_ignore_key_order_and_surrounding_whitespace():
+    cache = ReportCache("v1")
+    key = cache.make_key({"age": 41, "symptoms": ["cough ", " fever"]})
+    assert cache.make_key({"symptoms": ["cough", "fever"], "age": 41}) == key
+    assert cache.make_key({"age": 42, "symptoms": ["cough", "fever"]}) != key
+    assert ReportCache("v2").make_key({"age": 41, "symptoms": ["cough", "fever"]}) != key
+
+def test_concurrent_requests_share_one_upstream_call():
+    cache = ReportCache("v1")
+    release = threading.Event()
+    calls = []
+
+    def generate():
+        calls.append(1)
+        release.wait(timeout=5)
+        return "report"
+
+    with ThreadPoolExecutor(max_workers=5) as pool:
+        futures = [pool.submit(cache.get_or_generate, "k", generate) for _ in range(5)]
+        # Let every request reach the cache before the upstream call returns
+        while cache.stats()["coalesced"] < 4:
+            time.sleep(0.01)
+        release.set()
+        assert [future.result(timeout=5) for future in futures] == ["report"] * 5
+
+    assert len(calls) == 1
+    assert cache.get_or_generate("k", generate) == "report"
+    stats = cache.stats()
+    assert (stats["upstream_calls"], stats["coalesced"], stats["hits"]) == (1, 4, 1)
+
+def test_failures_are_shared_but_not_cached():
+    cache = ReportCache("v1")
+
+    def fail():
+        raise RuntimeError("provider error")
+
+    with pytest.raises(RuntimeError, match="provider error"):
+        cache.get_or_generate("k", fail)
+    assert cache.get_or_generate("k", lambda: "report") == "report"
+    assert cache.stats()["upstream_calls"] == 2
+
+def test_disk_tier_survives_a_restart_until_the_ttl(tmp_path, monkeypatch):
+    ReportCache("v1", disk_dir=str(tmp_path)).get_or_generate("k", lambda: "report")
+    restarted = ReportCache("v1", ttl_seconds=60, disk_dir=str(tmp_path))
+    assert restarted.get_or_generate("k", lambda: "new report") == "report"
+    assert restarted.stats()["disk_hits"] == 1
+
+    later = time.time() + 61
+    monkeypatch.setattr(report_cache, "time", types.SimpleNamespace(time=lambda: later, perf_counter=time.perf_counter))
+    assert ReportCache("v1", ttl_seconds=60, disk_dir=str(tmp_path)).get_or_generate("k", lambda: "new report") == "new report"
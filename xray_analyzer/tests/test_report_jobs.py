@@ -0,0 +1,90 @@
+import queue
+import threading
+import time
+
+import pytest
+
+from report_jobs import ReportJobQueue
+
+def test_reports_run_in_the_background_up_to_the_concurrency_limit():
+    release = threading.Event()
+    running, peak = [0], [0]
+    lock = threading.Lock()
+
+    def generate(patient_data):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        release.wait(5)
+        with lock:
+            running[0] -= 1
+        yield f"report for {patient_data['age']}"
+
+    jobs = ReportJobQueue(generate, max_concurrency=2, max_pending=4)
+    try:
+        job_ids = [jobs.submit({"age": age}) for age in range(4)]
+        # submit returned at once, while every report is still waiting on the provider
+        assert all(jobs.get(job_id).status in ("queued", "running") for job_id in job_ids)
+        with pytest.raises(queue.Full):
+            jobs.submit({"age": 99})
+
+        release.set()
+        texts = [jobs.wait(job_id, timeout=5).report_text for job_id in job_ids]
+    finally:
+        jobs.close()
+    assert texts == [f"report for {age}" for age in range(4)]
+    assert peak[0] == 2
+    assert jobs.stats()["completed"] == 4
+
+def test_resubmits_join_the_job_in_flight():
+    release = threading.Event()
+
+    def generate(patient_data):
+        release.wait(5)
+        yield "report"
+
+    jobs = ReportJobQueue(generate, max_concurrency=1)
+    try:
+        first = jobs.submit({"age": 41}, key="k")
+        assert jobs.submit({"age": 41}, key="k") == first
+        release.set()
+        jobs.wait(first, timeout=5)
+        # Once it is done, the same key starts a new job
+        assert jobs.submit({"age": 41}, key="k") != first
+    finally:
+        jobs.close()
+    assert jobs.stats()["deduplicated"] == 1
+
+def test_failed_reports_keep_their_error_until_they_expire():
+    def generate(patient_data):
+        yield "partial"
+        raise RuntimeError("provider unavailable")
+
+    jobs = ReportJobQueue(generate, ttl_seconds=0.05)
+    try:
+        job = jobs.wait(jobs.submit({"age": 41}), timeout=5)
+        assert (job.status, job.error) == ("error", "provider unavailable")
+        assert job.to_json()["report_text"] == "partial"
+        assert jobs.stats()["failed"] == 1
+
+        time.sleep(0.1)
+        jobs.submit({"age": 42})
+        assert jobs.get(job.job_id) is None
+    finally:
+        jobs.close()
+
+def test_flask_report_jobs_are_polled_until_done(asgi_app):
+    import main
+    client = main.app.test_client()
+    response = client.post("/generate-report", json={"age": 57, "symptoms": "fever"})
+    assert response.status_code == 202
+    job = response.get_json()
+    assert job["status"] == "queued" and job["status_url"] == f"/reports/{job['job_id']}"
+
+    deadline = time.monotonic() + 5
+    while (status := client.get(job["status_url"]).get_json())["status"] in ("queued", "running"):
+        assert time.monotonic() < deadline
+        time.sleep(0.02)
+    assert status["status"] == "done" and status["report_text"]
+    assert client.post("/generate-report", json={}).status_code == 400
+    assert client.get("/reports/unknown").status_code == 404
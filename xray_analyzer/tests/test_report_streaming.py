@@ -0,0 +1,62 @@
+import json
+import threading
+
+from report_jobs import ReportJobQueue
+
+def test_chunks_are_readable_while_the_report_is_generated():
+    first_read = threading.Event()
+
+    def generate(patient_data):
+        yield "Findings: "
+        first_read.wait(5)
+        yield "no acute disease."
+
+    jobs = ReportJobQueue(generate)
+    try:
+        job = jobs.get(jobs.submit({"age": 41}))
+        assert job.wait_for_chunks(0, timeout=5) == ["Findings: "]
+        assert not job.done.is_set()
+        assert job.to_json()["report_text"] == "Findings: "
+        assert job.first_chunk_at is not None
+
+        first_read.set()
+        assert job.wait_for_chunks(1, timeout=5) == ["no acute disease."]
+        jobs.wait(job.job_id, timeout=5)
+    finally:
+        jobs.close()
+    assert job.report_text == "Findings: no acute disease."
+    # Past the end of a finished report there is nothing to wait for
+    assert job.wait_for_chunks(2, timeout=5) == []
+
+def test_flask_report_events_stream_the_whole_report(asgi_app):
+    import main
+    client = main.app.test_client()
+    job = client.post("/generate-report", json={"age": 63, "symptoms": "cough"}).get_json()
+
+    response = client.get(job["events_url"])
+    assert response.mimetype == "text/event-stream"
+    body = response.get_data(as_text=True)
+    events = [
+        (block.split("\n")[0][len("event: "):], json.loads(block.split("\n")[1][len("data: "):]))
+        for block in body.split("\n\n") if block.startswith("event: ")
+    ]
+    assert events[0][0] == "status" and events[-1][0] == "done"
+    assert {name for name, _ in events[1:-1]} == {"chunk"}
+    assert "".join(data["text"] for _, data in events[1:-1]) == events[-1][1]["report_text"]
+    assert client.get("/reports/unknown/events").status_code == 404
+
+def test_flask_report_events_end_with_failed(asgi_app, monkeypatch):
+    import main
+
+    def generate(patient_data):
+        yield "Findings: "
+        raise RuntimeError("provider unavailable")
+
+    monkeypatch.setattr(main.report_jobs, "generate_fn", generate)
+    client = main.app.test_client()
+    job = client.post("/generate-report", json={"age": 70, "symptoms": "dyspnea"}).get_json()
+    body = client.get(job["events_url"]).get_data(as_text=True)
+    last = body.strip().split("\n\n")[-1].split("\n")
+    assert last[0] == "event: failed"
+    assert json.loads(last[1][len("data: "):])["error"] == "provider unavailable"
+    assert 'data: {"text": "Findings: "}' in body
@@ -1,17 +1,34 @@
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
 from torchvision import transforms
+import numpy as np
+from io import BytesIO
 
-def preprocess_image(image_path):
+INPUT_SIZE = 224
+
+# Built once; the resize happens separately so the same resized image feeds the model and the overlay
+MODEL_TRANSFORM = transforms.Compose([
+    transforms.ToTensor(),
+    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+])
+
+def load_image(image, draft_size=None):
+    """Decodes a path, raw bytes, a file-like object or an RGB/grayscale array into an RGB PIL image."""
+    if isinstance(image, Image.Image): return image.convert("RGB")
+    if isinstance(image, np.ndarray): return Image.fromarray(image).convert("RGB")
+    if isinstance(image, (bytes, bytearray, memoryview)): image = BytesIO(image)
+    image = Image.open(image)
+    if draft_size is not None: image.draft(None, draft_size) # reduced-resolution JPEG decoding
+    return image.convert("RGB")
+
+def preprocess_image(image):
     try:
-        image = Image.open(image_path).convert("RGB")
+        image = load_image(image, draft_size=(INPUT_SIZE, INPUT_SIZE))
     except FileNotFoundError:
-        print(f"Error: Image file not found at '{image_path}'")
+        print(f"Error: Image file not found at '{image}'")
+        return None, None
+    except UnidentifiedImageError:
+        print("Error: Could not decode the image")
         return None, None
         
-    transform = transforms.Compose([
-        transforms.Resize((224, 224)),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-    ])
-    
-    return transform(image).unsqueeze(0), image.resize((224, 224))
\ No newline at end of file
+    resized = image.resize((INPUT_SIZE, INPUT_SIZE), Image.BILINEAR, reducing_gap=3.0)
+    return MODEL_TRANSFORM(resized).unsqueeze(0), resized
\ No newline at end of file
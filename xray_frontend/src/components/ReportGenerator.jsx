@@ -18,6 +18,26 @@ const INITIAL_STATE = {
   }
 };
 
+const API_URL = 'http://127.0.0.1:5000';
+
+// Follows a report job's server-sent events until it is done, passing each streamed chunk to onChunk
+const waitForReport = (eventsUrl, onChunk) => new Promise((resolve, reject) => {
+  const events = new EventSource(eventsUrl);
+  events.addEventListener('chunk', (e) => onChunk(JSON.parse(e.data).text));
+  events.addEventListener('done', (e) => {
+    events.close();
+    resolve(JSON.parse(e.data));
+  });
+  events.addEventListener('failed', (e) => {
+    events.close();
+    reject(new Error(JSON.parse(e.data).error));
+  });
+  events.onerror = () => {
+    events.close();
+    reject(new Error('Lost connection to the server'));
+  };
+});
+
 const ReportGenerator = () => {
   const [formData, setFormData] = useState(INITIAL_STATE);
   const [report, setReport] = useState('');
@@ -51,13 +71,15 @@ const ReportGenerator = () => {
     };
     
     try {
-      const response = await fetch('http://127.0.0.1:5000/generate-report', {
+      const response = await fetch(`${API_URL}/generate-report`, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify(finalData)
       });
       if (!response.ok) throw new Error('Server returned an error');
-      const data = await response.json();
+      // The report is generated in the background; the response only carries the job
+      const job = await response.json();
+      const data = await waitForReport(`${API_URL}${job.events_url}`, (text) => setReport(prev => prev + text));
       setReport(data.report_text);
     } catch (err) {
       setError(`Failed to generate report: ${err.message}`);
@@ -91,7 +113,7 @@ const ReportGenerator = () => {
         </div>
         <div className="report-display card">
             <h3 className="card-title">Generated Report</h3>
-            {isLoading && <p>AI is generating the report, please wait...</p>}
+            {isLoading && !report && <p>AI is generating the report, please wait...</p>}
             {error && <p style={{color: 'red'}}>{error}</p>}
             {report && <pre className="report-text">{report}</pre>}
         </div>